@@ -0,0 +1,200 @@
+"""
+Кнопки обработки изображений: общая часть синхронного (bot.py) и асинхронного (async_bot.py) бота.
+
+Модуль не обращается к Telegram и не загружает файлы: он только решает по нажатой кнопке и состоянию пользователя,
+что нужно сделать. Загрузку, обработку и отправку каждый бот выполняет своими средствами (потоки и пул процессов
+планировщика или цикл событий asyncio):
+- IMAGE_ACTIONS: кнопки преобразований - операция, функция, аргументы, профиль кодирования, ответ на нажатие;
+- plan_job: задание для нажатой кнопки (одно изображение, альбом или ASCII-арт) или отказ ActionRejected, если
+фотографии нет или цепочка пуста;
+- add_chain_step: добавление шага в цепочку преобразований;
+- is_animated: обрабатывается ли изображение покадрово;
+- send_method, sent_file_id, result_file: отправка результата (фотография, документ или анимация);
+- ascii_args, ascii_messages: параметры ASCII-арта пользователя и разбиение готового текста на сообщения;
+- button_label: метка кнопки для метрик из фиксированного набора BUTTON_LABELS.
+"""
+import io
+
+import encoding
+from ascii_art import chunk_ascii_rows
+from colormaps import COLORMAPS, apply_colormap
+from image_processing import (ASCII_CHARS, ASCII_MAX_MESSAGES, ASCII_MESSAGE_OVERHEAD, ASCII_ORDER_BY_BRIGHTNESS,
+                              ASCII_WIDTH, convert_to_heatmap, invert_colors, mirror_image, pixelate_image,
+                              resize_for_sticker)
+from pipeline import MAX_STEPS, STEPS, output_profile, render_steps
+
+NO_PHOTO = "Я не нашел вашу фотографию. Пожалуйста, пришлите изображение еще раз."
+EMPTY_CHAIN = "Цепочка пуста. Добавьте хотя бы один шаг."
+
+# Кнопки преобразований: callback_data -> (операция, функция, аргументы, профиль кодирования, ответ на нажатие).
+# Операция определяет бюджет разрешения и ключ кэша результатов: mirror_horizontal и mirror_vertical - одна
+# операция с разными аргументами, как и все палитры palette:<название>
+IMAGE_ACTIONS = {
+    "pixelate": ("pixelate", pixelate_image, (20,), "pixel_art", "Пикселизация вашего изображения..."),
+    "invert": ("invert", invert_colors, (), "photo", "Инверсия цветов изображения..."),
+    "mirror_horizontal": ("mirror", mirror_image, ("horizontal",), "photo", "Отражение изображения по горизонтали..."),
+    "mirror_vertical": ("mirror", mirror_image, ("vertical",), "photo", "Отражение изображения по вертикали..."),
+    "heatmap": ("heatmap", convert_to_heatmap, (), "photo", "Создание тепловой карты изображения..."),
+    "sticker": ("sticker", resize_for_sticker, (512,), "sticker", "Подготовка изображения для стикера..."),
+    **{f"palette:{name}": ("palette", apply_colormap, (name,), "photo", "Применение палитры...")
+       for name in COLORMAPS},
+}
+
+
+class ActionRejected(Exception):
+    """
+    Кнопку нельзя выполнить.
+    notice: ответ на нажатие кнопки (или None)
+    message: сообщение в чат (или None)
+    """
+
+    def __init__(self, notice=None, message=None):
+        super().__init__(notice or message)
+        self.notice = notice
+        self.message = message
+
+
+class Job:
+    """
+    Задание для нажатой кнопки (plan_job).
+    kind: 'image' - одно изображение, 'album' - все фотографии альбома, 'ascii' - ASCII-арт
+    operation, func, args, profile: преобразование; профиль 'animation' - покадровая обработка GIF
+    notice: ответ на нажатие кнопки
+    """
+    __slots__ = ('kind', 'operation', 'func', 'args', 'profile', 'notice')
+
+    def __init__(self, kind, operation, func=None, args=(), profile="photo", notice=None):
+        self.kind = kind
+        self.operation = operation
+        self.func = func
+        self.args = args
+        self.profile = profile
+        self.notice = notice
+
+    @property
+    def name(self):
+        """
+        Название задания для трассировки (модуль metrics)
+        """
+        return "album" if self.kind == "album" else self.operation
+
+
+# Метки кнопок в метриках: callback_data присылает клиент, поэтому метка берется только из этого набора
+BUTTON_LABELS = frozenset(data.split(":", 1)[0] for data in IMAGE_ACTIONS) | {
+    "ascii", "palettes", "chain", "chain_add", "chain_run", "chain_clear", "joke", "compliment", "flip_coin"}
+
+
+def button_label(data):
+    """
+    Метка нажатой кнопки для метрик: префикс callback_data до двоеточия или "other" для неизвестных данных
+    """
+    label = (data or "").split(":", 1)[0]
+    return label if label in BUTTON_LABELS else "other"
+
+
+def is_job_button(data):
+    """
+    Запускает ли кнопка обработку изображения пользователя
+    """
+    return data in IMAGE_ACTIONS or data in ("ascii", "chain_run")
+
+
+def plan_job(state, data):
+    """
+    Задание для кнопки обработки изображения (is_job_button).
+    Кнопки преобразований и цепочки применяются ко всем фотографиям альбома, ASCII-арт - к первой фотографии.
+    Шаги цепочки запоминаются на момент нажатия: пока задание ждет в очереди, цепочку могут изменить.
+    Вызывает ActionRejected, если фотографии нет (сессия истекла) или цепочка пуста.
+    """
+    if state is None:
+        raise ActionRejected(message=NO_PHOTO)
+    if data == "ascii":
+        return Job("ascii", "ascii", notice="Преобразование вашего изображения в формат ASCII...")
+    if data == "chain_run":
+        steps = state.chain
+        if not steps:
+            raise ActionRejected(message=EMPTY_CHAIN)
+        operation, func, args, profile = "chain", render_steps, (steps,), output_profile(steps)
+        notice = "Применение цепочки преобразований..."
+    else:
+        operation, func, args, profile, notice = IMAGE_ACTIONS[data]
+    if state.album:
+        return Job("album", operation, func, args, profile, f"Обработка альбома ({len(state.album)} фото)...")
+    if is_animated(state, operation, args):
+        profile = "animation"
+    return Job("image", operation, func, args, profile, notice)
+
+
+def add_chain_step(state, step):
+    """
+    Добавление шага в цепочку преобразований пользователя.
+    Возвращает (новый список шагов, ответ на нажатие); список - None, если шаг добавить нельзя.
+    """
+    if state is None:
+        return None, "Пожалуйста, пришлите изображение еще раз."
+    steps = list(state.chain or [])
+    if step not in STEPS or len(steps) >= MAX_STEPS:
+        return None, f"В цепочке может быть не больше {MAX_STEPS} шагов."
+    steps.append(step)
+    return steps, "Цепочка: " + " → ".join(STEPS[name][3] for name in steps)
+
+
+def is_animated(state, operation, args=()):
+    """
+    Обрабатывается ли изображение пользователя покадрово: да для GIF, кроме стикера и цепочки со стикером
+    (для них используется первый кадр)
+    """
+    if state.media != "animation" or operation == "sticker":
+        return False
+    return not (operation == "chain" and "sticker" in args[0])
+
+
+def send_method(profile, file_name="image"):
+    """
+    Метод бота для отправки результата и его именованные аргументы: стикер отправляется как документ,
+    анимация - как анимация, остальное - как фотография
+    """
+    if encoding.is_document(profile):
+        return "send_document", {"visible_file_name": encoding.file_name(profile, file_name),
+                                 "disable_content_type_detection": True}
+    if encoding.is_animation(profile):
+        return "send_animation", {}
+    return "send_photo", {}
+
+
+def sent_file_id(message):
+    """
+    file_id отправленного результата. Для GIF Telegram присылает и animation, и document.
+    """
+    if message.animation is not None:
+        return message.animation.file_id
+    if message.document is not None:
+        return message.document.file_id
+    return message.photo[-1].file_id
+
+
+def result_file(data, profile, file_name="image"):
+    """
+    Байты результата как файл для отправки (имя с расширением профиля кодирования)
+    """
+    content = io.BytesIO(data)
+    content.name = encoding.file_name(profile, file_name)
+    return content
+
+
+def ascii_args(state):
+    """
+    Аргументы image_to_ascii после изображения: ширина, набор символов пользователя (или стандартный),
+    количество сообщений и упорядочивание символов. Они же - параметры ключа кэша результатов.
+    """
+    return ASCII_WIDTH, state.ascii_chars or ASCII_CHARS, ASCII_MAX_MESSAGES, ASCII_ORDER_BY_BRIGHTNESS
+
+
+def ascii_messages(ascii_art):
+    """
+    Тексты сообщений (MarkdownV2) с ASCII-артом: каждое содержит целые строки в блоке кода и не превышает
+    ограничение Telegram. Внутри блока кода экранируются только обратная косая черта и обратный апостроф.
+    """
+    # Текст заканчивается переводом строки; splitlines не подходит: он делит и по символам вроде \x0c
+    chunks = chunk_ascii_rows(ascii_art.split("\n")[:-1], overhead=ASCII_MESSAGE_OVERHEAD) or ["\n"]
+    return ["```\n" + chunk.replace("\\", "\\\\").replace("`", "\\`") + "```" for chunk in chunks]
@@ -0,0 +1,72 @@
+"""
+Сбор фотографий альбома (media group).
+
+Telegram присылает альбом как несколько отдельных сообщений с одинаковым media_group_id, причем сообщения
+могут прийти в разных пакетах обновлений. Раньше каждая фотография альбома заменяла предыдущую в состоянии
+пользователя, и обработать можно было только одну из них. MediaGroupBuffer накапливает сообщения альбома,
+пока они приходят, и отдает их вместе, когда новых сообщений нет дольше заданной задержки (debounce).
+
+Буфер не зависит от способа отложенного вызова: синхронный бот использует threading.Timer,
+асинхронный - loop.call_later. Порядок работы:
+- add: добавляет сообщение; если это первое сообщение альбома, нужно запланировать проверку через delay;
+- due: сколько еще ждать до завершения альбома (0 - альбом собран);
+- pop: забирает собранный альбом.
+"""
+import threading
+import time
+
+# Максимальное количество фотографий в альбоме Telegram (и в одном вызове send_media_group)
+MAX_ALBUM_SIZE = 10
+
+
+class MediaGroupBuffer:
+    """
+    Буфер сообщений альбомов
+    delay: сколько ждать следующую фотографию альбома, в секундах
+    """
+
+    def __init__(self, delay=1.0):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._groups = {}  # media_group_id -> [chat_id, сообщения, время последнего сообщения]
+
+    def __len__(self):
+        """
+        Количество альбомов, которые еще собираются
+        """
+        with self._lock:
+            return len(self._groups)
+
+    def add(self, message):
+        """
+        Добавляет сообщение альбома. Возвращает True для первого сообщения альбома.
+        """
+        with self._lock:
+            group = self._groups.get(message.media_group_id)
+            if group is None:
+                self._groups[message.media_group_id] = [message.chat.id, [message], time.monotonic()]
+                return True
+            group[1].append(message)
+            group[2] = time.monotonic()
+            return False
+
+    def due(self, media_group_id):
+        """
+        Оставшееся время ожидания альбома в секундах (0 - новых сообщений не было дольше delay)
+        """
+        with self._lock:
+            group = self._groups.get(media_group_id)
+            if group is None:
+                return 0
+            return max(0.0, group[2] + self.delay - time.monotonic())
+
+    def pop(self, media_group_id):
+        """
+        Забирает альбом. Возвращает (chat_id, сообщения по порядку отправки) или None.
+        """
+        with self._lock:
+            group = self._groups.pop(media_group_id, None)
+        if group is None:
+            return None
+        chat_id, messages, _ = group
+        return chat_id, sorted(messages, key=lambda message: message.message_id)[:MAX_ALBUM_SIZE]
@@ -0,0 +1,155 @@
+"""
+Покадровая обработка анимаций (GIF, отправленных как файл или как анимация).
+
+Раньше бот принимал только фотографии. Для анимации те же преобразования (pixelate_image, invert_colors,
+mirror_image, convert_to_heatmap, палитры и цепочки) применяются к каждому кадру:
+- кадры читаются по одному генератором поверх ImageSequence (iter_frames) и сразу уменьшаются до размера,
+который укладывается в бюджет;
+- кадры обрабатываются пачками (transform_chunk) параллельно в пуле процессов; одновременно в работе
+находится ограниченное число пачек (scheduler.imap_executor), поэтому исходные кадры длинной анимации
+никогда не загружаются в память все сразу;
+- обработанные кадры для GIF сразу переводятся в палитру (1 байт на точку) в процессе пула, а результат
+кодируется в анимированный GIF или WebP (ANIMATION_FORMAT). Кодировщики Pillow принимают только полный список
+кадров, поэтому обработанные кадры ограничены бюджетом.
+
+Бюджет защищает процесс от слишком больших анимаций: ANIMATION_MAX_FRAMES (количество кадров),
+ANIMATION_MAX_SIDE (длинная сторона кадра, больше - уменьшается), ANIMATION_MAX_PIXELS (сумма точек всех
+кадров после уменьшения). Если анимация не укладывается в бюджет, вызывается AnimationTooLarge. Кадр больше
+бюджета точек IMAGE_MAX_PIXELS (модуль limits) отклоняется до декодирования: уменьшение при декодировании
+для GIF невозможно.
+Настройки: ANIMATION_CHUNK_FRAMES (кадров в пачке).
+"""
+import itertools
+import os
+import time
+
+from PIL import Image, ImageSequence
+
+import encoding
+from image_loader import open_image
+from limits import ImageTooLarge, check_size
+
+MAX_FRAMES = int(os.getenv('ANIMATION_MAX_FRAMES', 300))
+MAX_SIDE = int(os.getenv('ANIMATION_MAX_SIDE', 480))
+MAX_PIXELS = int(os.getenv('ANIMATION_MAX_PIXELS', 40_000_000))
+CHUNK_FRAMES = int(os.getenv('ANIMATION_CHUNK_FRAMES', 8))
+
+# Длительность кадра по умолчанию, если она не указана в файле, мс
+DEFAULT_DURATION = 100
+
+# Фон, на который накладываются полупрозрачные кадры при сохранении в GIF (в GIF нет полупрозрачности)
+GIF_BACKGROUND = (255, 255, 255)
+
+
+class AnimationTooLarge(ImageTooLarge):
+    """
+    Анимация не укладывается в бюджет кадров или точек
+    """
+
+
+def frame_size(image, budget=None):
+    """
+    Размер кадров после уменьшения до бюджета операции (budget) и ANIMATION_MAX_SIDE.
+    Проверяет бюджет кадров и точек.
+    """
+    frames = getattr(image, "n_frames", 1)
+    if frames > MAX_FRAMES:
+        raise AnimationTooLarge(f"Too many frames: {frames} > {MAX_FRAMES}")
+    width, height = image.size
+    side = min(MAX_SIDE, budget) if budget else MAX_SIDE
+    scale = min(1.0, side / max(width, height))
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if frames * size[0] * size[1] > MAX_PIXELS:
+        raise AnimationTooLarge(f"Too many pixels: {frames} frames of {size[0]}x{size[1]}")
+    return size
+
+
+def iter_frames(image, size):
+    """
+    Генератор кадров анимации: (кадр RGB или RGBA размера size, длительность в мс).
+    Кадры читаются по одному, так как seek меняет изображение на месте.
+    """
+    mode = "RGBA" if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info else "RGB"
+    for frame in ImageSequence.Iterator(image):
+        duration = frame.info.get("duration") or DEFAULT_DURATION
+        frame = frame.convert(mode)
+        if frame.size != size:
+            frame = frame.resize(size, Image.BILINEAR, reducing_gap=2.0)
+        yield frame, duration
+
+
+def chunked(items, size):
+    """
+    Разбивает последовательность на списки по size элементов
+    """
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def serial_imap(func, items, *args):
+    """
+    Обработка пачек по очереди в текущем потоке (без пула процессов)
+    """
+    for item in items:
+        yield func(item, *args)
+
+
+def transform_chunk(frames, func, args=(), image_format="GIF"):
+    """
+    Применяет преобразование к пачке кадров (задание для пула процессов).
+    Для GIF кадры сразу переводятся в палитру: их меньше передавать и хранить до кодирования.
+    """
+    return [prepare_frame(func(frame, *args), image_format) for frame in frames]
+
+
+def prepare_frame(frame, image_format):
+    if image_format != "GIF":
+        return frame if frame.mode in ("RGB", "RGBA") else frame.convert("RGB")
+    if frame.mode in ("RGBA", "LA", "PA") or (frame.mode == "P" and "transparency" in frame.info):
+        background = Image.new("RGB", frame.size, GIF_BACKGROUND)
+        background.paste(frame, mask=frame.convert("RGBA"))
+        frame = background
+    elif frame.mode != "RGB":
+        frame = frame.convert("RGB")
+    return frame.quantize(colors=256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+
+
+def encode_animation(frames, durations, loop=0, image_format="GIF"):
+    """
+    Кодирует кадры в анимированный GIF или WebP
+    """
+    options = {"optimize": False} if image_format == "GIF" else {"quality": 80, "method": 4}
+    return encoding.save(frames[0], image_format, dict(options, save_all=True, append_images=frames[1:],
+                                                       duration=durations, loop=loop))
+
+
+def render_animation(data, func, args=(), budget=None, imap=serial_imap, profile="animation"):
+    """
+    Покадровая обработка анимации и кодирование результата.
+    data: содержимое файла
+    budget: бюджет разрешения операции (модуль image_loader)
+    imap: функция imap(func, items, *args) для параллельной обработки пачек (scheduler.imap_cpu)
+    Возвращает (байты, {'transform': мс, 'encode': мс}), как apply_and_encode_timed.
+    """
+    image_format = encoding.PROFILES[profile]["format"]
+    started = time.perf_counter()
+    with open_image(data) as image:
+        try:
+            check_size(image, oversize="reject")
+        except ImageTooLarge as error:
+            raise AnimationTooLarge(str(error)) from error
+        size = frame_size(image, budget)
+        loop = image.info.get("loop", 0)
+        durations = []
+
+        def chunks():
+            for chunk in chunked(iter_frames(image, size), CHUNK_FRAMES):
+                durations.extend(duration for _, duration in chunk)
+                yield [frame for frame, _ in chunk]
+
+        frames = [frame for chunk in imap(transform_chunk, chunks(), func, args, image_format) for frame in chunk]
+    transformed = time.perf_counter()
+    result = encode_animation(frames, durations, loop, image_format)
+    encoded = time.perf_counter()
+    return result, {'transform': (transformed - started) * 1000, 'encode': (encoded - transformed) * 1000}
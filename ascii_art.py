@@ -0,0 +1,116 @@
+"""
+Быстрое построение ASCII-арта.
+
+Вместо обхода пикселей по одному и сложения строк для каждого набора символов один раз строится таблица
+из 256 элементов (яркость -> символ). Затем весь буфер изображения в градациях серого переводится в символы
+за один проход с помощью bytes.translate (или str.translate для символов вне Latin-1), а строки
+собираются одним вызовом join.
+
+Функции:
+- build_ascii_table: таблица соответствия яркости и символа для набора символов (кэшируется);
+- pixels_to_ascii: преобразует изображение в оттенках серого в строку символов;
+- render_ascii_rows: изменяет размер изображения и возвращает список строк ASCII-арта;
+- chunk_ascii_rows: разбивает строки на сообщения, не превышающие ограничение Telegram;
+- order_by_brightness: упорядочивает пользовательский набор символов от самого "плотного" к самому светлому.
+"""
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+
+# Коэффициент высоты, так как высота символов больше их ширины
+CHAR_ASPECT = 0.55
+
+
+@lru_cache(maxsize=128)
+def build_ascii_table(ascii_chars):
+    """
+    Строит таблицу из 256 элементов: яркость пикселя -> символ.
+    Для символов из Latin-1 возвращает bytes для bytes.translate, иначе - кортеж строк для str.translate.
+    """
+    if not ascii_chars:
+        raise ValueError("Набор символов для ASCII-арта не может быть пустым")
+    count = len(ascii_chars)
+    glyphs = [ascii_chars[value * count // 256] for value in range(256)]
+    if all(ord(glyph) < 256 for glyph in glyphs):
+        return bytes(ord(glyph) for glyph in glyphs)
+    return tuple(glyphs)
+
+
+def pixels_to_ascii(image, ascii_chars):
+    """
+    Преобразование пикселей изображения в оттенках серого в строку символов за один проход
+    """
+    if image.mode != 'L':
+        image = image.convert('L')
+    table = build_ascii_table(ascii_chars)
+    data = image.tobytes()
+    if isinstance(table, bytes):
+        return data.translate(table).decode('latin-1')
+    return data.decode('latin-1').translate(table)
+
+
+def render_ascii_rows(image, new_width=40, ascii_chars='@%#*+=-:. ', max_rows=None):
+    """
+    Изменяет размер изображения с учетом пропорций символов и возвращает список строк ASCII-арта
+    image: объект PIL.Image
+    new_width: ширина ASCII-арта в символах
+    max_rows: максимальное количество строк (None - без ограничения)
+    """
+    image = image.convert('L')
+    width, height = image.size
+    new_height = int(height / float(width) * new_width * CHAR_ASPECT)
+    rows = new_height if max_rows is None else min(new_height, max_rows)
+    if rows <= 0:
+        return []
+
+    # Изменяем размер, сохраняя пропорции исходного изображения, и отбрасываем лишние строки
+    img_resized = image.resize((new_width, new_height))
+    if rows < new_height:
+        img_resized = img_resized.crop((0, 0, new_width, rows))
+
+    text = pixels_to_ascii(img_resized, ascii_chars)
+    return [text[i:i + new_width] for i in range(0, len(text), new_width)]
+
+
+def chunk_ascii_rows(rows, limit=MESSAGE_LIMIT, overhead=0):
+    """
+    Разбивает строки ASCII-арта на несколько сообщений.
+    Каждое сообщение содержит целые строки, а его длина вместе с overhead (например, разметкой
+    блока кода) не превышает limit.
+    """
+    chunks = []
+    current = []
+    size = overhead
+    for row in rows:
+        row_size = len(row) + 1
+        if current and size + row_size > limit:
+            chunks.append("\n".join(current) + "\n")
+            current = []
+            size = overhead
+        current.append(row)
+        size += row_size
+    if current:
+        chunks.append("\n".join(current) + "\n")
+    return chunks
+
+
+@lru_cache(maxsize=128)
+def order_by_brightness(ascii_chars):
+    """
+    Упорядочивает символы по "плотности" начертания: сначала самые темные (с наибольшим количеством
+    закрашенных пикселей), в конце - самые светлые. Так пользовательский набор символов в любом порядке
+    дает правильный ASCII-арт.
+    """
+    font = ImageFont.load_default()
+    left, top, right, bottom = font.getbbox("@")
+    cell = (max(right - left, 1) * 2, max(bottom - top, 1) * 2)
+
+    def ink(glyph):
+        canvas = Image.new('L', cell, 0)
+        ImageDraw.Draw(canvas).text((0, 0), glyph, fill=255, font=font)
+        return sum(value * count for value, count in enumerate(canvas.histogram()))
+
+    return ''.join(sorted(ascii_chars, key=ink, reverse=True))
@@ -0,0 +1,534 @@
+"""
+Асинхронный режим работы бота на AsyncTeleBot.
+
+В этом режиме все чаты обслуживаются одним циклом событий asyncio: запросы get_file, download_file и
+send_photo не блокируют поток, а HTTP-соединения с Telegram API переиспользуются (keep-alive) через общий
+пул сессий aiohttp. Обновления принимаются либо опросом (polling), либо через локальный веб-сервер (webhook).
+Обработка изображений выполняется в пуле процессов планировщика (bot.scheduler), чтобы не останавливать цикл
+событий: задание ждет результат через asyncio.wrap_future и не занимает поток; при WORKER_PROCESSES=0 - в отдельном
+потоке. Хранилище состояний, кэш результатов и кэш загрузок вызываются в своем пуле потоков (run_store,
+ASYNC_STORE_THREADS): с STATE_BACKEND=sqlite, RESULT_CACHE_PATH и DOWNLOAD_CACHE_DIR они читают и записывают файлы,
+а обработчики всех чатов (например, фильтр is_awaiting_charset) не должны ждать за декодированием и покадровой
+обработкой анимаций, которые выполняются в пуле потоков asyncio по умолчанию.
+
+Бот создается фабрикой create_app (общие объекты - хранилище состояний, кэши, метрики - создает модуль bot,
+bot.create_components); при импорте модуля ничего не создается. Обработчики (register_handlers) повторяют
+обработчики синхронного бота (bot.py):
+- send_welcome: команды /start и /help;
+- handle_photo: получение изображения;
+- set_ascii_chars: ввод пользовательского набора символов;
+- callback_query: нажатие кнопок; что делать по кнопке обработки изображения, решает модуль actions (общий
+с синхронным ботом), здесь - только загрузка, обработка и отправка средствами asyncio (run_job);
+- album_and_send: обработка всех фотографий альбома и отправка одним вызовом send_media_group.
+
+Запуск:
+    python async_bot.py                      # опрос (polling)
+    python async_bot.py --webhook --port 8080 --webhook-url https://example.com
+
+Переменные окружения:
+- TELEGRAM_API_URL: адрес Bot API (например, локального тестового сервера http://127.0.0.1:8081);
+- TELEGRAM_MAX_CONNECTIONS: максимальное количество одновременных HTTP-соединений с Bot API;
+- ASYNC_STORE_THREADS: количество потоков для хранилища состояний и кэшей (run_store);
+- WEBHOOK_SECRET: секрет для проверки заголовка X-Telegram-Bot-Api-Secret-Token;
+- DISPATCH_*: ограничение частоты отправки, как в синхронном боте (модуль dispatch);
+- METRICS_PORT, METRICS_LOG, METRICS_PROFILE_RATE: метрики этапов обработки, как в синхронном боте (модуль metrics);
+- IMAGE_MAX_PIXELS, IMAGE_OVERSIZE, JOB_MEMORY_LIMIT_MB, MALLOC_MMAP_THRESHOLD_KB: ограничения памяти, как в синхронном
+боте (модуль limits).
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import random
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from aiohttp import web
+from telebot import asyncio_helper, types
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.async_telebot import AsyncTeleBot
+
+import actions
+import animation
+import dispatch
+import encoding
+import bot as sync_bot
+from bot import (ALBUM_RECEIVED, COMPLIMENTS, FILE_RECEIVED, FILE_TOO_LARGE, JOKES, MAX_FILE_SIZE, UNSUPPORTED_FILE,
+                 album_selection, file_media, get_chain_keyboard, get_options_keyboard, get_palette_keyboard,
+                 image_decoder, job_key, record_download, record_encoding, result_key, save_album)
+from image_loader import photo_sizes, select_for_operation
+from image_processing import apply_and_encode_timed, image_to_ascii
+from scheduler import chat_queue
+
+logger = logging.getLogger(__name__)
+
+# Бот создается функцией create_app; общие объекты (хранилище состояний, кэши, метрики) - модулем bot
+bot = None
+
+# Пул потоков для хранилища состояний и кэшей (run_store), создается в create_app
+store_executor = None
+
+# Блокировки чатов: задания одного чата выполняются по очереди.
+# chat_id -> [блокировка, количество заданий чата, которые ее держат или ждут]
+chat_locks = {}
+
+# Ссылки на запущенные задачи, чтобы они не были удалены сборщиком мусора до завершения
+background_tasks = set()
+
+async def send_welcome(message):
+    """
+    Обработчик команд /start и /help
+    """
+    await bot.reply_to(message, "Пришлите мне изображение, и я предложу вам варианты!")
+
+
+async def handle_photo(message):
+    """
+    Обработчик получения изображения.
+    Фотографии альбома собираются вместе, и бот отвечает один раз на весь альбом.
+    """
+    if message.media_group_id:
+        if sync_bot.album_buffer.add(message):
+            schedule_album_check(message.media_group_id, sync_bot.album_buffer.delay)
+        return
+    photo = message.photo[-1]
+    await run_store(sync_bot.user_states.set_photo, message.chat.id, photo.file_id, photo.file_unique_id,
+                    photo_sizes(message.photo))
+    await bot.reply_to(message, "У меня есть ваша фотография! Пожалуйста, введите набор символов для ASCII-арта "
+                                "(например, '@%#*+=-:. ').")
+
+
+async def handle_file(message):
+    """
+    Обработчик изображений, присланных файлом, анимацией GIF или стикером
+    """
+    media, file = file_media(message)
+    if media is None:
+        await bot.reply_to(message, UNSUPPORTED_FILE)
+    elif (file.file_size or 0) > MAX_FILE_SIZE:
+        await bot.reply_to(message, FILE_TOO_LARGE)
+    else:
+        await run_store(sync_bot.user_states.set_photo, message.chat.id, file.file_id, file.file_unique_id,
+                        media=media)
+        await bot.reply_to(message, FILE_RECEIVED)
+
+
+def schedule_album_check(media_group_id, delay):
+    """
+    Проверка через delay секунд, собран ли альбом
+    """
+    asyncio.get_running_loop().call_later(delay, lambda: start_task(finish_album(media_group_id)))
+
+
+async def finish_album(media_group_id):
+    """
+    Завершение сбора альбома: если фотографии еще приходят, проверка откладывается
+    """
+    remaining = sync_bot.album_buffer.due(media_group_id)
+    if remaining > 0:
+        schedule_album_check(media_group_id, remaining)
+        return
+    album = sync_bot.album_buffer.pop(media_group_id)
+    if album is not None:
+        chat_id, messages = album
+        await run_store(save_album, chat_id, messages)
+        await bot.reply_to(messages[0], ALBUM_RECEIVED.format(len(messages)))
+
+
+async def set_ascii_chars(message):
+    """
+    Обработчик ввода пользовательского набора символов
+    """
+    await run_store(sync_bot.user_states.update, message.chat.id, ascii_chars=message.text)
+    await bot.reply_to(message, "Спасибо! Теперь выберите, что бы Вы хотели сделать с изображением.",
+                       reply_markup=get_options_keyboard())
+
+
+async def callback_query(call):
+    """
+    Обработчик нажатия кнопок.
+    Ответ на нажатие отправляется сразу, обработка изображения выполняется в отдельной задаче.
+    """
+    with sync_bot.metrics.stage("dispatch", actions.button_label(call.data)):
+        await dispatch_callback(call)
+
+
+async def dispatch_callback(call):
+    """
+    Выбор действия по нажатой кнопке. Что делать по кнопке обработки изображения, решает модуль actions.
+    """
+    chat_id = call.message.chat.id
+    if actions.is_job_button(call.data):
+        state = await run_store(sync_bot.user_states.get, chat_id)
+        try:
+            job = actions.plan_job(state, call.data)
+        except actions.ActionRejected as rejected:
+            await bot.answer_callback_query(call.id, rejected.notice)
+            if rejected.message:
+                await bot.send_message(chat_id, rejected.message)
+            return
+        await bot.answer_callback_query(call.id, job.notice)
+        run_for_chat(chat_id, run_job(chat_id, job), job.name,
+                     job_key(chat_id, state, job.kind, job.operation, job.args))
+    elif call.data == "palettes":
+        await bot.answer_callback_query(call.id, "Выбор цветовой палитры...")
+        await bot.send_message(chat_id, "Выберите палитру:", reply_markup=get_palette_keyboard())
+    elif call.data == "chain":
+        await bot.answer_callback_query(call.id, "Составление цепочки преобразований...")
+        await bot.send_message(chat_id, "Выберите шаги по порядку и нажмите Run Chain. Изображение будет "
+                                        "обработано всеми шагами за один раз.", reply_markup=get_chain_keyboard())
+    elif call.data.startswith("chain_add:"):
+        state = await run_store(sync_bot.user_states.get, chat_id)
+        steps, notice = actions.add_chain_step(state, call.data.split(":", 1)[1])
+        if steps is not None:
+            await run_store(sync_bot.user_states.update, chat_id, chain=steps)
+        await bot.answer_callback_query(call.id, notice)
+    elif call.data == "chain_clear":
+        await run_store(sync_bot.user_states.update, chat_id, chain=None)
+        await bot.answer_callback_query(call.id, "Цепочка очищена")
+    elif call.data == "joke":
+        await bot.answer_callback_query(call.id, "Случайная шутка...")
+        await bot.send_message(chat_id, random.choice(JOKES))
+    elif call.data == "compliment":
+        await bot.answer_callback_query(call.id, "Случайный комплимент...")
+        await bot.send_message(chat_id, random.choice(COMPLIMENTS))
+    elif call.data == "flip_coin":
+        await bot.answer_callback_query(call.id, "Подбрасываем монетку...")
+        result = random.choice(["Орел", "Решка"])
+        await bot.send_message(chat_id, f"Монетка подброшена: {result}!")
+
+
+def run_for_chat(chat_id, coroutine, operation=None, key=None):
+    """
+    Запускает задание в отдельной задаче, сохраняя порядок заданий внутри одного чата.
+    operation: название операции для трассировки задания (модуль metrics)
+    key: ключ задания (bot.job_key); если такое задание уже выполняется, повторное нажатие отбрасывается
+    """
+    if key is not None and not sync_bot.in_flight.start(key):
+        coroutine.close()
+        return None
+
+    # Блокировка удаляется, когда завершается последнее задание чата: после release() блокировка свободна
+    # (locked() ложно), пока ее не захватит следующее ожидающее задание
+    entry = chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+
+    async def runner():
+        # Запросы задания к Bot API ждут токен чата и не отбрасываются (модуль dispatch)
+        with chat_queue(chat_id):
+            try:
+                async with entry[0]:
+                    with sync_bot.metrics.trace(operation, chat_id) if sync_bot.metrics.enabled else nullcontext():
+                        await coroutine
+            except sync_bot.JOB_ERRORS as error:
+                await bot.send_message(chat_id, sync_bot.job_error_message(error))
+            except Exception:
+                logger.exception("Ошибка при обработке задания для чата %s", chat_id)
+            finally:
+                if key is not None:
+                    sync_bot.in_flight.finish(key)
+                entry[1] -= 1
+                if not entry[1]:
+                    del chat_locks[chat_id]
+
+    return start_task(runner())
+
+
+def start_task(coroutine):
+    """
+    Запуск фоновой задачи с сохранением ссылки на нее до завершения
+    """
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def run_cpu(func, *args):
+    """
+    Выполнение преобразования без блокировки цикла событий: в пуле процессов планировщика (bot.scheduler) или,
+    если пул выключен (WORKER_PROCESSES=0), в отдельном потоке. Результат из пула процессов ожидается через
+    asyncio.wrap_future, поток при этом не занят. Аварийно завершившийся пул планировщик заменяет сам.
+    """
+    if not sync_bot.scheduler.cpu_workers:
+        return await asyncio.to_thread(func, *args)
+    return await asyncio.wrap_future(sync_bot.scheduler.submit_cpu(func, *args))
+
+
+async def run_store(func, *args, **kwargs):
+    """
+    Вызов хранилища состояний или кэша в отдельном пуле потоков (store_executor): вызовы обработчиков не ждут
+    за заданиями обработки в пуле потоков asyncio по умолчанию
+    """
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(store_executor, call)
+
+
+async def load_photo(chat_id, operation=None):
+    """
+    Загрузка и декодирование фотографии пользователя через общий кэш загрузок.
+    Выбирается наименьший достаточный для операции вариант фотографии (модуль image_loader).
+    """
+    state = await run_store(sync_bot.user_states.get, chat_id)
+    return await load_selected(select_for_operation(state, operation), operation)
+
+
+async def load_selected(selected, operation=None):
+    """
+    Загрузка и декодирование выбранного варианта фотографии
+    selected: (file_id, file_unique_id, бюджет разрешения) - результат select_for_operation
+    """
+    file_id, file_unique_id, _ = selected
+    image_key, decode = image_decoder(selected, operation)
+    image = sync_bot.download_cache.get_image(image_key)
+    if image is not None:
+        return image
+
+    data = await fetch_file(file_id, file_unique_id, operation)
+    return await asyncio.to_thread(sync_bot.download_cache.fetch_image, image_key, lambda: data, decode)
+
+
+async def fetch_file(file_id, file_unique_id, operation=None):
+    """
+    Загрузка файла по file_id через общий кэш загрузок
+    """
+    data = await run_store(sync_bot.download_cache.get, file_unique_id)
+    if data is None:
+        with sync_bot.metrics.stage("download"):
+            file_info = await bot.get_file(file_id)
+            data = await bot.download_file(file_info.file_path)
+        record_download(data, operation)
+        await run_store(sync_bot.download_cache.put, file_unique_id, data)
+    return data
+
+
+async def render_animated(chat_id, operation, func, args=()):
+    """
+    Покадровая обработка анимации (модуль animation): пачки кадров обрабатываются параллельно в пуле процессов,
+    кадры читаются и результат кодируется в отдельном потоке (пул потоков asyncio по умолчанию), чтобы не
+    блокировать цикл событий
+    """
+    state = await run_store(sync_bot.user_states.get, chat_id)
+    file_id, file_unique_id, budget = select_for_operation(state, operation)
+    data = await fetch_file(file_id, file_unique_id, operation)
+    result, stages = await asyncio.to_thread(animation.render_animation, data, func, args, budget,
+                                             sync_bot.scheduler.imap_cpu)
+    record_encoding(stages, result)
+    return result
+
+
+async def run_job(chat_id, job):
+    """
+    Выполнение задания по нажатой кнопке (actions.plan_job)
+    """
+    if job.kind == "album":
+        await album_and_send(chat_id, job)
+    elif job.kind == "ascii":
+        await ascii_and_send(chat_id)
+    else:
+        await transform_and_send(chat_id, job)
+
+
+async def send_image_result(chat_id, key, render, profile="photo", file_name="image"):
+    """
+    Отправка обработанного изображения с использованием кэша результатов, как bot.send_image_result.
+    render: сопрограмма-функция, которая обрабатывает изображение и возвращает байты результата
+    """
+    method, options = actions.send_method(profile, file_name)
+
+    async def send(content):
+        with sync_bot.metrics.stage("upload"):
+            return actions.sent_file_id(await getattr(bot, method)(chat_id, content, **options))
+
+    file_id = await run_store(sync_bot.result_cache.get, key)
+    if file_id is not None:
+        try:
+            await send(file_id)
+            return
+        except ApiTelegramException:
+            await run_store(sync_bot.result_cache.delete, key)
+
+    file_id = await send(actions.result_file(await render(), profile, file_name))
+    await run_store(sync_bot.result_cache.put, key, file_id)
+
+
+async def transform_and_send(chat_id, job):
+    """
+    Применение преобразования к изображению пользователя и отправка результата, как bot.transform_and_send.
+    GIF обрабатывается покадрово и отправляется анимацией.
+    """
+    key = await run_store(result_key, chat_id, job.operation, *job.args)
+
+    async def render():
+        if job.profile == "animation":
+            return await render_animated(chat_id, job.operation, job.func, job.args)
+        image = await load_photo(chat_id, job.operation)
+        result, stages, baseline = await run_cpu(apply_and_encode_timed, job.func, image, job.args, job.profile)
+        record_encoding(stages, result, baseline)
+        return result
+
+    await send_image_result(chat_id, key, render, job.profile, job.operation)
+
+
+async def ascii_and_send(chat_id):
+    """
+    Преобразование изображения в ASCII-арт и отправка (длинный ASCII-арт - несколькими сообщениями)
+    """
+    state = await run_store(sync_bot.user_states.get, chat_id)
+    args = actions.ascii_args(state)
+    key = await run_store(result_key, chat_id, "ascii", *args)
+    ascii_art = await run_store(sync_bot.result_cache.get, key)
+    if ascii_art is None:
+        image = await load_photo(chat_id, "ascii")
+        with sync_bot.metrics.stage("transform"):
+            ascii_art = await run_cpu(image_to_ascii, image, *args)
+        await run_store(sync_bot.result_cache.put, key, ascii_art)
+    with sync_bot.metrics.stage("upload"):
+        for text in actions.ascii_messages(ascii_art):
+            await bot.send_message(chat_id, text, parse_mode="MarkdownV2")
+
+
+async def album_and_send(chat_id, job):
+    """
+    Обработка всех фотографий альбома и отправка результатов одним вызовом send_media_group.
+    Фотографии загружаются одновременно, обрабатываются параллельно в пуле процессов.
+    """
+    selected, keys, contents, missing = await run_store(album_selection, chat_id, job)
+    if missing:
+        images = await asyncio.gather(*[load_selected(selected[index], job.operation) for index in missing])
+        results = await asyncio.gather(*[run_cpu(apply_and_encode_timed, job.func, image, job.args, job.profile)
+                                         for image in images])
+        for index, (data, stages, baseline) in zip(missing, results):
+            record_encoding(stages, data, baseline)
+            contents[index] = actions.result_file(data, job.profile, f"image{index + 1}")
+
+    media_type = types.InputMediaDocument if encoding.is_document(job.profile) else types.InputMediaPhoto
+    try:
+        with sync_bot.metrics.stage("upload"):
+            sent = await bot.send_media_group(chat_id, [media_type(content) for content in contents])
+    except ApiTelegramException:
+        if len(missing) == len(keys):
+            raise
+        # Сохраненные file_id больше не принимаются - обрабатываем все фотографии заново
+        for key in keys:
+            await run_store(sync_bot.result_cache.delete, key)
+        await album_and_send(chat_id, job)
+        return
+    for index in missing:
+        await run_store(sync_bot.result_cache.put, keys[index], actions.sent_file_id(sent[index]))
+
+
+def create_webhook_app(path, secret=None):
+    """
+    Веб-приложение aiohttp для приема обновлений от Telegram.
+    Обновление передается боту в отдельной задаче, а Telegram сразу получает ответ 200.
+    """
+    async def handle_update(request):
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=403)
+        update = types.Update.de_json(await request.text())
+        start_task(bot.process_new_updates([update]))
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def run_webhook(host, port, webhook_url=None, secret=None):
+    """
+    Запуск локального веб-сервера для приема обновлений.
+    Если указан webhook_url, адрес регистрируется в Telegram через setWebhook.
+    """
+    path = f'/webhook/{sync_bot.TOKEN.split(":")[0]}'
+    runner = web.AppRunner(create_webhook_app(path, secret))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    if webhook_url:
+        await bot.set_webhook(url=webhook_url.rstrip('/') + path, secret_token=secret)
+    logger.info("Прием обновлений на http://%s:%s%s", host, port, path)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await asyncio_helper.session_manager.session.close()
+
+
+def create_app(token=None, handlers=True):
+    """
+    Фабрика приложения: создает общие объекты синхронного бота (bot.create_components) и бота AsyncTeleBot.
+    token: токен бота (по умолчанию - TELEGRAM_BOT_TOKEN)
+    handlers: регистрировать ли обработчики сообщений и нажатий кнопок
+    Повторный вызов возвращает уже созданного бота.
+    """
+    global bot, store_executor
+    if bot is not None:
+        return bot
+    sync_bot.create_components()
+    store_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ASYNC_STORE_THREADS', 4)),
+                                        thread_name_prefix='async-store')
+    # Адрес Bot API можно заменить, например, на локальный тестовый сервер
+    sync_bot.configure_api(asyncio_helper)
+    # Ограничение пула соединений aiohttp: соединения переиспользуются между запросами
+    asyncio_helper.REQUEST_LIMIT = int(os.getenv('TELEGRAM_MAX_CONNECTIONS', 100))
+    # Ограничение частоты отправки и повтор после ответа 429, как в синхронном боте (модуль dispatch)
+    dispatch.install_async(sync_bot.rate_limiter, asyncio_helper)
+    token = token or sync_bot.TOKEN or ''
+    bot = AsyncTeleBot(token, validate_token=bool(token))
+    if handlers:
+        register_handlers()
+    return bot
+
+
+async def is_awaiting_charset(message):
+    """
+    Фильтр обработчика set_ascii_chars: ждет ли бот набор символов от этого чата
+    """
+    return await run_store(sync_bot.user_states.is_awaiting_charset, message.chat.id)
+
+
+def register_handlers():
+    """
+    Регистрация обработчиков бота в том же порядке, что и в синхронном боте
+    """
+    bot.register_message_handler(send_welcome, commands=['start', 'help'])
+    bot.register_message_handler(handle_photo, content_types=['photo'])
+    bot.register_message_handler(handle_file, content_types=['document', 'animation', 'sticker', 'video_note'])
+    bot.register_message_handler(set_ascii_chars, func=is_awaiting_charset)
+    bot.register_callback_query_handler(callback_query, func=lambda call: True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Асинхронный режим телеграм-бота")
+    parser.add_argument('--webhook', action='store_true', help="принимать обновления через веб-сервер")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--webhook-url', default=os.getenv('WEBHOOK_URL'),
+                        help="внешний адрес для регистрации в Telegram")
+    args = parser.parse_args()
+
+    create_app()
+    if not sync_bot.TOKEN:
+        raise SystemExit("Не задан токен бота: переменная окружения TELEGRAM_BOT_TOKEN или файл .env")
+    logging.basicConfig(level=logging.INFO)
+    if os.getenv('METRICS_PORT'):
+        sync_bot.metrics.serve(os.getenv('METRICS_HOST', '127.0.0.1'), int(os.environ['METRICS_PORT']))
+    try:
+        if args.webhook:
+            # Без внешнего адреса (например, при локальной проверке) секрет необязателен
+            secret = os.getenv('WEBHOOK_SECRET') or (secrets.token_urlsafe(32) if args.webhook_url else None)
+            asyncio.run(run_webhook(args.host, args.port, args.webhook_url, secret))
+        else:
+            asyncio.run(bot.infinity_polling())
+    finally:
+        # Записываем накопленные изменения состояний, как в синхронном боте (bot.main)
+        store_executor.shutdown(wait=True)
+        sync_bot.user_states.close()
+        sync_bot.result_cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Сравнение скорости построения ASCII-арта: исходная реализация (посимвольное сложение строк)
+и модуль ascii_art (таблица из 256 элементов + translate + join).
+
+Запуск из корня проекта:
+    python benchmarks/bench_ascii.py
+"""
+import os
+import sys
+import timeit
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ascii_art  # noqa: E402
+
+ASCII_CHARS = '@%#*+=-:. '
+CUSTOM_CHARS = '█▓▒░ '
+
+
+def legacy_pixels_to_ascii(image, ascii_chars):
+    """
+    Исходная реализация pixels_to_ascii
+    """
+    pixels = image.getdata()
+    characters = ""
+    for pixel in pixels:
+        characters += ascii_chars[pixel * len(ascii_chars) // 256]
+    return characters
+
+
+def legacy_image_to_ascii(image, new_width, ascii_chars):
+    """
+    Исходная реализация image_to_ascii (без ограничения на количество строк)
+    """
+    image = image.convert('L')
+    width, height = image.size
+    new_height = int(height / float(width) * new_width * 0.55)
+    img_resized = image.resize((new_width, new_height))
+    img_str = legacy_pixels_to_ascii(img_resized, ascii_chars)
+    ascii_text = ""
+    for i in range(0, len(img_str), new_width):
+        ascii_text += img_str[i:i + new_width] + "\n"
+    return ascii_text
+
+
+def engine_image_to_ascii(image, new_width, ascii_chars):
+    rows = ascii_art.render_ascii_rows(image, new_width, ascii_chars)
+    return "\n".join(rows) + "\n"
+
+
+def make_image(size):
+    """
+    Тестовое изображение с плавным градиентом и шумом
+    """
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 64)
+    return Image.blend(gradient, noise, 0.3).convert('RGB')
+
+
+def bench(func, *args, number):
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=3)) / number
+
+
+def main():
+    image = make_image((1280, 960))
+    print(f"{'width':>6} {'charset':>8} {'legacy, ms':>11} {'engine, ms':>11} {'speedup':>8}")
+    for charset_name, charset in (('ascii', ASCII_CHARS), ('unicode', CUSTOM_CHARS)):
+        for width in (40, 120, 300):
+            assert legacy_image_to_ascii(image, width, charset) == engine_image_to_ascii(image, width, charset)
+            number = 20 if width < 300 else 5
+            legacy = bench(legacy_image_to_ascii, image, width, charset, number=number)
+            engine = bench(engine_image_to_ascii, image, width, charset, number=number)
+            print(f"{width:>6} {charset_name:>8} {legacy * 1000:>11.2f} {engine * 1000:>11.2f} "
+                  f"{legacy / engine:>7.1f}x")
+
+    # Отдельно сравниваем только перевод пикселей в символы (без изменения размера)
+    gray = make_image((1000, 550)).convert('L')
+    legacy = bench(legacy_pixels_to_ascii, gray, ASCII_CHARS, number=3)
+    engine = bench(ascii_art.pixels_to_ascii, gray, ASCII_CHARS, number=3)
+    print(f"pixels_to_ascii 1000x550: legacy {legacy * 1000:.2f} ms, engine {engine * 1000:.2f} ms, "
+          f"{legacy / engine:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Сравнение кодирования результатов по профилям (модуль encoding) с прежним способом сохранения.
+
+Для каждой операции (pixelate, invert, heatmap, sticker) и каждого размера изображения результат обработки
+сохраняется прежним способом (JPEG или PNG с настройками по умолчанию) и по профилю операции. Выводятся размер
+файла, время кодирования (медиана) и доля сэкономленных байтов; результат в формате JSON печатается последней
+строкой (или записывается в файл --output) для отслеживания регрессий.
+
+Запуск из корня проекта:
+    python benchmarks/bench_encoding.py [--sizes 1280x960,2560x1920] [--repeat 5] [--output encoding.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from PIL import Image, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import encoding  # noqa: E402
+from image_processing import (convert_to_heatmap, encode_image, invert_colors, pixelate_image,  # noqa: E402
+                              resize_for_sticker)
+
+DEFAULT_SIZES = "640x480,1280x960,2560x1920"
+
+# Операция -> (функция обработки, прежний формат, профиль кодирования)
+OPERATIONS = {
+    "pixelate": (lambda image: pixelate_image(image, 20), "JPEG", "pixel_art"),
+    "invert": (invert_colors, "JPEG", "photo"),
+    "heatmap": (convert_to_heatmap, "JPEG", "photo"),
+    "sticker": (resize_for_sticker, "PNG", "sticker"),
+}
+
+
+def make_image(width, height):
+    """
+    Тестовое изображение, похожее на фотографию: плавные переходы, контуры и немного шума
+    (чистый шум не сжимается ни одним способом, и сравнение теряет смысл)
+    """
+    base = Image.effect_mandelbrot((width, height), (-2.0, -1.2, 0.8, 1.2), 60).filter(ImageFilter.GaussianBlur(2))
+    channels = [base, Image.linear_gradient('L').resize((width, height)),
+                Image.radial_gradient('L').resize((width, height))]
+    noise = Image.effect_noise((width, height), 12)
+    return Image.merge('RGB', [Image.blend(channel, noise, 0.1) for channel in channels])
+
+
+def measure(func, repeat):
+    """
+    Медиана времени вызова func() в миллисекундах и результат последнего вызова
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        data = func()
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times), data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="размеры изображений через запятую")
+    parser.add_argument('--operations', default=','.join(OPERATIONS), help="операции через запятую")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="файл для результата в формате JSON")
+    args = parser.parse_args()
+
+    sizes = [tuple(int(value) for value in size.split('x')) for size in args.sizes.split(',')]
+    results = {}
+    print(f"{'operation':>10} {'size':>10} {'old, KB':>9} {'new, KB':>9} {'saved':>7} {'old, ms':>9} {'new, ms':>9}")
+    for width, height in sizes:
+        image = make_image(width, height)
+        size = f"{width}x{height}"
+        for name in args.operations.split(','):
+            func, old_format, profile = OPERATIONS[name]
+            result = func(image)
+            old_ms, old = measure(lambda: encode_image(result, old_format), args.repeat)
+            new_ms, new = measure(lambda: encoding.encode(result, profile), args.repeat)
+            row = {"profile": profile, "old_bytes": len(old), "new_bytes": len(new),
+                   "saved_ratio": 1 - len(new) / len(old), "old_ms": old_ms, "new_ms": new_ms}
+            results.setdefault(name, {})[size] = row
+            print(f"{name:>10} {size:>10} {len(old) / 1024:>9.1f} {len(new) / 1024:>9.1f} "
+                  f"{row['saved_ratio']:>7.1%} {old_ms:>9.2f} {new_ms:>9.2f}")
+
+    report = {"benchmark": "encoding", "python": platform.python_version(),
+              "pillow": Image.__version__, "repeat": args.repeat, "results": results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Микробенчмарки функций обработки изображений (модуль image_processing).
+
+Каждая функция (resize_image, pixels_to_ascii, pixelate_image, invert_colors, mirror_image,
+convert_to_heatmap, resize_for_sticker) измеряется на наборе изображений разного размера. Для каждой пары
+(функция, размер) выводятся медиана, p95 и лучшее время; результат в формате JSON печатается последней
+строкой (или записывается в файл --output) для отслеживания регрессий.
+
+Запуск из корня проекта:
+    python benchmarks/bench_images.py [--sizes 320x240,1280x960,2560x1920] [--repeat 20] [--output bench.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_processing import (ASCII_CHARS, convert_to_heatmap, grayify, invert_colors, mirror_image,  # noqa: E402
+                              pixelate_image, pixels_to_ascii, resize_for_sticker, resize_image)
+
+DEFAULT_SIZES = "320x240,1280x960,2560x1920,4000x3000"
+
+
+def ascii_input(image):
+    """
+    pixels_to_ascii получает уменьшенное изображение в оттенках серого, как в image_to_ascii
+    """
+    return grayify(resize_image(image, 40))
+
+
+# Функция -> (подготовка входного изображения, вызов)
+FUNCTIONS = {
+    "resize_image": (None, lambda image: resize_image(image, 100)),
+    "pixels_to_ascii": (ascii_input, lambda image: pixels_to_ascii(image, ASCII_CHARS)),
+    "pixelate_image": (None, lambda image: pixelate_image(image, 20)),
+    "invert_colors": (None, invert_colors),
+    "mirror_image": (None, lambda image: mirror_image(image, "horizontal")),
+    "convert_to_heatmap": (None, convert_to_heatmap),
+    "resize_for_sticker": (None, resize_for_sticker),
+}
+
+
+def make_image(width, height):
+    """
+    Тестовое изображение: шум в каждом канале (не сжимается и не вырождается, как однотонная заливка)
+    """
+    return Image.merge('RGB', [Image.effect_noise((width, height), sigma).convert('L') for sigma in (30, 60, 90)])
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(func, image, repeat):
+    """
+    Время вызова func(image) в миллисекундах: медиана, p95 и лучшее из repeat запусков
+    """
+    func(image)  # прогрев
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(image)
+        times.append((time.perf_counter() - started) * 1000)
+    return {"median_ms": statistics.median(times), "p95_ms": percentile(times, 0.95), "min_ms": min(times)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="размеры изображений через запятую")
+    parser.add_argument('--functions', default=','.join(FUNCTIONS), help="функции через запятую")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help="файл для результата в формате JSON")
+    args = parser.parse_args()
+
+    sizes = [tuple(int(value) for value in size.split('x')) for size in args.sizes.split(',')]
+    names = args.functions.split(',')
+    results = {}
+    print(f"{'function':>20} {'size':>10} {'median, ms':>11} {'p95, ms':>9} {'min, ms':>9}")
+    for width, height in sizes:
+        image = make_image(width, height)
+        size = f"{width}x{height}"
+        for name in names:
+            prepare, func = FUNCTIONS[name]
+            row = measure(func, prepare(image) if prepare else image, args.repeat)
+            results.setdefault(name, {})[size] = row
+            print(f"{name:>20} {size:>10} {row['median_ms']:>11.2f} {row['p95_ms']:>9.2f} "
+                  f"{row['min_ms']:>9.2f}")
+
+    report = {"benchmark": "images", "python": platform.python_version(),
+              "pillow": Image.__version__, "repeat": args.repeat, "results": results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Время холодного запуска: импорт модулей бота и создание приложения (bot.create_app).
+
+Каждый сценарий выполняется в новом процессе интерпретатора (--repeat раз, выводится медиана):
+- image_processing: импорт функций обработки изображений без бота;
+- bot: импорт модуля bot без токена (telebot, dotenv, планировщик и кэши не загружаются);
+- create_app: создание общих объектов и бота TeleBot с обработчиками, как при запуске процесса-обработчика;
+- first_image: create_app, затем декодирование фотографии и кодирование стикера WebP - загрузка модулей Pillow
+при первом использовании;
+- async_app: создание асинхронного бота (модуль async_bot, нужна библиотека aiohttp).
+
+Для каждого сценария выводятся время внутри процесса (import_ms), время всего процесса вместе с запуском
+интерпретатора (process_ms), количество загруженных модулей и модулей форматов Pillow. С --top N дополнительно
+печатаются N пакетов, импорт которых в сценарии create_app занимает больше всего времени (python -X importtime).
+С --max-ms код завершения - 1, если медиана import_ms сценария create_app больше заданной: так проверка может
+работать в CI. Результат в формате JSON печатается последней строкой (или записывается в файл --output).
+
+Запуск из корня проекта:
+    python benchmarks/bench_import.py [--repeat 5] [--top 10] [--max-ms 300] [--output import.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Сценарий -> код, время выполнения которого измеряется (PHOTO - путь к тестовой фотографии)
+SCENARIOS = {
+    "image_processing": "import image_processing",
+    "bot": "import bot",
+    "create_app": "import bot\nbot.create_app()",
+    "first_image": ("import bot\nbot.create_app()\n"
+                    "from image_loader import decode_image\n"
+                    "from image_processing import apply_and_encode_timed, resize_for_sticker\n"
+                    "image = decode_image(open(PHOTO, 'rb').read())\n"
+                    "apply_and_encode_timed(resize_for_sticker, image, (512,), 'sticker')"),
+    "async_app": "import async_bot\nasync_bot.create_app()",
+}
+
+# Код дочернего процесса: замер сценария и печать показателей одной строкой JSON
+CHILD = """
+import sys, time
+sys.path.insert(0, {root!r})
+PHOTO = {photo!r}
+started = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - started
+import json
+print(json.dumps({{"import_ms": elapsed * 1000, "modules": len(sys.modules), "telebot": "telebot" in sys.modules,
+                  "pil_plugins": sum(name.endswith("ImagePlugin") for name in sys.modules)}}))
+"""
+
+
+def child_env():
+    """
+    Окружение дочерних процессов: без метрик, файлов SQLite и дискового кэша
+    """
+    env = dict(os.environ, STATE_BACKEND='memory')
+    for name in ('METRICS_PORT', 'METRICS_LOG', 'RESULT_CACHE_PATH', 'DOWNLOAD_CACHE_DIR'):
+        env.pop(name, None)
+    return env
+
+
+def run_scenario(code, photo, env, importtime=False):
+    """
+    Один запуск сценария в новом процессе. Возвращает (показатели, время процесса в мс, вывод -X importtime).
+    """
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else [])
+    command += ['-c', CHILD.format(root=ROOT, photo=photo, code=code)]
+    started = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True, env=env, cwd=tempfile.gettempdir())
+    elapsed = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    return json.loads(result.stdout.strip().splitlines()[-1]), elapsed, result.stderr
+
+
+def heaviest_packages(importtime_output, top):
+    """
+    Пакеты верхнего уровня с наибольшим суммарным собственным временем импорта (мс)
+    """
+    totals = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(self_us) / 1000
+    return dict(sorted(totals.items(), key=lambda item: -item[1])[:top])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="сценарии через запятую")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=0, help="показать N самых долгих импортов сценария create_app")
+    parser.add_argument('--max-ms', type=float, help="допустимая медиана import_ms сценария create_app")
+    parser.add_argument('--output', help="файл для результата в формате JSON")
+    args = parser.parse_args()
+
+    from PIL import Image
+    photo = Image.merge('RGB', [Image.effect_noise((1280, 960), sigma).convert('L') for sigma in (30, 60, 90)])
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as file:
+        photo.save(file, format='JPEG', quality=90)
+        path = file.name
+
+    env = child_env()
+    results = {}
+    try:
+        print(f"{'scenario':>16} {'import, ms':>11} {'process, ms':>12} {'modules':>8} {'PIL plugins':>12}")
+        for name in args.scenarios.split(','):
+            runs = []
+            try:
+                for _ in range(args.repeat):
+                    runs.append(run_scenario(SCENARIOS[name], path, env))
+            except RuntimeError as error:
+                results[name] = {"error": str(error)}
+                print(f"{name:>16} error: {error}")
+                continue
+            stats, _, _ = runs[-1]
+            row = {"import_ms": statistics.median(run[0]["import_ms"] for run in runs),
+                   "process_ms": statistics.median(run[1] for run in runs),
+                   "modules": stats["modules"], "telebot": stats["telebot"], "pil_plugins": stats["pil_plugins"]}
+            results[name] = row
+            print(f"{name:>16} {row['import_ms']:>11.1f} {row['process_ms']:>12.1f} {row['modules']:>8} "
+                  f"{row['pil_plugins']:>12}")
+
+        report = {"benchmark": "import", "python": platform.python_version(), "repeat": args.repeat,
+                  "scenarios": results}
+        if args.top:
+            _, _, output = run_scenario(SCENARIOS["create_app"], path, env, importtime=True)
+            report["heaviest_packages_ms"] = heaviest_packages(output, args.top)
+            for package, ms in report["heaviest_packages_ms"].items():
+                print(f"{package:>24} {ms:>8.1f} ms")
+    finally:
+        os.remove(path)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report))
+    create_app = results.get("create_app", {})
+    if args.max_ms is not None and create_app.get("import_ms", float('inf')) > args.max_ms:
+        print(f"create_app: {create_app.get('import_ms')} ms > {args.max_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Сравнение полного декодирования фотографии и загрузки с учетом бюджета разрешения (модуль image_loader).
+
+Для каждой операции (ASCII-арт, пикселизация, тепловая карта, стикер) измеряются время декодирования вместе
+с обработкой и пиковое потребление памяти (RSS). Каждый вариант запускается в отдельном процессе; после импорта
+модулей и чтения файла пиковый RSS процесса сбрасывается (модуль process_memory), поэтому rss_delta_kb - память
+самого декодирования и обработки, а не импорта Pillow и numpy (ru_maxrss после импорта бывает больше нее).
+
+Запуск из корня проекта:
+    python benchmarks/bench_loader.py [--size 2560x1920]
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from process_memory import peak_rss_kb, reset_peak_rss, rss_kb  # noqa: E402
+
+OPERATIONS = ("ascii", "pixelate", "heatmap", "sticker")
+
+
+def run_operation(operation, image):
+    from image_processing import convert_to_heatmap, image_to_ascii, pixelate_image, resize_for_sticker
+    if operation == "ascii":
+        return image_to_ascii(image)
+    if operation == "pixelate":
+        return pixelate_image(image, 20)
+    if operation == "heatmap":
+        return convert_to_heatmap(image)
+    return resize_for_sticker(image)
+
+
+def child(path, operation, variant, repeat):
+    """
+    Замер в дочернем процессе: время одного прохода (лучшее из repeat) и пиковый RSS
+    """
+    from PIL import Image
+    import image_processing  # noqa: F401 - импорт до замера, run_operation импортирует его при первом вызове
+    from image_loader import DECODE_MODES, RESOLUTION_BUDGETS, decode_image
+
+    with open(path, 'rb') as file:
+        data = file.read()
+    gc.collect()
+    if reset_peak_rss():
+        baseline_rss = rss_kb('self')
+    else:
+        # Без /proc/self/clear_refs остается ru_maxrss: пик с запуска процесса, включая импорт модулей
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        if variant == "full":
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        else:
+            image = decode_image(data, RESOLUTION_BUDGETS[operation], DECODE_MODES.get(operation))
+        run_operation(operation, image)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    peak_rss = peak_rss_kb() or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"ms": best * 1000, "rss_kb": peak_rss, "rss_delta_kb": peak_rss - baseline_rss}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', default='2560x1920', help="размер тестовой фотографии")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--child', nargs=3, metavar=('PATH', 'OPERATION', 'VARIANT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child, repeat=args.repeat)
+        return
+
+    from PIL import Image
+    width, height = (int(value) for value in args.size.split('x'))
+    photo = Image.merge('RGB', [Image.effect_noise((width, height), sigma).convert('L') for sigma in (30, 60, 90)])
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as file:
+        photo.save(file, format='JPEG', quality=90)
+        path = file.name
+
+    results = {}
+    try:
+        print(f"{'operation':>10} {'full, ms':>9} {'budget, ms':>11} {'full +RSS, MB':>14} {'budget +RSS, MB':>16}")
+        for operation in OPERATIONS:
+            row = {}
+            for variant in ("full", "budget"):
+                output = subprocess.run([sys.executable, __file__, '--repeat', str(args.repeat),
+                                         '--child', path, operation, variant],
+                                        check=True, capture_output=True, text=True).stdout
+                row[variant] = json.loads(output)
+            results[operation] = row
+            print(f"{operation:>10} {row['full']['ms']:>9.1f} {row['budget']['ms']:>11.1f} "
+                  f"{row['full']['rss_delta_kb'] / 1024:>14.1f} {row['budget']['rss_delta_kb'] / 1024:>16.1f}")
+    finally:
+        os.remove(path)
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
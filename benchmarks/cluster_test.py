@@ -0,0 +1,180 @@
+"""
+Проверка запуска бота в несколько процессов (модуль cluster) с локальной заглушкой Telegram Bot API.
+
+Кластер запускается отдельным процессом (python cluster.py) с очередью и состояниями в SQLite во временном
+каталоге. Сценарий:
+- каждый чат присылает сразу, не дожидаясь ответов, фотографию, набор символов и нажатия кнопок: ответы
+в каждом чате должны прийти в том же порядке (иначе, например, кнопка опередит фотографию, и бот ответит,
+что фотографии нет);
+- следующая серия нажатий отправляется, и сразу после того как кластер ее получил, он останавливается сигналом
+SIGTERM: все нажатия должны быть обработаны до завершения (drain), а код завершения - 0;
+- кластер запускается снова с другим количеством обработчиков, и чаты нажимают кнопки без новой фотографии:
+состояние чатов должно сохраниться.
+
+Результат в формате JSON печатается последней строкой; при ошибках код завершения - 1.
+
+Запуск из корня проекта:
+    python benchmarks/cluster_test.py [--chats 8] [--workers 2] [--restart-workers 3]
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from load_test import register_photos  # noqa: E402
+from work_queue import SQLiteWorkQueue  # noqa: E402
+
+# Метод ответа бота на каждое действие
+REPLIES = {"photo": "sendMessage", "charset": "sendMessage", "ascii": "sendMessage", "sticker": "sendDocument",
+           "pixelate": "sendPhoto", "invert": "sendPhoto", "mirror_horizontal": "sendPhoto", "heatmap": "sendPhoto"}
+
+
+class Chat:
+    """
+    Чат теста: отправляет действия без ожидания ответов и запоминает ожидаемую последовательность ответов
+    """
+
+    def __init__(self, api, chat_id):
+        self.api = api
+        self.chat_id = chat_id
+        self.chat = {'id': chat_id, 'type': 'private'}
+        self.user = {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"}
+        self.expected = []
+        self._message_ids = iter(range(1, 1000))
+
+    def send(self, action, photo=None):
+        """
+        Отправляет действие. Возвращает номер обновления.
+        """
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': self.chat,
+                   'from': self.user}
+        if action == "photo":
+            update = {'message': dict(message, photo=photo)}
+        elif action == "charset":
+            update = {'message': dict(message, text='@%#*+=-:. ')}
+        else:
+            update = {'callback_query': {'id': f"{self.chat_id}:{message['message_id']}", 'from': self.user,
+                                         'chat_instance': str(self.chat_id), 'data': action, 'message': message}}
+        self.expected.append(REPLIES[action])
+        self.api.push_update(update)
+        return self.api.last_update_id
+
+    def check(self, timeout):
+        """
+        Ошибка (строка) или None, если все ответы пришли в ожидаемом порядке
+        """
+        try:
+            replies = self.api.wait_replies(self.chat_id, len(self.expected), timeout)
+        except TimeoutError as error:
+            return str(error)
+        methods = [method for method, _ in replies]
+        if methods != self.expected:
+            return f"chat {self.chat_id}: expected {self.expected}, got {methods}"
+        return None
+
+
+def wait_queued(path, update_id, timeout):
+    """
+    Ждет, пока ingress положит в очередь обновление update_id
+    """
+    queue = SQLiteWorkQueue(path)
+    deadline = time.monotonic() + timeout
+    try:
+        while queue.last_update_id() < update_id:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"update {update_id} is not queued")
+            time.sleep(0.01)
+    finally:
+        queue.close()
+
+
+def start_cluster(api, workdir, workers):
+    env = dict(os.environ, TELEGRAM_API_URL=api.url, TELEGRAM_BOT_TOKEN='1:cluster-test',
+               WORK_QUEUE_PATH=os.path.join(workdir, 'work_queue.sqlite3'),
+               STATE_BACKEND='sqlite', STATE_DB_PATH=os.path.join(workdir, 'user_states.sqlite3'),
+               CLUSTER_POLL_TIMEOUT='1', WORKER_PROCESSES='0')
+    for name in ('DOWNLOAD_CACHE_DIR', 'RESULT_CACHE_PATH', 'METRICS_PORT', 'METRICS_LOG'):
+        env.pop(name, None)
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, 'cluster.py'), '--workers', str(workers)],
+                            cwd=workdir, env=env)
+
+
+def stop_cluster(process, timeout):
+    process.send_signal(signal.SIGTERM)
+    try:
+        return process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chats', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--restart-workers', type=int, default=3, help="обработчиков после перезапуска")
+    parser.add_argument('--size', default='640x480', help="размер самого большого варианта фотографии")
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    api = FakeBotAPI().start()
+    width, height = (int(value) for value in args.size.split('x'))
+    photos = register_photos(api, args.chats, width, height)
+    chats = [Chat(api, 2000 + index * 7) for index in range(args.chats)]
+    errors = []
+    phases = {}
+
+    def run_phase(name, actions):
+        started = time.perf_counter()
+        for chat, photo in zip(chats, photos):
+            for action in actions:
+                chat.send(action, photo)
+        errors.extend(error for error in (chat.check(args.timeout) for chat in chats) if error)
+        phases[name] = time.perf_counter() - started
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cluster = start_cluster(api, workdir, args.workers)
+        try:
+            run_phase("ordering", ["photo", "charset", "pixelate", "ascii", "invert", "sticker"])
+
+            # Остановка сразу после того, как обновления попали в очередь: все они должны быть обработаны
+            # до завершения
+            started = time.perf_counter()
+            for chat in chats:
+                for action in ("heatmap", "mirror_horizontal", "ascii"):
+                    update_id = chat.send(action)
+            wait_queued(os.path.join(workdir, 'work_queue.sqlite3'), update_id, args.timeout)
+            exitcode = stop_cluster(cluster, args.timeout)
+            if exitcode != 0:
+                errors.append(f"drain: exit code {exitcode}")
+            errors.extend(error for error in (chat.check(0) for chat in chats) if error)
+            phases["drain"] = time.perf_counter() - started
+
+            # Перезапуск с другим количеством обработчиков: фотографии и наборы символов чатов сохранились
+            cluster = start_cluster(api, workdir, args.restart_workers)
+            run_phase("restart", ["invert", "ascii"])
+        finally:
+            if cluster.poll() is None and stop_cluster(cluster, args.timeout) != 0:
+                errors.append("restart: cluster did not stop cleanly")
+    api.stop()
+
+    report = {"benchmark": "cluster", "config": {"chats": args.chats, "workers": args.workers,
+                                                 "restart_workers": args.restart_workers},
+              "phases_s": phases, "api_calls": dict(api.calls), "errors": errors}
+    for error in errors:
+        print("ERROR:", error)
+    print(json.dumps(report))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочного тестирования.
+
+Сервер отвечает на те методы, которые использует бот: getUpdates (длинный опрос очереди обновлений),
+getFile и загрузку файла, sendMessage, sendPhoto, sendDocument, sendAnimation, sendMediaGroup,
+answerCallbackQuery.
+Все остальные методы возвращают пустой успешный ответ. Отправленные ботом сообщения записываются, и тест может
+дождаться очередного ответа в нужном чате (wait_replies). flood_wait имитирует ответ 429 Too Many Requests.
+После вызова setWebhook обновления не ставятся в очередь getUpdates, а отправляются POST-запросом на
+зарегистрированный адрес с заголовком X-Telegram-Bot-Api-Secret-Token, как это делает Telegram.
+
+Бот подключается к заглушке через переменную окружения TELEGRAM_API_URL.
+"""
+import itertools
+import json
+import threading
+import time
+import urllib.request
+from email.parser import BytesParser
+from email.policy import default
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Методы, которые отправляют пользователю ответ
+REPLY_METHODS = ("sendMessage", "sendPhoto", "sendDocument", "sendAnimation", "sendMediaGroup")
+
+
+def form_fields(content_type, body):
+    """
+    Текстовые поля тела запроса (application/x-www-form-urlencoded или multipart/form-data); файлы пропускаются
+    """
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return {name: values[-1] for name, values in parse_qs(body.decode()).items()}
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=default).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        return {part.get_param('name', header='content-disposition'): part.get_content()
+                for part in message.iter_parts() if part.get_filename() is None}
+    return {}
+
+
+class FloodWait(Exception):
+    """
+    Ответ 429 Too Many Requests
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class FakeBotAPI:
+    """
+    Заглушка Bot API в отдельном потоке
+    host, port: адрес сервера (port=0 - любой свободный порт)
+    latency: искусственная задержка ответа на методы отправки в секундах (имитация сети)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.latency = latency
+        self.files = {}          # file_path -> содержимое файла
+        self.calls = defaultdict(int)
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._last_update_id = 0
+        self._flood = {}  # метод -> [сколько еще ответить 429, retry_after]
+        self._file_ids = itertools.count(1)
+        self._replies = defaultdict(list)  # chat_id -> [(метод, время ответа)]
+        self._webhook = None  # (адрес, секрет) после вызова setWebhook
+        self._condition = threading.Condition()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_file(self, file_path, content):
+        self.files[file_path] = content
+
+    def push_update(self, update):
+        """
+        Добавляет обновление в очередь getUpdates или, если зарегистрирован webhook, отправляет его боту.
+        Возвращает время добавления.
+        """
+        with self._condition:
+            update = dict(update, update_id=next(self._update_ids))
+            self._last_update_id = update['update_id']
+            webhook = self._webhook
+            if webhook is None:
+                self._updates.append(update)
+                self._condition.notify_all()
+        pushed_at = time.perf_counter()
+        if webhook is not None:
+            url, secret = webhook
+            headers = {'Content-Type': 'application/json'}
+            if secret:
+                headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+            request = urllib.request.Request(url, json.dumps(update).encode(), headers)
+            with urllib.request.urlopen(request, timeout=10):
+                pass
+        return pushed_at
+
+    @property
+    def webhook(self):
+        """
+        Адрес, зарегистрированный вызовом setWebhook, или None
+        """
+        with self._condition:
+            return self._webhook and self._webhook[0]
+
+    @property
+    def last_update_id(self):
+        with self._condition:
+            return self._last_update_id
+
+    def flood_wait(self, method, count=1, retry_after=1):
+        """
+        Следующие count вызовов метода получат ответ 429 Too Many Requests с заданным retry_after
+        """
+        with self._condition:
+            self._flood[method] = [count, retry_after]
+
+    def reply_count(self, chat_id):
+        with self._condition:
+            return len(self._replies[chat_id])
+
+    def wait_replies(self, chat_id, count, timeout=60):
+        """
+        Ждет, пока в чат будет отправлено count ответов. Возвращает список (метод, время ответа).
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while len(self._replies[chat_id]) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"chat {chat_id}: {len(self._replies[chat_id])} of {count} replies")
+                self._condition.wait(remaining)
+            return list(self._replies[chat_id])
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        timeout = float(params.get('timeout', 0))
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            # Подтвержденные ботом обновления удаляются из очереди
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return list(self._updates[:100])
+
+    def _reply(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = int(params['chat_id'])
+        if method == "sendMediaGroup":
+            # Альбом - один ответ, но несколько сообщений
+            result = [self._message(chat_id, "send" + media['type'].capitalize(), params)
+                      for media in json.loads(params['media'])]
+        else:
+            result = self._message(chat_id, method, params)
+        with self._condition:
+            self._replies[chat_id].append((method, time.perf_counter()))
+            self._condition.notify_all()
+        return result
+
+    def _message(self, chat_id, method, params):
+        message = {'message_id': next(self._file_ids), 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        file_id = f"result{message['message_id']}"
+        if method == "sendPhoto":
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1, 'height': 1}]
+        elif method == "sendDocument":
+            message['document'] = {'file_id': file_id, 'file_unique_id': file_id}
+        elif method == "sendAnimation":
+            message['animation'] = {'file_id': file_id, 'file_unique_id': file_id, 'width': 1, 'height': 1,
+                                    'duration': 1}
+            message['document'] = {'file_id': file_id, 'file_unique_id': file_id}
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+    def _call(self, method, params):
+        self.calls[method] += 1
+        with self._condition:
+            flood = self._flood.get(method)
+            if flood and flood[0] > 0:
+                flood[0] -= 1
+                raise FloodWait(flood[1])
+        if method == "getMe":
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method in ("setWebhook", "deleteWebhook"):
+            with self._condition:
+                self._webhook = (params['url'], params.get('secret_token')) if params.get('url') else None
+            return True
+        if method == "getFile":
+            file_id = params['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_path': file_id,
+                    'file_size': len(self.files.get(file_id, b''))}
+        if method in REPLY_METHODS:
+            return self._reply(method, params)
+        return True
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                parts = url.path.strip('/').split('/')
+                if parts[0] == 'file':
+                    content = api.files.get('/'.join(parts[2:]))
+                    if content is None:
+                        self._send(404, b'')
+                    else:
+                        self._send(200, content, 'application/octet-stream')
+                    return
+                # Синхронный telebot передает параметры в строке запроса, асинхронный - в теле запроса
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                params.update(form_fields(self.headers.get('Content-Type', ''), body))
+                try:
+                    result = {'ok': True, 'result': api._call(parts[-1], params)}
+                except FloodWait as error:
+                    result = {'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after "
+                              f"{error.retry_after}", 'parameters': {'retry_after': error.retry_after}}
+                except (KeyError, ValueError) as error:
+                    result = {'ok': False, 'error_code': 400, 'description': f"Bad Request: {error}"}
+                status = 200 if result['ok'] else result['error_code']
+                self._send(status, json.dumps(result).encode(), 'application/json')
+
+            def _send(self, status, body, content_type='text/plain'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
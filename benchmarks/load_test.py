@@ -0,0 +1,272 @@
+"""
+Нагрузочный тест бота с локальной заглушкой Telegram Bot API (модуль fake_bot_api).
+
+Бот (модуль bot) запускается в режиме опроса и подключается к заглушке через TELEGRAM_API_URL. С параметром
+--async запускается асинхронный бот (модуль async_bot): опросом или, с --webhook, с приемом обновлений через
+веб-сервер (заглушка доставляет их на адрес, зарегистрированный вызовом setWebhook). Сценарий и проверки для всех
+режимов одинаковые. Каждый из
+N параллельных чатов присылает фотографию (или альбом, --album), набор символов для ASCII-арта и затем
+по очереди нажимает кнопки операций, дожидаясь ответа на каждое действие. Задержка измеряется от появления
+обновления в очереди getUpdates до отправки ботом ответа в чат.
+
+Выводятся задержки p50/p95/p99 (всего и по операциям), пропускная способность и пиковое потребление памяти
+(RSS процесса бота и всех его потомков - forkserver и процессов пула, замеряется во время теста модулем
+process_memory). Результат в формате JSON печатается последней строкой
+(или записывается в файл --output) для отслеживания регрессий.
+
+Запуск из корня проекта:
+    python benchmarks/load_test.py [--chats 20] [--rounds 2] [--size 1280x960] [--output load.json]
+    python benchmarks/load_test.py --async [--webhook]
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from process_memory import MemorySampler  # noqa: E402
+
+DEFAULT_OPERATIONS = "pixelate,ascii,invert,mirror_horizontal,heatmap,sticker"
+
+# Варианты фотографии, которые Telegram присылает в message.photo (доли длинной стороны оригинала)
+PHOTO_SCALES = (0.25, 0.625, 1.0)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def summarize(latencies):
+    """
+    Задержки в миллисекундах: p50, p95, p99, максимум и количество
+    """
+    return {"count": len(latencies), "p50_ms": percentile(latencies, 0.5), "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99), "max_ms": max(latencies) if latencies else None}
+
+
+def register_photos(api, count, width, height):
+    """
+    Создает count разных фотографий в нескольких размерах и возвращает для каждой содержимое поля photo
+    """
+    photos = []
+    for index in range(count):
+        original = Image.effect_noise((width, height), 40 + index % 50).convert('RGB')
+        sizes = []
+        for scale in PHOTO_SCALES:
+            size = (max(1, int(width * scale)), max(1, int(height * scale)))
+            buffer = io.BytesIO()
+            original.resize(size).save(buffer, format='JPEG', quality=85)
+            file_id = f"photo{index}_{size[0]}"
+            api.add_file(file_id, buffer.getvalue())
+            sizes.append({'file_id': file_id, 'file_unique_id': file_id, 'width': size[0], 'height': size[1]})
+        photos.append(sizes)
+    return photos
+
+
+def run_chat(api, chat_id, photos, operations, rounds, latencies, errors):
+    """
+    Сценарий одного чата: фотография (или альбом, если фотографий несколько), набор символов, затем rounds раз
+    все операции по очереди. Каждое действие вызывает ровно один ответ бота (сообщение, фотографию, документ
+    или альбом).
+    """
+    chat = {'id': chat_id, 'type': 'private'}
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"}
+    messages = []
+    for index, photo in enumerate(photos):
+        message = {'message_id': index + 1, 'date': int(time.time()), 'chat': chat, 'from': user, 'photo': photo}
+        if len(photos) > 1:
+            message['media_group_id'] = f"album{chat_id}"
+        messages.append({'message': message})
+    actions = [("album" if len(photos) > 1 else "photo", messages),
+               ("charset", [{'message': {'message_id': len(photos) + 1, 'date': int(time.time()), 'chat': chat,
+                                         'from': user, 'text': '@%#*+=-:. '}}])]
+    for _ in range(rounds):
+        for operation in operations:
+            actions.append((operation, [{'callback_query': {
+                'id': f"{chat_id}:{operation}", 'from': user, 'chat_instance': str(chat_id), 'data': operation,
+                'message': {'message_id': len(photos) + 2, 'date': int(time.time()), 'chat': chat}}}]))
+
+    for name, updates in actions:
+        expected = api.reply_count(chat_id) + 1
+        for update in updates:
+            pushed_at = api.push_update(update)
+        try:
+            replies = api.wait_replies(chat_id, expected)
+        except TimeoutError:
+            errors.append(f"{name}: timeout in chat {chat_id}")
+            return
+        latencies.append((name, (replies[expected - 1][1] - pushed_at) * 1000))
+
+
+def start_sync_bot():
+    """
+    Синхронный бот (модуль bot) в режиме опроса в отдельном потоке. Возвращает функцию остановки.
+    """
+    import bot
+
+    polling = threading.Thread(target=bot.create_app().polling,
+                               kwargs={'none_stop': True, 'interval': 0, 'timeout': 1}, daemon=True)
+    polling.start()
+
+    def stop():
+        bot.bot.stop_polling()
+        polling.join(timeout=5)
+
+    return stop
+
+
+def start_async_bot(api, webhook=False):
+    """
+    Асинхронный бот (модуль async_bot) в отдельном потоке со своим циклом событий: опросом или через веб-сервер
+    (webhook=True; бот регистрирует адрес в заглушке вызовом setWebhook). Возвращает функцию остановки.
+    """
+    import async_bot
+
+    bot = async_bot.create_app()
+    loop = asyncio.new_event_loop()
+
+    async def serve():
+        try:
+            if webhook:
+                with socket.socket() as probe:
+                    probe.bind(('127.0.0.1', 0))
+                    port = probe.getsockname()[1]
+                await async_bot.run_webhook('127.0.0.1', port, f"http://127.0.0.1:{port}", 'load-test-secret')
+            else:
+                await bot.infinity_polling(timeout=1)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await asyncio.gather(*async_bot.background_tasks, return_exceptions=True)
+            session = async_bot.asyncio_helper.session_manager.session
+            if session is not None and not session.closed:
+                await session.close()
+
+    task = loop.create_task(serve())
+    thread = threading.Thread(target=loop.run_until_complete, args=(task,), daemon=True)
+    thread.start()
+    if webhook:
+        deadline = time.monotonic() + 10
+        while api.webhook is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def stop():
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join(timeout=10)
+        loop.close()
+
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chats', type=int, default=20, help="количество параллельных чатов")
+    parser.add_argument('--rounds', type=int, default=2, help="сколько раз каждый чат повторяет все операции")
+    parser.add_argument('--operations', default=DEFAULT_OPERATIONS, help="кнопки через запятую")
+    parser.add_argument('--photos', type=int, help="количество разных фотографий (по умолчанию - по числу чатов)")
+    parser.add_argument('--album', type=int, default=1, help="фотографий в альбоме каждого чата (1 - без альбома)")
+    parser.add_argument('--size', default='1280x960', help="размер самого большого варианта фотографии")
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа заглушки на отправку, с")
+    parser.add_argument('--async', dest='async_bot', action='store_true',
+                        help="асинхронный бот (модуль async_bot) вместо синхронного")
+    parser.add_argument('--webhook', action='store_true',
+                        help="асинхронный бот принимает обновления через веб-сервер, а не опросом")
+    parser.add_argument('--output', help="файл для результата в формате JSON")
+    args = parser.parse_args()
+    if args.webhook and not args.async_bot:
+        parser.error("--webhook работает только вместе с --async")
+    mode = ("async-webhook" if args.webhook else "async-polling") if args.async_bot else "sync"
+
+    api = FakeBotAPI(latency=args.latency).start()
+    width, height = (int(value) for value in args.size.split('x'))
+    photos = register_photos(api, args.photos or args.chats * args.album, width, height)
+
+    # Настройки бота задаются до его создания (bot.create_app); кэш загрузок не использует диск
+    os.environ['TELEGRAM_API_URL'] = api.url
+    os.environ['TELEGRAM_BOT_TOKEN'] = '1:load-test'
+    os.environ['STATE_BACKEND'] = 'memory'
+    # Тест измеряет обработку, а не ограничение частоты отправки в чат (модуль dispatch): по умолчанию оно выключено
+    os.environ.setdefault('DISPATCH_CHAT_RATE', '0')
+    os.environ.pop('DOWNLOAD_CACHE_DIR', None)
+    os.environ.pop('RESULT_CACHE_PATH', None)
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        import bot
+
+        stop = start_async_bot(api, args.webhook) if args.async_bot else start_sync_bot()
+        sampler = MemorySampler().start()
+
+        operations = args.operations.split(',')
+        latencies = []
+        errors = []
+        started = time.perf_counter()
+        chats = [threading.Thread(target=run_chat, args=(
+            api, 1000 + index, [photos[(index * args.album + item) % len(photos)] for item in range(args.album)],
+            operations, args.rounds, latencies, errors)) for index in range(args.chats)]
+        for chat in chats:
+            chat.start()
+        for chat in chats:
+            chat.join()
+        elapsed = time.perf_counter() - started
+        sampler.sample()
+        sampler.stop()
+        memory = sampler.peak()
+
+        stop()
+        scheduler_stats = bot.scheduler.stats()
+        bot.scheduler.shutdown()
+        bot.user_states.close()
+        bot.result_cache.close()
+        api.stop()
+
+    by_operation = {}
+    for name, latency in latencies:
+        by_operation.setdefault(name, []).append(latency)
+    report = {
+        "benchmark": "load",
+        "python": platform.python_version(),
+        "config": {"mode": mode, "chats": args.chats, "album": args.album, "rounds": args.rounds,
+                   "operations": operations, "size": args.size, "photos": len(photos), "latency_s": args.latency},
+        "elapsed_s": elapsed,
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / elapsed if elapsed else None,
+        "latency": summarize([latency for _, latency in latencies]),
+        "operations": {name: summarize(values) for name, values in by_operation.items()},
+        "peak_rss_kb": memory["main_kb"],
+        "peak_children_rss_kb": memory["children_kb"],
+        "peak_total_rss_kb": memory["total_kb"],
+        "pool_processes": memory["workers"],
+        "api_calls": dict(api.calls),
+        "scheduler": scheduler_stats,
+        "errors": errors,
+    }
+
+    print(f"{'operation':>18} {'count':>6} {'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9}")
+    for name, row in list(report["operations"].items()) + [("total", report["latency"])]:
+        if row["count"]:
+            print(f"{name:>18} {row['count']:>6} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+    print(f"throughput: {report['throughput_rps']:.1f} requests/s, peak RSS: {report['peak_rss_kb'] / 1024:.1f} MB "
+          f"(pool processes: {report['peak_children_rss_kb'] / 1024:.1f} MB in {report['pool_processes']}), "
+          f"errors: {len(errors)}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
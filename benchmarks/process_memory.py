@@ -0,0 +1,130 @@
+"""
+Замер памяти процесса бота и его пула обработки (для benchmarks/stress_memory.py, benchmarks/load_test.py
+и benchmarks/bench_loader.py).
+
+Процессы пула запускаются через forkserver (scheduler.process_pool), поэтому они - не дочерние процессы бота,
+а дочерние процессы forkserver. resource.getrusage(RUSAGE_CHILDREN) учитывает только завершенные дочерние
+процессы, поэтому RSS пула замеряется по /proc: у всех потомков процесса, пока они работают.
+
+- rss_kb: резидентная память процесса;
+- reset_peak_rss, peak_rss_kb: сброс и чтение пиковой резидентной памяти процесса (VmHWM);
+- descendants: все потомки процесса (дочерние процессы, их дочерние процессы и т.д.);
+- MemorySampler: замер RSS процесса и всех его потомков в отдельном потоке, пиковые значения.
+"""
+import os
+import threading
+
+
+def rss_kb(pid):
+    """
+    Резидентная память процесса (VmRSS) в килобайтах или 0, если процесс уже завершился
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def peak_rss_kb(pid='self'):
+    """
+    Пиковая резидентная память процесса (VmHWM) в килобайтах с запуска или последнего reset_peak_rss
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def reset_peak_rss(pid='self'):
+    """
+    Сбрасывает пиковую резидентную память процесса до текущей (Linux 4.0+). В отличие от ru_maxrss, после сброса
+    пик не включает память, занятую ранее (например, при импорте модулей). Возвращает False, если сброс недоступен.
+    """
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def descendants(pid):
+    """
+    Идентификаторы всех потомков процесса: процессы пула, forkserver и resource_tracker
+    """
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as stat:
+                # Имя процесса в скобках может содержать пробелы: поля считаются после него
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+
+    result = []
+    pending = list(children.get(pid, ()))
+    while pending:
+        child = pending.pop()
+        result.append(child)
+        pending.extend(children.get(child, ()))
+    return result
+
+
+class MemorySampler:
+    """
+    Замер RSS процесса и всех его потомков в отдельном потоке; peak() возвращает максимум с последнего reset().
+    children_kb - сумма RSS потомков, workers - сколько их было в момент пика.
+    """
+
+    def __init__(self, interval=0.05, pid=None):
+        self.interval = interval
+        self.pid = os.getpid() if pid is None else pid
+        self._peak = {"total_kb": 0, "main_kb": 0, "children_kb": 0, "workers": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='memory-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def reset(self):
+        with self._lock:
+            self._peak = dict.fromkeys(self._peak, 0)
+
+    def peak(self):
+        with self._lock:
+            return dict(self._peak)
+
+    def sample(self):
+        """
+        Один замер (вызывается потоком замера, а также перед чтением итогов)
+        """
+        main = rss_kb(self.pid)
+        pids = descendants(self.pid)
+        pool = sum(rss_kb(child) for child in pids)
+        with self._lock:
+            self._peak["main_kb"] = max(self._peak["main_kb"], main)
+            if pool > self._peak["children_kb"]:
+                self._peak["children_kb"] = pool
+                self._peak["workers"] = len(pids)
+            self._peak["total_kb"] = max(self._peak["total_kb"], main + pool)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
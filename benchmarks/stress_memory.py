@@ -0,0 +1,206 @@
+"""
+Нагрузочный тест памяти: параллельная загрузка больших изображений (модуль limits).
+
+Бот (модуль bot) подключается к заглушке Bot API (модуль fake_bot_api), как в benchmarks/load_test.py. В каждом
+раунде N параллельных чатов присылают файлом (документом) одно из больших изображений:
+- bomb: PNG одного цвета --bomb-side x --bomb-side (файл - сотни килобайт, после декодирования - больше сотни
+мегабайт), должен отклоняться до декодирования;
+- jpeg: JPEG --jpeg-size (по умолчанию 8000x6000, 48 млн точек), уменьшается при декодировании до бюджета точек;
+- png: PNG --png-size (по умолчанию 4000x3000), укладывается в бюджет и обрабатывается полностью,
+а затем нажимают кнопки операций (--operations). Каждый раунд использует новые file_id, поэтому кэши загрузок и
+результатов не избавляют от декодирования и обработки.
+
+Во время теста RSS процесса бота и всех его потомков (forkserver и процессы пула, модуль process_memory) замеряется
+каждые --interval секунд.
+Выводится пиковый RSS каждого раунда. Первые --warmup раундов заполняют кэши загрузок и декодированных изображений
+(их объем ограничен) и в рост не входят; после них пиковый RSS с ограничениями не растет от раунда к раунду
+(growth_mb - рост относительно первого раунда после прогрева). С --no-limits ограничения выключаются
+(IMAGE_MAX_PIXELS=0, JOB_MEMORY_LIMIT_MB=0, MALLOC_MMAP_THRESHOLD_KB=0) для сравнения. С --max-growth-mb код
+завершения - 1, если рост больше заданного. Результат в формате JSON печатается последней строкой (или
+записывается в файл --output).
+
+Запуск из корня проекта:
+    python benchmarks/stress_memory.py [--chats 6] [--rounds 4] [--warmup 1] [--no-limits] [--output memory.json]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from process_memory import MemorySampler  # noqa: E402
+
+DEFAULT_OPERATIONS = "sticker,invert,pixelate"
+
+# Вид изображения -> MIME-тип документа
+KINDS = {"bomb": "image/png", "jpeg": "image/jpeg", "png": "image/png"}
+
+
+def make_images(bomb_side, jpeg_size, png_size):
+    """
+    Содержимое файлов для каждого вида изображения
+    """
+    images = {}
+    buffer = io.BytesIO()
+    Image.new('L', (bomb_side, bomb_side), 255).save(buffer, format='PNG')
+    images["bomb"] = buffer.getvalue()
+    # Шум в низком разрешении, растянутый до нужного размера: файл небольшой, а изображение не одноцветное
+    for kind, size, image_format in (("jpeg", jpeg_size, 'JPEG'), ("png", png_size, 'PNG')):
+        noise = Image.merge('RGB', [Image.effect_noise((size[0] // 16, size[1] // 16), sigma).convert('L')
+                                    for sigma in (30, 60, 90)])
+        buffer = io.BytesIO()
+        noise.resize(size, Image.BILINEAR).save(buffer, format=image_format)
+        images[kind] = buffer.getvalue()
+    return images
+
+
+def run_chat(api, chat_id, round_index, kind, images, operations, outcomes, errors):
+    """
+    Сценарий одного чата в раунде: документ, набор символов, затем все операции по очереди.
+    Каждое действие вызывает ровно один ответ бота; метод ответа на кнопку записывается в outcomes.
+    """
+    chat = {'id': chat_id, 'type': 'private'}
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f"user{chat_id}"}
+    file_id = f"{kind}_{chat_id}_{round_index}"
+    api.add_file(file_id, images[kind])
+    document = {'file_id': file_id, 'file_unique_id': file_id, 'file_name': f"{kind}.bin",
+                'mime_type': KINDS[kind], 'file_size': len(images[kind])}
+    now = int(time.time())
+    actions = [("document", {'message': {'message_id': 1, 'date': now, 'chat': chat, 'from': user,
+                                         'document': document}}),
+               ("charset", {'message': {'message_id': 2, 'date': now, 'chat': chat, 'from': user,
+                                        'text': '@%#*+=-:. '}})]
+    for operation in operations:
+        actions.append((operation, {'callback_query': {
+            'id': f"{file_id}:{operation}", 'from': user, 'chat_instance': str(chat_id), 'data': operation,
+            'message': {'message_id': 3, 'date': now, 'chat': chat}}}))
+
+    for name, update in actions:
+        expected = api.reply_count(chat_id) + 1
+        api.push_update(update)
+        try:
+            replies = api.wait_replies(chat_id, expected, timeout=300)
+        except TimeoutError:
+            errors.append(f"{name}: timeout in chat {chat_id}")
+            return
+        if name in operations:
+            method = replies[expected - 1][0]
+            outcomes.setdefault(kind, {}).setdefault(method, 0)
+            outcomes[kind][method] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--chats', type=int, default=6, help="количество параллельных чатов в раунде")
+    parser.add_argument('--rounds', type=int, default=4, help="раундов после прогрева")
+    parser.add_argument('--warmup', type=int, default=1, help="раундов прогрева кэшей")
+    parser.add_argument('--kinds', default=','.join(KINDS), help="виды изображений через запятую (по кругу по чатам)")
+    parser.add_argument('--operations', default=DEFAULT_OPERATIONS, help="кнопки через запятую")
+    parser.add_argument('--bomb-side', type=int, default=12000, help="сторона PNG-бомбы")
+    parser.add_argument('--jpeg-size', default='8000x6000')
+    parser.add_argument('--png-size', default='4000x3000')
+    parser.add_argument('--interval', type=float, default=0.02, help="период замера RSS, с")
+    parser.add_argument('--no-limits', action='store_true', help="выключить ограничения памяти (для сравнения)")
+    parser.add_argument('--max-growth-mb', type=float, help="допустимый рост пикового RSS после прогрева")
+    parser.add_argument('--output', help="файл для результата в формате JSON")
+    args = parser.parse_args()
+
+    def parse_size(value):
+        return tuple(int(part) for part in value.split('x'))
+
+    images = make_images(args.bomb_side, parse_size(args.jpeg_size), parse_size(args.png_size))
+    kinds = args.kinds.split(',')
+    operations = args.operations.split(',')
+
+    api = FakeBotAPI().start()
+    # Настройки бота задаются до его создания (bot.create_app), как в load_test
+    os.environ['TELEGRAM_API_URL'] = api.url
+    os.environ['TELEGRAM_BOT_TOKEN'] = '1:stress-memory'
+    os.environ['STATE_BACKEND'] = 'memory'
+    os.environ.setdefault('DISPATCH_CHAT_RATE', '0')
+    os.environ.pop('DOWNLOAD_CACHE_DIR', None)
+    os.environ.pop('RESULT_CACHE_PATH', None)
+    if args.no_limits:
+        os.environ['IMAGE_MAX_PIXELS'] = '0'
+        os.environ['JOB_MEMORY_LIMIT_MB'] = '0'
+        os.environ['MALLOC_MMAP_THRESHOLD_KB'] = '0'
+
+    sampler = MemorySampler(args.interval).start()
+    rounds = []
+    outcomes = {}
+    errors = []
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        import bot
+        import limits
+
+        polling = threading.Thread(target=bot.create_app().polling,
+                                   kwargs={'none_stop': True, 'interval': 0, 'timeout': 1}, daemon=True)
+        polling.start()
+        for round_index in range(args.warmup + args.rounds):
+            sampler.reset()
+            started = time.perf_counter()
+            chats = [threading.Thread(target=run_chat, args=(
+                api, 1000 + index, round_index, kinds[index % len(kinds)], images, operations, outcomes, errors))
+                for index in range(args.chats)]
+            for chat in chats:
+                chat.start()
+            for chat in chats:
+                chat.join()
+            row = dict(sampler.peak(), elapsed_s=time.perf_counter() - started, warmup=round_index < args.warmup)
+            rounds.append(row)
+            label = f"round {round_index + 1}" + (" (warmup)" if row['warmup'] else "")
+            print(f"{label}: peak RSS {row['total_kb'] / 1024:.1f} MB (main {row['main_kb'] / 1024:.1f} MB, "
+                  f"pool {row['children_kb'] / 1024:.1f} MB in {row['workers']} processes), {row['elapsed_s']:.1f} s")
+
+        bot.bot.stop_polling()
+        polling.join(timeout=5)
+        scheduler_stats = bot.scheduler.stats()
+        bot.scheduler.shutdown()
+        bot.user_states.close()
+        bot.result_cache.close()
+        api.stop()
+    sampler.stop()
+
+    peaks = [row["total_kb"] for row in rounds if not row["warmup"]]
+    growth_mb = (max(peaks[1:]) - peaks[0]) / 1024 if len(peaks) > 1 else 0.0
+    report = {
+        "benchmark": "memory",
+        "python": platform.python_version(),
+        "config": {"chats": args.chats, "rounds": args.rounds, "warmup": args.warmup, "kinds": kinds,
+                   "operations": operations,
+                   "bomb_side": args.bomb_side, "jpeg_size": args.jpeg_size, "png_size": args.png_size,
+                   "file_bytes": {kind: len(data) for kind, data in images.items()}, "limits": not args.no_limits,
+                   "max_pixels": limits.MAX_PIXELS, "oversize": limits.OVERSIZE,
+                   "job_memory_limit_mb": limits.JOB_MEMORY_LIMIT // (1024 * 1024),
+                   "mmap_threshold_kb": limits.MMAP_THRESHOLD // 1024},
+        "rounds": rounds,
+        "peak_rss_mb": max(row["total_kb"] for row in rounds) / 1024 if rounds else None,
+        "growth_mb": growth_mb,
+        # Ответы на кнопки по видам изображений: sendMessage - сообщение об отклонении
+        "outcomes": outcomes,
+        "scheduler": scheduler_stats,
+        "errors": errors,
+    }
+    print(f"peak RSS: {report['peak_rss_mb']:.1f} MB, growth after warmup: {growth_mb:.1f} MB, "
+          f"errors: {len(errors)}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report))
+    failed = errors or (args.max_growth_mb is not None and growth_mb > args.max_growth_mb)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,39 +2,127 @@
 Многофункциональный телеграм-бот. Данный бот умеет обрабатывать фотографии и делать ASCII-арт.
 Проект использует библиотеки telebot (для взаимодействия с Telegram API) и Pillow (для работы с изображениями)
 
-Функции обработки изображений:
+Функции обработки изображений (модуль image_processing):
 - resize_image: изменяет размер изображения с сохранением пропорций.
 - grayify: преобразует цветное изображение в оттенки серого.
 - image_to_ascii: основная функция для преобразования изображения в ASCII-арт. Изменяет размер, преобразует
 в градации серого и затем в строку ASCII-символов.
 - pixels_to_ascii: конвертирует пиксели изображения в градациях серого в строку ASCII-символов,
-используя предопределенную строку ASCII_CHARS.
+используя предопределенную строку ASCII_CHARS. Преобразование выполняется модулем ascii_art за один проход
+по таблице из 256 элементов.
 - pixelate_image: принимает изображение и размер пикселя. Уменьшает изображение до размера,
 где один пиксель представляет большую область, затем увеличивает обратно, создавая пиксельный эффект.
 - invert_colors: функция инверсии цветов изображения
 - mirror_image: функция отражения изображения по горизонтали или вертикали
 - convert_to_heatmap: функция преобразования изображения в тепловую карту
+- apply_colormap (модуль colormaps): применение цветовой палитры (heatmap, inverted, viridis, sepia, thermal).
+Таблицы палитр вычисляются один раз, палитра применяется к изображению за один проход.
 
-Обработчики событий:
-- @bot.message_handler(commands=['start', 'help']): для текстовых команд. Реагирует на команды /start и /help,
+Обработчики событий (регистрируются функцией register_handlers при создании бота):
+- send_welcome (commands=['start', 'help']): для текстовых команд. Реагирует на команды /start и /help,
 отправляя приветственное сообщение.
-- @bot.message_handler(content_types=['photo']): для получения изображений. Реагирует на изображения,
+- handle_photo (content_types=['photo']): для получения изображений. Реагирует на изображения,
 отправляемые пользователем, и предлагает варианты обработки.
-- @bot.callback_query_handler: (func=lambda call: True): определяет действия в ответ на выбор пользователя
+- handle_file (content_types=['document', 'animation', 'sticker', 'video_note']): изображения, GIF и
+стикеры, отправленные файлом. Неподдерживаемые файлы (видео, анимированные стикеры) получают ответ с объяснением.
+- set_ascii_chars: ввод пользовательского набора символов после получения изображения.
+- callback_query (func=lambda call: True): определяет действия в ответ на выбор пользователя
 (например, пикселизация или ASCII-арт) и вызывает соответствующую функцию обработки.
 
-Функции отправки изображений:
-- pixelate_and_send: пикселизирует изображение и отправляет его обратно пользователю;
-- ascii_and_send: преобразует изображение в ASCII-арт и отправляет результат в виде текстового сообщения;
-- invert_and_send: инверсия цветов;
-- mirror_and_send: отражение изображения;
-- heatmap_and_send: преобразование изображения в тепловую карту;
+Кнопки обработки изображений (модуль actions, общий с асинхронным ботом): таблица кнопок преобразований
+IMAGE_ACTIONS и выбор задания по нажатой кнопке (actions.plan_job). Функции отправки выполняют задание:
+- transform_and_send: пикселизация, инверсия цветов, отражение, тепловая карта, палитра (клавиатура
+get_palette_keyboard, модуль colormaps), стикер или цепочка преобразований (модуль pipeline); результат
+отправляется пользователю;
+- ascii_and_send: преобразует изображение в ASCII-арт и отправляет результат текстовыми сообщениями;
+- album_and_send: обработка всех фотографий альбома и отправка результатов одним вызовом send_media_group;
 - random_joke_send: выбирает случайную шутку из списка и отправляет эту шутку пользователю;
 - random_compliment_send: выбирает случайный комплимент из списка и отправляет его пользователю;
 - flip_coin_send: функция подбрасывания монетки и отправки результата.
 
+Альбомы (модуль album):
+- handle_photo собирает фотографии альбома (media_group_id) в album_buffer, finish_album сохраняет их все в
+состоянии пользователя, когда новых фотографий нет ALBUM_DELAY секунд;
+- кнопки обработки изображений и цепочки применяются ко всем фотографиям альбома (album_and_send).
+
+Состояния пользователей (модуль state_store):
+- user_states: хранилище с ограничением количества сессий и временем жизни (в памяти или в SQLite).
+Настройки: STATE_BACKEND (memory или sqlite), STATE_DB_PATH, STATE_TTL, STATE_MAX_ENTRIES.
+
+Загрузка фотографий:
+- download_photo: загружает файл фотографии пользователя через кэш download_cache (модуль download_cache);
+- load_photo: возвращает декодированное изображение, повторно используя уже декодированные фотографии.
+Для каждой операции выбирается наименьший достаточный вариант фотографии, а JPEG уменьшается при декодировании
+(модуль image_loader).
+
+Планировщик обработки (модуль scheduler):
+- submit_job: ставит обработку изображения в очередь чата, чтобы поток опроса сразу освобождался;
+- scheduler.run_cpu: выполняет преобразование и кодирование изображения в пуле процессов.
+Настройки: WORKER_QUEUE_SIZE (размер очереди), WORKER_IO_THREADS (потоки), WORKER_PROCESSES (процессы, 0 - без пула).
+
+Кэш результатов (модуль result_cache):
+- send_image_result: повторно отправляет file_id уже загруженного результата вместо обработки и загрузки;
+- result_key: ключ результата (фотография, операция, параметры).
+Настройки: RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_PATH (файл SQLite для сохранения кэша между запусками).
+
+Метрики (модуль metrics):
+- каждое задание трассируется (submit_job), время этапов download, decode, transform, encode, upload и
+dispatch (обработка нажатия кнопки) записывается в гистограммы по операциям, ошибки считаются по типам;
+- render_image: обработка и кодирование в пуле процессов с замером времени обоих этапов.
+Настройки: METRICS_PORT (HTTP-сервер /metrics в формате Prometheus, /debug/profile, /debug/tracemalloc),
+METRICS_HOST, METRICS_LOG (строка JSON в журнале по каждому заданию), METRICS_PROFILE_RATE (доля заданий
+под cProfile). Если METRICS_PORT и METRICS_LOG не заданы, измерения выключены.
+
+Кодирование результатов (модуль encoding):
+- формат и параметры кодирования выбираются по профилю операции: photo - прогрессивный оптимизированный JPEG
+с подобранным качеством, pixel_art (пикселизация) - PNG с палитрой, sticker - WebP без прозрачных полей;
+- send_image_result и send_album отправляют стикер как документ, остальное - как фотографию;
+- record_encoding: размер результата и сэкономленные байты в метриках (output_bytes, saved_bytes).
+Настройки: ENCODING_JPEG_QUALITY, ENCODING_MAX_BYTES, ENCODING_WEBP_QUALITY, ENCODING_REPORT.
+
+Анимации (модуль animation):
+- transform_and_send: применяет преобразование к фотографии или покадрово к анимации (render_animated) и
+отправляет результат;
+- кадры читаются по одному и обрабатываются пачками в пуле процессов, результат кодируется в GIF или WebP и
+отправляется вызовом send_animation.
+Настройки: ANIMATION_FORMAT, ANIMATION_MAX_FRAMES, ANIMATION_MAX_SIDE, ANIMATION_MAX_PIXELS, ANIMATION_CHUNK_FRAMES.
+
+Отправка (модуль dispatch):
+- все запросы к Bot API проходят через rate_limiter: корзины токенов для каждого чата и общая, ответы на нажатия
+кнопок отправляются раньше загрузки изображений, после ответа 429 запрос повторяется через retry_after секунд;
+- обработчики не ждут токен своего чата в общих потоках: запрос ждет в очереди чата планировщика; ответ
+отбрасывается, только если такой же текст уже ждет отправки в этот чат (сообщения с клавиатурой и ERROR_NOTICES
+отправляются всегда);
+- submit_job отбрасывает повторное нажатие той же кнопки, пока задание еще выполняется (in_flight).
+Настройки: DISPATCH_GLOBAL_RATE, DISPATCH_CHAT_RATE, DISPATCH_CHAT_BURST, DISPATCH_GROUP_RATE, DISPATCH_MAX_RETRIES.
+
+Ограничения памяти (модуль limits):
+- размер изображения проверяется по заголовку до декодирования: JPEG больше бюджета точек уменьшается при
+декодировании, остальные форматы отклоняются;
+- память каждого процесса пула ограничена (limits.init_worker), а холсты стикеров и буферы кодирования
+переиспользуются;
+- finish_job отвечает IMAGE_TOO_LARGE (или ANIMATION_TOO_LARGE), если изображение не укладывается в ограничения
+или обработке не хватило памяти, и UNSUPPORTED_FILE, если Pillow не может прочитать файл (SVG, HEIC и другие
+форматы с MIME-типом image/*);
+- create_components фиксирует порог mmap распределителя памяти (limits.tune_allocator), чтобы RSS не рос из-за
+фрагментации кучи; кэш декодированных изображений ограничен по объему (DOWNLOAD_CACHE_IMAGE_BYTES).
+Настройки: IMAGE_MAX_PIXELS, IMAGE_OVERSIZE (downscale или reject), JOB_MEMORY_LIMIT_MB, MALLOC_MMAP_THRESHOLD_KB.
+
 Инициализация бота:
-- bot.polling(none_stop=True).
+- при импорте модуля ничего не создается и не запускается, токен не нужен: функции модуля можно импортировать
+для проверки и замеров;
+- load_settings: загрузка переменных из файла .env, токена и адреса Bot API;
+- create_components: общие объекты (user_states, scheduler, кэши, metrics, rate_limiter), их использует и
+асинхронный бот;
+- create_app: фабрика приложения - создает бота TeleBot и при необходимости регистрирует обработчики
+(register_handlers). Модуль telebot загружается только здесь;
+- main: create_app и bot.polling(none_stop=True).
+Модули форматов Pillow загружаются при первом использовании (image_loader.load_plugin), а модули профилирования,
+HTTP-сервера метрик и пул процессов - только если они нужны. Время холодного запуска: benchmarks/bench_import.py.
+Для запуска в несколько процессов используется модуль cluster: один процесс получает обновления и кладет их
+в очередь (модуль work_queue), процессы-обработчики передают обновления своих чатов в bot.process_new_updates.
+Настройка TELEGRAM_API_URL заменяет адрес Bot API (например, на локальный тестовый сервер для нагрузочного
+тестирования, см. benchmarks/load_test.py).
 
 Описание импортов:
 * import io: импортирует модуль io, который обеспечивает возможность работы с потоками. Он используется здесь
@@ -42,40 +130,79 @@
 * import os: взаимодействие с операционной системой. В данном проекте используется для получения значения
 токена бота из переменной окружения;
 * import random: импортирует модуль random для случайного выбора шутки;
-* import telebot: импортирует библиотеку telebot, которая используется для взаимодействия с API Telegram Bot.
-Позволяет создавать ботов, которые могут отправлять и получать сообщения, обрабатывать команды и многое другое;
-* from PIL import Image: импортирует модуль Image из библиотеки Pillow. Этот модуль используется для открытия,
-обработки и сохранения изображений в различных форматах;
-* from PIL import ImageOps: импорт модуля ImageOps из библиотеки Pillow. Включает в себя различные операции,
-такие как инверсия цветов, поворот и обрезка изображений и др.;
+* from telebot import TeleBot: импортирует библиотеку telebot, которая используется для взаимодействия с API
+Telegram Bot. Позволяет создавать ботов, которые могут отправлять и получать сообщения, обрабатывать команды и
+многое другое. Импортируется в create_app, а не при импорте модуля;
+* Pillow (PIL.Image) используется модулями обработки изображений (image_processing, image_loader, encoding и др.)
+для открытия, обработки и сохранения изображений в различных форматах;
 * from dotenv import load_dotenv: библиотека dotenv используется для загрузки переменных окружения из файла .env
-В проекте load_dotenv вызывается для загрузки переменной TELEGRAM_BOT_TOKEN из файла .env,
+В проекте load_dotenv вызывается (в load_settings) для загрузки переменной TELEGRAM_BOT_TOKEN из файла .env,
 чтобы обеспечить безопасность токена бота;
 * from telebot import types: импортирует модуль types из библиотеки telebot, который содержит различные классы
-и функции для создания различных типов объектов Telegram, таких, как клавиатуры и кнопки.
+и функции для создания различных типов объектов Telegram, таких, как клавиатуры и кнопки (импортируется
+в функциях, которые создают клавиатуры и альбомы).
 """
-import io
+import logging
 import os
 import random
-
-import telebot
-from PIL import Image, ImageOps
-from PIL.ImageOps import grayscale
-from dotenv import load_dotenv
-from telebot import types
-from telebot.apihelper import download_file
-
-# Инициализация бота с использованием токена
-load_dotenv()  # Загружаем переменные из .env файла
-TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-
-bot = telebot.TeleBot(TOKEN)
-
-# Состояние пользователя хранится в словаре
-user_states = {}
-
-# Набор символов для создания ASCII-арта
-ASCII_CHARS = '@%#*+=-:. '
+import threading
+
+from PIL import UnidentifiedImageError
+
+import actions
+import encoding
+import animation
+import dispatch
+import limits
+from album import MediaGroupBuffer
+from animation import AnimationTooLarge
+from colormaps import COLORMAPS, apply_colormap
+from download_cache import DownloadCache
+from metrics import BYTES_BUCKETS, Metrics
+from image_loader import DECODE_MODES, decode_image, photo_sizes, select_for_operation, select_sizes_for_operation
+from result_cache import ResultCache
+from pipeline import STEPS
+from image_processing import (ASCII_CHARS, apply_and_encode_timed, convert_to_heatmap, grayify, image_to_ascii,
+                              invert_colors, mirror_image, pixelate_image, pixels_to_ascii, resize_for_sticker,
+                              resize_image)
+from scheduler import ProcessingScheduler
+from state_store import create_state_store
+
+# Настройки и объекты бота создаются при запуске (load_settings, create_components, create_app), а не при импорте:
+# модуль можно импортировать без токена, например, для проверки функций обработки
+TOKEN = None
+API_URL = None
+bot = None
+rate_limiter = None
+user_states = None
+scheduler = None
+download_cache = None
+result_cache = None
+metrics = None
+in_flight = None
+album_buffer = None
+
+ALBUM_RECEIVED = ("У меня есть ваш альбом ({} фото)! Обработка изображений будет применена ко всем фотографиям, "
+                  "ASCII-арт - к первой. Пожалуйста, введите набор символов для ASCII-арта (например, '@%#*+=-:. ').")
+
+# Ответы на изображения, присланные файлом, анимацией или стикером
+FILE_RECEIVED = ("У меня есть ваше изображение! Анимация GIF будет обработана покадрово. Пожалуйста, введите набор "
+                 "символов для ASCII-арта (например, '@%#*+=-:. ').")
+UNSUPPORTED_FILE = ("Я умею обрабатывать фотографии, изображения, присланные файлом, анимации GIF и обычные стикеры. "
+                    "Видео, видеосообщения и анимированные стикеры пока не поддерживаются.")
+FILE_TOO_LARGE = "Файл слишком большой: бот может загружать файлы размером до 20 МБ."
+ANIMATION_TOO_LARGE = "Анимация слишком длинная или слишком большая для обработки. Попробуйте анимацию покороче."
+IMAGE_TOO_LARGE = "Изображение слишком большое для обработки. Попробуйте изображение меньшего разрешения."
+
+# Сообщения об ошибках: модуль dispatch отправляет их, даже если такое же сообщение уже ждет отправки в чат
+ERROR_NOTICES = (actions.NO_PHOTO, actions.EMPTY_CHAIN, UNSUPPORTED_FILE, FILE_TOO_LARGE, ANIMATION_TOO_LARGE,
+                 IMAGE_TOO_LARGE)
+
+# Ошибки задания, о которых сообщается пользователю (job_error_message), а не только в журнал
+JOB_ERRORS = (limits.ImageTooLarge, MemoryError, UnidentifiedImageError)
+
+# Максимальный размер файла, который бот может загрузить через Bot API
+MAX_FILE_SIZE = 20 * 1024 * 1024
 
 # Списки шуток и комплиментов
 JOKES = [
@@ -100,167 +227,96 @@ COMPLIMENTS = [
     "Ты очень умный и сообразительный!"
 ]
 
-def resize_image(image, new_width=100):
-    """
-    Функция изменения размера изображения
-    """
-    width, height = image.size
-    ratio = height / width
-    new_height = int(new_width * ratio)
-    return image.resize((new_width, new_height))
-
-def grayify(image):
-    """
-    Преобразование изображения в градации серого
-    """
-    return image.convert("L")
-
-def image_to_ascii(image_stream, new_width=40, ascii_chars=ASCII_CHARS):
-    """
-    Преобразование изображения в ASCII-арт
-    image_stream: поток изображения
-    new_width: новая ширина для изменения размера
-    ascii_chars: набор символов для ASCII-арта
-    """
-    # Переводим в оттенки серого
-    image = Image.open(image_stream).convert('L')
-
-    # меняем размер, сохраняя отношение сторон
-    width, height = image.size
-    aspect_ratio = height / float(width)
-    new_height = int(
-        aspect_ratio * new_width * 0.55)  # корректируем соотношение для ASCII, так как высота букв больше, чем ширина
-    img_resized = image.resize((new_width, new_height))
-
-    # Конвертируем пиксели в ASCII-символы
-    img_str = pixels_to_ascii(img_resized, ascii_chars)
-    img_width = img_resized.width
-
-    # Ограничение на количество символов
-    max_characters = 4000 - (new_width + 1)
-    max_rows = max_characters // (new_width + 1)
-
-    ascii_art = ""
-    for i in range(0, min(max_rows * img_width, len(img_str)), img_width):
-        ascii_art += img_str[i:i + img_width] + "\n"
-
-    return ascii_art
-
-def pixels_to_ascii(image, ascii_chars):
-    """
-    Преобразование пикселей в ASCII-символы
-    """
-    pixels = image.getdata()
-    characters = ""
-    for pixel in pixels:
-        characters += ascii_chars[pixel * len(ascii_chars) // 256]
-    return characters
-
-def pixelate_image(image, pixel_size):
+def send_welcome(message):
     """
-    Функция огрубления изображения
+    Обработчик команд /start и /help
     """
-    image = image.resize(
-        (image.size[0] // pixel_size, image.size[1] // pixel_size),
-        Image.NEAREST
-    )
-    image = image.resize(
-        (image.size[0] * pixel_size, image.size[1] * pixel_size),
-        Image.NEAREST
-    )
-    return image
+    bot.reply_to(message, "Пришлите мне изображение, и я предложу вам варианты!")
 
-def invert_colors(image):
+def handle_photo(message):
     """
-    Функция инверсии цветов изображения
+    Обработчик получения изображения.
+    Фотографии альбома собираются вместе (finish_album), и бот отвечает один раз на весь альбом.
     """
-    # Проверяем, что изображение в формате RGB
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    return ImageOps.invert(image)
+    if message.media_group_id:
+        if album_buffer.add(message):
+            schedule_album_check(message.media_group_id, album_buffer.delay)
+        return
+    bot.reply_to(message, "У меня есть ваша фотография! Пожалуйста, введите набор символов для ASCII-арта "
+                          "(например, '@%#*+=-:. ').")
+    photo = message.photo[-1]
+    user_states.set_photo(message.chat.id, photo.file_id, photo.file_unique_id, photo_sizes(message.photo))
 
-def mirror_image(image, direction="horizontal"):
+def handle_file(message):
     """
-    Функция отражения изображения по горизонтали или вертикали
-    image: Объект PIL.Image
-    direction: Направление отражения ("horizontal" или "vertical")
+    Обработчик изображений, присланных не как фотография: файлом (документ), анимацией GIF или стикером.
+    GIF обрабатывается покадрово (модуль animation), остальные изображения - как фотография.
     """
-    if direction == "horizontal":
-        return image.transpose(Image.FLIP_LEFT_RIGHT)
-    elif direction == "vertical":
-        return image.transpose(Image.FLIP_TOP_BOTTOM)
+    media, file = file_media(message)
+    if media is None:
+        bot.reply_to(message, UNSUPPORTED_FILE)
+    elif (file.file_size or 0) > MAX_FILE_SIZE:
+        bot.reply_to(message, FILE_TOO_LARGE)
     else:
-        raise ValueError("Invalid direction. Use 'horizontal' or 'vertical'.")
+        bot.reply_to(message, FILE_RECEIVED)
+        user_states.set_photo(message.chat.id, file.file_id, file.file_unique_id, media=media)
 
-def convert_to_heatmap(image):
+def file_media(message):
     """
-    Преобразование изображения в тепловую карту
-    grayscale_image: преобразуем изображение в оттенки серого
-    heatmap_image: применяем градиент от синего (холодные) к красному (теплые области)
+    Вид присланного файла и сам файл: ("animation", файл) для GIF, ("image", файл) для других изображений и
+    статичных стикеров, (None, None) для файлов, которые Pillow не может декодировать (видео, MP4-анимации,
+    анимированные и видеостикеры)
     """
-    grayscale_image = image.convert("L")
-    heatmap_image = ImageOps.colorize(grayscale_image, black="blue", white="red")
-    return  heatmap_image
+    if message.content_type == "sticker":
+        sticker = message.sticker
+        return (None, None) if sticker.is_animated or sticker.is_video else ("image", sticker)
+    # Для GIF Telegram присылает и animation, и document
+    file = message.animation or message.document
+    mime_type = getattr(file, "mime_type", None) or ""
+    if mime_type == "image/gif":
+        return "animation", file
+    if mime_type.startswith("image/"):
+        return "image", file
+    return None, None
 
-def resize_for_sticker(image, max_size=512):
+def schedule_album_check(media_group_id, delay):
     """
-    Изменяет размер изображения для загрузки в Telegram в виде стикера.
-    - Максимальное измерение (ширина или высота) не превышает max_size.
-    - Гарантирует формат PNG и добавляет прозрачный фон, если его нет.
-    image: объект PIL.Image;
-    max_size: максимальный размер (ширина или высота)
-        """
-    # Получаем текущие размеры изображения
-    width, height = image.size
-
-    # Вычисляем коэффициент изменения размера
-    scaling_factor = max_size / max(width, height)
-
-    # Вычисляем новые размеры, сохраняя пропорции
-    new_width = int(width * scaling_factor)
-    new_height = int(height * scaling_factor)
-
-    # Изменяем размер изображения
-    resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-    # Проверяем, есть ли прозрачный фон, и добавляем его, если нужно
-    if resized_image.mode != "RGBA":
-        resized_image = resized_image.convert("RGBA")
-
-    # Создаем новое изображение с прозрачным фоном
-    final_image = Image.new("RGBA", (max_size, max_size), (0, 0, 0, 0))
-
-    # Размещаем изображение по центру
-    offset_x = (max_size - new_width) // 2
-    offset_y = (max_size - new_height) // 2
-    final_image.paste(resized_image, (offset_x, offset_y), resized_image)
-
-    return final_image
-
+    Проверка через delay секунд, собран ли альбом
+    """
+    timer = threading.Timer(delay, finish_album, (media_group_id,))
+    timer.daemon = True
+    timer.start()
 
-@bot.message_handler(commands=['start', 'help'])
-def send_welcome(message):
+def finish_album(media_group_id):
     """
-    Обработчик команд /start и /help
+    Завершение сбора альбома: если фотографии еще приходят, проверка откладывается, иначе все фотографии
+    альбома сохраняются в состоянии пользователя
     """
-    bot.reply_to(message, "Пришлите мне изображение, и я предложу вам варианты!")
+    remaining = album_buffer.due(media_group_id)
+    if remaining > 0:
+        schedule_album_check(media_group_id, remaining)
+        return
+    album = album_buffer.pop(media_group_id)
+    if album is not None:
+        chat_id, messages = album
+        save_album(chat_id, messages)
+        bot.reply_to(messages[0], ALBUM_RECEIVED.format(len(messages)))
 
-@bot.message_handler(content_types=['photo'])
-def handle_photo(message):
+def save_album(chat_id, messages):
     """
-    Обработчик получения изображения
+    Сохранение всех фотографий альбома в состоянии пользователя.
+    Первая фотография сохраняется и как обычная фотография: к ней применяется ASCII-арт.
     """
-    bot.reply_to(message, "У меня есть ваша фотография! Пожалуйста, введите набор символов для ASCII-арта "
-                          "(например, '@%#*+=-:. ').")
-    user_states[message.chat.id] = {'photo': message.photo[-1].file_id, 'ascii_chars': None}
+    album_sizes = [photo_sizes(message.photo) for message in messages]
+    photo = messages[0].photo[-1]
+    user_states.set_photo(chat_id, photo.file_id, photo.file_unique_id, album_sizes[0],
+                          album=album_sizes if len(album_sizes) > 1 else None)
 
-@bot.message_handler(func=lambda message: message.chat.id in user_states and
-                                          user_states[message.chat.id]['ascii_chars'] is None)
 def set_ascii_chars(message):
     """
     Обработчик ввода пользовательского набора символов
     """
-    user_states[message.chat.id]['ascii_chars'] = message.text
+    user_states.update(message.chat.id, ascii_chars=message.text)
     bot.reply_to(message, "Спасибо! Теперь выберите, что бы Вы хотели сделать с изображением.",
                  reply_markup=get_options_keyboard())
 
@@ -268,6 +324,8 @@ def get_options_keyboard():
     """
     Создание клавиатуры с вариантами действий
     """
+    from telebot import types
+
     keyboard = types.InlineKeyboardMarkup()
     pixelate_btn = types.InlineKeyboardButton("Pixelate", callback_data="pixelate")
     ascii_btn = types.InlineKeyboardButton("ASCII Art", callback_data="ascii")
@@ -275,43 +333,82 @@ def get_options_keyboard():
     mirror_h_btn = types.InlineKeyboardButton("Mirror Horizontal", callback_data="mirror_horizontal")
     mirror_v_btn = types.InlineKeyboardButton("Mirror Vertical", callback_data="mirror_vertical")
     heatmap_btn = types.InlineKeyboardButton("Heatmap", callback_data="heatmap")
+    palettes_btn = types.InlineKeyboardButton("Color Palettes", callback_data="palettes")
     sticker_btn = types.InlineKeyboardButton("Prepare Sticker", callback_data="sticker")
+    chain_btn = types.InlineKeyboardButton("Build Chain", callback_data="chain")
     joke_btn = types.InlineKeyboardButton("Random Joke", callback_data="joke")
     compliment_btn = types.InlineKeyboardButton("Random Compliment", callback_data="compliment")
     flip_coin_btn = types.InlineKeyboardButton("Flip a Coin", callback_data="flip_coin")
 
     keyboard.add(pixelate_btn, ascii_btn, invert_btn)
-    keyboard.add(mirror_h_btn, mirror_v_btn)
-    keyboard.add(heatmap_btn, sticker_btn)
+    keyboard.add(mirror_h_btn, mirror_v_btn, chain_btn)
+    keyboard.add(heatmap_btn, palettes_btn, sticker_btn)
     keyboard.add(joke_btn, compliment_btn, flip_coin_btn)
     return keyboard
 
-@bot.callback_query_handler(func=lambda call: True)
+def get_palette_keyboard():
+    """
+    Создание клавиатуры для выбора цветовой палитры (модуль colormaps)
+    """
+    from telebot import types
+
+    keyboard = types.InlineKeyboardMarkup(row_width=3)
+    keyboard.add(*[types.InlineKeyboardButton(label, callback_data=f"palette:{name}")
+                   for name, (_, label, _) in COLORMAPS.items()])
+    return keyboard
+
+def get_chain_keyboard():
+    """
+    Создание клавиатуры для составления цепочки преобразований
+    """
+    from telebot import types
+
+    keyboard = types.InlineKeyboardMarkup(row_width=3)
+    keyboard.add(*[types.InlineKeyboardButton(f"+ {label}", callback_data=f"chain_add:{name}")
+                   for name, (_, _, _, label) in STEPS.items()])
+    run_btn = types.InlineKeyboardButton("Run Chain", callback_data="chain_run")
+    clear_btn = types.InlineKeyboardButton("Clear", callback_data="chain_clear")
+    keyboard.add(run_btn, clear_btn)
+    return keyboard
+
 def callback_query(call):
     """
     Обработчик нажатия кнопок
     """
-    if call.data == "pixelate":
-        bot.answer_callback_query(call.id, "Пикселизация вашего изображения...")
-        pixelate_and_send(call.message)
-    elif call.data == "ascii":
-        bot.answer_callback_query(call.id, "Преобразование вашего изображения в формат ASCII...")
-        ascii_and_send(call.message)
-    elif call.data == "invert":
-        bot.answer_callback_query(call.id, "Инверсия цветов изображения...")
-        invert_and_send(call.message)  # Функция инверсии цветов и отправки изображения
-    elif call.data == "mirror_horizontal":
-        bot.answer_callback_query(call.id, "Отражение изображения по горизонтали...")
-        mirror_and_send(call.message, direction="horizontal")
-    elif call.data == "mirror_vertical":
-        bot.answer_callback_query(call.id, "Отражение изображения по вертикали...")
-        mirror_and_send(call.message, direction="vertical")
-    elif call.data == "heatmap":
-        bot.answer_callback_query(call.id, "Создание тепловой карты изображения...")
-        heatmap_and_send(call.message)
-    elif call.data == "sticker":
-        bot.answer_callback_query(call.id, "Подготовка изображения для стикера...")
-        prepare_sticker_and_send(call.message)
+    with metrics.stage("dispatch", actions.button_label(call.data)):
+        dispatch_callback(call)
+
+def dispatch_callback(call):
+    """
+    Выбор действия по нажатой кнопке. Что делать по кнопке обработки изображения, решает модуль actions.
+    """
+    chat_id = call.message.chat.id
+    if actions.is_job_button(call.data):
+        state = user_states.get(chat_id)
+        try:
+            job = actions.plan_job(state, call.data)
+        except actions.ActionRejected as rejected:
+            bot.answer_callback_query(call.id, rejected.notice)
+            if rejected.message:
+                bot.send_message(chat_id, rejected.message)
+            return
+        bot.answer_callback_query(call.id, job.notice)
+        submit_job(call.message, state, job)
+    elif call.data == "palettes":
+        bot.answer_callback_query(call.id, "Выбор цветовой палитры...")
+        bot.send_message(chat_id, "Выберите палитру:", reply_markup=get_palette_keyboard())
+    elif call.data == "chain":
+        bot.answer_callback_query(call.id, "Составление цепочки преобразований...")
+        bot.send_message(chat_id, "Выберите шаги по порядку и нажмите Run Chain. Изображение будет "
+                                  "обработано всеми шагами за один раз.", reply_markup=get_chain_keyboard())
+    elif call.data.startswith("chain_add:"):
+        steps, notice = actions.add_chain_step(user_states.get(chat_id), call.data.split(":", 1)[1])
+        if steps is not None:
+            user_states.update(chat_id, chain=steps)
+        bot.answer_callback_query(call.id, notice)
+    elif call.data == "chain_clear":
+        user_states.update(chat_id, chain=None)
+        bot.answer_callback_query(call.id, "Цепочка очищена")
     elif call.data == "joke":
         bot.answer_callback_query(call.id, "Случайная шутка...")
         random_joke_send(call.message)
@@ -322,119 +419,283 @@ def callback_query(call):
         bot.answer_callback_query(call.id, "Подбрасываем монетку...")
         flip_coin_send(call.message)
 
-def pixelate_and_send(message):
+def submit_job(message, state, job):
     """
-    Функция пикселизации и отправки изображения
+    Постановка обработки изображения в очередь планировщика.
+    Ответ на нажатие кнопки уже отправлен, поэтому поток опроса не ждет окончания обработки.
+    Если очередь переполнена, бот сообщает о своей занятости.
+    Повторное нажатие той же кнопки, пока задание еще выполняется, отбрасывается: результат придет один раз.
+    job: задание (actions.plan_job)
     """
-    photo_id = user_states[message.chat.id]['photo']
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
+    key = job_key(message.chat.id, state, job.kind, job.operation, job.args)
+    if not in_flight.start(key):
+        return
+    # Задание трассируется целиком: время всех этапов записывается в метрики под названием задания
+    if not scheduler.submit(message.chat.id, finish_job, key, metrics.traced(job.name, run_job), message, job=job):
+        in_flight.finish(key)
+        bot.send_message(message.chat.id, "Сейчас бот перегружен. Пожалуйста, повторите попытку через минуту.")
 
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
-    pixelated = pixelate_image(image, 20)
+def job_key(chat_id, state, *params):
+    """
+    Ключ задания для отбрасывания повторных нажатий: чат, фотография и параметры обработки
+    """
+    return chat_id, state.file_unique_id, repr(params)
 
-    output_stream = io.BytesIO()
-    pixelated.save(output_stream, format="JPEG")
-    output_stream.seek(0)
-    bot.send_photo(message.chat.id, output_stream)
+def finish_job(key, func, message, **kwargs):
+    """
+    Выполнение задания; после завершения такое же задание снова можно запустить.
+    Если изображение не укладывается в бюджет точек, обработке не хватило памяти (модуль limits) или Pillow
+    не может прочитать файл, пользователь получает сообщение об этом (job_error_message).
+    """
+    try:
+        return func(message, **kwargs)
+    except JOB_ERRORS as error:
+        bot.send_message(message.chat.id, job_error_message(error))
+    finally:
+        in_flight.finish(key)
 
-def ascii_and_send(message):
+def run_job(message, job):
     """
-    Функция преобразования изображения в ASCII-арт и отправки
+    Выполнение задания по нажатой кнопке (actions.plan_job)
     """
-    photo_id = user_states[message.chat.id]['photo']
+    if job.kind == "album":
+        album_and_send(message, job)
+    elif job.kind == "ascii":
+        ascii_and_send(message)
+    else:
+        transform_and_send(message, job)
 
-    # Используем пользовательские символы или стандартные
-    ascii_chars = user_states[message.chat.id]['ascii_chars'] or ASCII_CHARS
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
+def job_error_message(error):
+    """
+    Ответ на ошибку задания (JOB_ERRORS): файл, который Pillow не может прочитать (например, SVG или HEIC
+    с MIME-типом image/*), или изображение и анимация, которые не укладываются в ограничения
+    """
+    if isinstance(error, UnidentifiedImageError):
+        return UNSUPPORTED_FILE
+    return ANIMATION_TOO_LARGE if isinstance(error, AnimationTooLarge) else IMAGE_TOO_LARGE
 
-    image_stream = io.BytesIO(downloaded_file)
+def download_photo(chat_id, operation=None):
+    """
+    Загрузка файла фотографии пользователя.
+    Загружается наименьший вариант фотографии, достаточный для операции (модуль image_loader).
+    Повторные запросы той же фотографии обслуживаются из кэша без обращения к Telegram API.
+    """
+    file_id, file_unique_id, _ = select_for_operation(user_states.get(chat_id), operation)
+    return fetch_file(file_id, file_unique_id)
 
-    # Передаем пользовательские символы
-    ascii_art = image_to_ascii(image_stream, ascii_chars=ascii_chars)
-    bot.send_message(message.chat.id, f"```\n{ascii_art}\n```", parse_mode="MarkdownV2")
+def fetch_file(file_id, file_unique_id):
+    """
+    Загрузка файла по file_id через кэш загрузок
+    """
+    def load():
+        with metrics.stage("download"):
+            file_info = bot.get_file(file_id)
+            data = bot.download_file(file_info.file_path)
+        record_download(data)
+        return data
+
+    return download_cache.fetch(file_unique_id, load)
 
-def invert_and_send(message):
+def load_photo(chat_id, operation=None):
     """
-    Функция инверсии цветов и отправки изображения
+    Загрузка и декодирование фотографии пользователя.
+    Изображение уменьшается при декодировании до бюджета разрешения операции.
+    Возвращает объект PIL.Image из кэша, если фотография уже была декодирована для такого же бюджета.
     """
-    photo_id = user_states[message.chat.id]['photo']
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
+    return load_selected(select_for_operation(user_states.get(chat_id), operation), operation)
 
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
+def load_selected(selected, operation=None):
+    """
+    Загрузка и декодирование выбранного варианта фотографии
+    selected: (file_id, file_unique_id, бюджет разрешения) - результат select_for_operation
+    """
+    file_id, file_unique_id, _ = selected
+    image_key, decode = image_decoder(selected, operation)
+    return download_cache.fetch_image(image_key, lambda: fetch_file(file_id, file_unique_id), decoder=decode)
+
+def image_decoder(selected, operation=None):
+    """
+    Ключ декодированного изображения в кэше загрузок и функция декодирования (с замером этапа decode):
+    изображение уменьшается до бюджета разрешения операции и переводится в нужный ей режим
+    """
+    _, file_unique_id, budget = selected
+    mode = DECODE_MODES.get(operation)
 
-    # Применяем инверсию цветов
-    inverted_image = invert_colors(image)
+    def decode(data):
+        with metrics.stage("decode"):
+            return decode_image(data, budget, mode)
 
-    # Сохраняем результат в поток и отправляем
-    output_stream = io.BytesIO()
-    inverted_image.save(output_stream, format="JPEG")
-    output_stream.seek(0)
-    bot.send_photo(message.chat.id, output_stream)
+    return f"{file_unique_id}@{budget}:{mode}", decode
 
-def mirror_and_send(message, direction):
+def record_download(data, operation=None):
     """
-    Функция отражения изображения и отправки
+    Запись размера загруженного файла в метрики
     """
-    photo_id = user_states[message.chat.id]['photo']
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
+    metrics.observe("download_bytes", operation, len(data), BYTES_BUCKETS)
 
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
+def render_image(func, image, args=(), profile="photo"):
+    """
+    Обработка и кодирование изображения в пуле процессов.
+    Время обработки и кодирования измеряется в процессе пула и записывается в метрики вместе с размером
+    результата (и сэкономленными байтами, если включен ENCODING_REPORT).
+    profile: профиль кодирования (модуль encoding)
+    """
+    data, stages, baseline = scheduler.run_cpu(apply_and_encode_timed, func, image, args, profile)
+    record_encoding(stages, data, baseline)
+    return data
 
-    # Применяем отражение
-    mirrored_image = mirror_image(image, direction)
+def record_encoding(stages, data, baseline=None):
+    """
+    Запись в метрики времени обработки и кодирования, размера результата и сэкономленных байтов
+    """
+    metrics.record_stages(None, stages)
+    metrics.observe("output_bytes", None, len(data), BYTES_BUCKETS)
+    if baseline is not None:
+        metrics.observe("saved_bytes", None, max(0, baseline - len(data)), BYTES_BUCKETS)
 
-    # Сохраняем результат в поток и отправляем
-    output_stream = io.BytesIO()
-    mirrored_image.save(output_stream, format="JPEG")
-    output_stream.seek(0)
-    bot.send_photo(message.chat.id, output_stream)
+def result_key(chat_id, operation, *params):
+    """
+    Ключ кэша результатов: вариант фотографии, выбранный для операции, операция и ее параметры
+    """
+    _, file_unique_id, budget = select_for_operation(user_states.get(chat_id), operation)
+    return result_cache.make_key(file_unique_id, operation, params + (budget,))
 
-def heatmap_and_send(message):
+def send_image_result(chat_id, key, render, profile="photo", file_name="image"):
     """
-    Функция преобразования изображения в тепловую карту, и его отправки
-    photo_id: получаем ID фото и загружаем изображение
+    Отправка обработанного изображения с использованием кэша результатов.
+    Если такой результат уже отправлялся, повторно отправляется его file_id: изображение не обрабатывается
+    и не загружается в Telegram заново.
+    render: функция, которая обрабатывает изображение и возвращает байты результата
+    profile: профиль кодирования; метод отправки выбирает actions.send_method
+    file_name: имя файла без расширения
     """
-    photo_id = user_states[message.chat.id]['photo']
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
+    from telebot.apihelper import ApiTelegramException
 
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
+    method, options = actions.send_method(profile, file_name)
 
-    # Применяем тепловую карту
-    heatmap_image = convert_to_heatmap(image)
+    def send(content):
+        with metrics.stage("upload"):
+            return actions.sent_file_id(getattr(bot, method)(chat_id, content, **options))
 
-    # Сохраняем результат в поток и отправляем
-    output_stream = io.BytesIO()
-    heatmap_image.save(output_stream, format="JPEG")
-    output_stream.seek(0)
-    bot.send_photo(message.chat.id, output_stream)
+    file_id = result_cache.get(key)
+    if file_id is not None:
+        try:
+            send(file_id)
+            return
+        except ApiTelegramException:
+            # Сохраненный file_id больше не принимается - обрабатываем изображение заново
+            result_cache.delete(key)
 
-def prepare_sticker_and_send(message):
+    result_cache.put(key, send(actions.result_file(render(), profile, file_name)))
+
+def transform_and_send(message, job):
     """
-    Подготавливает изображение для загрузки в Telegram как стикер и отправляет его.
+    Применение преобразования к изображению пользователя и отправка результата через кэш результатов.
+    GIF (профиль animation) обрабатывается покадрово и отправляется анимацией (модуль animation).
+    job: задание (actions.plan_job); операция определяет бюджет разрешения и ключ кэша результатов, аргументы
+    функции - параметры ключа
     """
-    photo_id = user_states[message.chat.id]['photo']
-    file_info = bot.get_file(photo_id)
-    downloaded_file = bot.download_file(file_info.file_path)
-    image_stream = io.BytesIO(downloaded_file)
-    image = Image.open(image_stream)
+    chat_id = message.chat.id
+    key = result_key(chat_id, job.operation, *job.args)
+
+    def render():
+        if job.profile == "animation":
+            return render_animated(chat_id, job.operation, job.func, job.args)
+        image = load_photo(chat_id, job.operation)
+        return render_image(job.func, image, job.args, job.profile)
 
-    # Подготавливаем изображение для стикера
-    sticker_image = resize_for_sticker(image)
+    send_image_result(chat_id, key, render, job.profile, job.operation)
 
-    # Сохраняем изображение как PNG и отправляем
-    output_stream = io.BytesIO()
-    sticker_image.save(output_stream, format="PNG")
-    output_stream.seek(0)
-    bot.send_document(message.chat.id, output_stream, visible_file_name="sticker.png")
+def render_animated(chat_id, operation, func, args=()):
+    """
+    Покадровая обработка анимации пользователя: кадры обрабатываются пачками параллельно в пуле процессов
+    """
+    file_id, file_unique_id, budget = select_for_operation(user_states.get(chat_id), operation)
+    data = fetch_file(file_id, file_unique_id)
+    result, stages = animation.render_animation(data, func, args, budget, scheduler.imap_cpu)
+    record_encoding(stages, result)
+    return result
+
+def ascii_and_send(message):
+    """
+    Функция преобразования изображения в ASCII-арт и отправки.
+    Длинный ASCII-арт отправляется несколькими сообщениями (не больше ASCII_MAX_MESSAGES).
+    """
+    # Используем пользовательские символы или стандартные, ширину и порядок символов - из настроек
+    args = actions.ascii_args(user_states.get(message.chat.id))
+
+    # Готовый текст для этой фотографии и параметров берем из кэша результатов
+    key = result_key(message.chat.id, "ascii", *args)
+    ascii_art = result_cache.get(key)
+    if ascii_art is None:
+        image = load_photo(message.chat.id, "ascii")
+
+        # Передаем пользовательские символы
+        with metrics.stage("transform"):
+            ascii_art = scheduler.run_cpu(image_to_ascii, image, *args)
+        result_cache.put(key, ascii_art)
+    with metrics.stage("upload"):
+        for text in actions.ascii_messages(ascii_art):
+            bot.send_message(message.chat.id, text, parse_mode="MarkdownV2")
+
+def album_and_send(message, job):
+    """
+    Функция обработки всех фотографий альбома и отправки результатов одним альбомом.
+    Фотографии загружаются параллельно, обрабатываются параллельно в пуле процессов, а результаты отправляются
+    одним вызовом send_media_group. Уже отправлявшиеся результаты берутся из кэша результатов по file_id.
+    job: задание для альбома (actions.plan_job)
+    """
+    from telebot.apihelper import ApiTelegramException
+
+    chat_id = message.chat.id
+    selected, keys, contents, missing = album_selection(chat_id, job)
+    if missing:
+        images = scheduler.map_io(lambda index: load_selected(selected[index], job.operation), missing)
+        count = len(images)
+        results = scheduler.map_cpu(apply_and_encode_timed, [job.func] * count, images, [job.args] * count,
+                                    [job.profile] * count)
+        for index, (data, stages, baseline) in zip(missing, results):
+            record_encoding(stages, data, baseline)
+            contents[index] = actions.result_file(data, job.profile, f"image{index + 1}")
+
+    try:
+        file_ids = send_album(chat_id, contents, job.profile)
+    except ApiTelegramException:
+        if len(missing) == len(keys):
+            raise
+        # Сохраненные file_id больше не принимаются - обрабатываем все фотографии заново
+        for key in keys:
+            result_cache.delete(key)
+        album_and_send(message, job)
+        return
+    for index in missing:
+        result_cache.put(keys[index], file_ids[index])
+
+def album_selection(chat_id, job):
+    """
+    Варианты фотографий альбома для операции, ключи их результатов, уже отправленные результаты (file_id или None)
+    и номера фотографий, которые нужно обработать.
+    Ключи совпадают с ключами для отдельной фотографии (result_key), поэтому кэш результатов общий.
+    """
+    selected = [select_sizes_for_operation(sizes, job.operation) for sizes in user_states.get(chat_id).album]
+    keys = [result_cache.make_key(file_unique_id, job.operation, job.args + (budget,))
+            for _, file_unique_id, budget in selected]
+    contents = [result_cache.get(key) for key in keys]
+    missing = [index for index, content in enumerate(contents) if content is None]
+    return selected, keys, contents, missing
+
+def send_album(chat_id, contents, profile="photo"):
+    """
+    Отправка результатов одним альбомом. Стикеры отправляются как документы.
+    contents: байты или file_id для каждой фотографии
+    Возвращает file_id отправленных файлов.
+    """
+    from telebot import types
+
+    media_type = types.InputMediaDocument if encoding.is_document(profile) else types.InputMediaPhoto
+    with metrics.stage("upload"):
+        sent = bot.send_media_group(chat_id, [media_type(content) for content in contents])
+    return [actions.sent_file_id(message) for message in sent]
 
 def random_joke_send(message):
     """
@@ -459,5 +720,143 @@ def flip_coin_send(message):
     result = random.choice(["Орел", "Решка"])
     bot.send_message(message.chat.id, f"Монетка подброшена: {result}!")
 
-# Запуск бота
-bot.polling(none_stop=True)
+def load_settings():
+    """
+    Загрузка настроек: переменные из файла .env, токен бота и адрес Bot API
+    """
+    global TOKEN, API_URL
+    from dotenv import load_dotenv
+
+    load_dotenv()  # Загружаем переменные из .env файла
+    TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+    # Адрес Bot API можно заменить, например, на локальный тестовый сервер (benchmarks/fake_bot_api.py)
+    API_URL = os.getenv('TELEGRAM_API_URL')
+
+def configure_api(helper):
+    """
+    Подключение модуля запросов telebot (apihelper или asyncio_helper) к адресу Bot API из TELEGRAM_API_URL
+    """
+    if API_URL:
+        helper.API_URL = API_URL.rstrip('/') + '/bot{0}/{1}'
+        helper.FILE_URL = API_URL.rstrip('/') + '/file/bot{0}/{1}'
+
+def create_components():
+    """
+    Создание общих объектов бота по настройкам из переменных окружения: ограничение частоты отправки,
+    хранилище состояний, планировщик, кэши, метрики. Их использует и асинхронный бот (модуль async_bot).
+    Повторный вызов ничего не делает.
+    """
+    global rate_limiter, user_states, scheduler, download_cache, result_cache, metrics, in_flight, album_buffer
+    if user_states is not None:
+        return
+    load_settings()
+
+    # Все запросы к Bot API проходят через ограничение частоты (модуль dispatch): корзины токенов для каждого чата
+    # и общая, ответы на нажатия кнопок - раньше загрузки изображений, повтор после ответа 429
+    rate_limiter = dispatch.create_rate_limiter(keep_texts=ERROR_NOTICES)
+
+    # Большие буферы (изображения, загруженные файлы) выделяются через mmap и сразу возвращаются системе
+    limits.tune_allocator()
+
+    # Состояние пользователя хранится в хранилище состояний (в памяти или в SQLite, модуль state_store)
+    user_states = create_state_store()
+
+    # Планировщик обработки: задания выполняются вне потока опроса, преобразования - в пуле процессов
+    scheduler = ProcessingScheduler(
+        max_pending=int(os.getenv('WORKER_QUEUE_SIZE', 100)),
+        io_workers=int(os.getenv('WORKER_IO_THREADS', 8)),
+        cpu_workers=int(os.environ['WORKER_PROCESSES']) if os.getenv('WORKER_PROCESSES') else None,
+        # Память каждого процесса пула ограничена: преобразование не может занять больше JOB_MEMORY_LIMIT_MB
+        initializer=limits.init_worker,
+    )
+
+    # Кэш загруженных фотографий, общий для всех функций отправки
+    download_cache = DownloadCache(
+        max_bytes=int(os.getenv('DOWNLOAD_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+        ttl=int(os.getenv('DOWNLOAD_CACHE_TTL', 600)),
+        disk_dir=os.getenv('DOWNLOAD_CACHE_DIR'),
+        max_image_bytes=int(os.getenv('DOWNLOAD_CACHE_IMAGE_BYTES', 256 * 1024 * 1024)),
+    )
+
+    # Кэш результатов: file_id отправленных изображений и тексты ASCII-арта
+    result_cache = ResultCache(
+        max_entries=int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 10000)),
+        path=os.getenv('RESULT_CACHE_PATH'),
+    )
+
+    # Метрики этапов обработки (модуль metrics): включаются, если задан порт HTTP-сервера метрик или журнал
+    metrics = Metrics(
+        enabled=bool(os.getenv('METRICS_PORT') or os.getenv('METRICS_LOG')),
+        log=bool(os.getenv('METRICS_LOG')),
+        profile_rate=float(os.getenv('METRICS_PROFILE_RATE', 0)),
+    )
+    metrics.add_collector('scheduler', scheduler.stats)
+    metrics.add_collector('download_cache', download_cache.stats)
+    metrics.add_collector('result_cache', result_cache.stats)
+
+    # Задания, которые сейчас выполняются: повторное нажатие той же кнопки не запускает второе задание
+    in_flight = dispatch.InFlight()
+    metrics.add_collector('dispatch', lambda: {**rate_limiter.stats(), **in_flight.stats()})
+
+    # Фотографии альбомов собираются вместе: альбом считается полученным, если новых фотографий нет ALBUM_DELAY
+    # секунд
+    album_buffer = MediaGroupBuffer(delay=float(os.getenv('ALBUM_DELAY', 1.0)))
+
+def create_app(token=None, handlers=True):
+    """
+    Фабрика приложения: создает общие объекты и бота TeleBot (модуль telebot загружается только здесь).
+    token: токен бота (по умолчанию - TELEGRAM_BOT_TOKEN); без токена бот создается, но не может обращаться
+    к Bot API
+    handlers: регистрировать ли обработчики сообщений и нажатий кнопок
+    Повторный вызов возвращает уже созданного бота.
+    """
+    global bot
+    if bot is not None:
+        return bot
+    create_components()
+    from telebot import TeleBot, apihelper
+
+    configure_api(apihelper)
+    # Обработчики не ждут токен своего чата в общих потоках: такие запросы ждут в очереди чата планировщика
+    dispatch.install(rate_limiter, apihelper, scheduler)
+    token = token or TOKEN or ''
+    bot = TeleBot(token, validate_token=bool(token))
+    if handlers:
+        register_handlers()
+    return bot
+
+def register_handlers():
+    """
+    Регистрация обработчиков бота (порядок важен: первым срабатывает первый подходящий обработчик)
+    """
+    # Команды /start и /help
+    bot.register_message_handler(send_welcome, commands=['start', 'help'])
+    # Получение изображения
+    bot.register_message_handler(handle_photo, content_types=['photo'])
+    # Изображения, GIF и стикеры, присланные не как фотография
+    bot.register_message_handler(handle_file, content_types=['document', 'animation', 'sticker', 'video_note'])
+    # Ввод пользовательского набора символов
+    bot.register_message_handler(set_ascii_chars, func=lambda message: user_states.is_awaiting_charset(message.chat.id))
+    # Нажатие кнопок
+    bot.register_callback_query_handler(callback_query, func=lambda call: True)
+
+def main():
+    """
+    Запуск бота: опрос обновлений до остановки, затем запись состояний и кэша результатов
+    """
+    create_app()
+    if not TOKEN:
+        raise SystemExit("Не задан токен бота: переменная окружения TELEGRAM_BOT_TOKEN или файл .env")
+    if metrics.log:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if os.getenv('METRICS_PORT'):
+        metrics.serve(os.getenv('METRICS_HOST', '127.0.0.1'), int(os.environ['METRICS_PORT']))
+    try:
+        bot.polling(none_stop=True)
+    finally:
+        user_states.close()  # Записываем накопленные изменения состояний
+        result_cache.close()
+
+# Запуск бота (процессы пула обработки импортируют модуль повторно, поэтому запуск только из основного модуля)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Запуск бота в несколько процессов.
+
+Обычный запуск (python bot.py) - один процесс: опрос обновлений и обработчики telebot работают в одном
+процессе и не используют больше одного ядра для приема и разбора сообщений. В режиме кластера:
+- один процесс (ingress) получает обновления из Bot API и кладет их в очередь (модуль work_queue), ничего не
+обрабатывая. Номер последнего принятого обновления хранится в очереди, поэтому после перезапуска
+обновления не теряются и не обрабатываются дважды;
+- N процессов-обработчиков (run_worker) забирают обновления своих сегментов и передают их обработчикам
+модуля bot (bot.process_new_updates). Сегмент выбирается по идентификатору чата, поэтому все обновления
+одного чата обрабатывает один процесс, строго по порядку;
+- состояние чатов хранится в SQLite (STATE_BACKEND=sqlite по умолчанию в этом режиме): оно общее для
+перезапусков и смены количества обработчиков, а в каждый момент чат изменяет только один процесс.
+
+Остановка (SIGTERM или Ctrl+C) выполняется без потери заданий: ingress перестает принимать обновления
+(полученные, но еще не переданные в очередь обновления не подтверждаются и будут получены снова), обработчики
+дорабатывают задания своих сегментов и задания планировщика (не дольше CLUSTER_DRAIN_TIMEOUT секунд), записывают
+состояния и завершаются. Задания, оставшиеся в очереди SQLite, будут обработаны после следующего запуска.
+
+Запуск:
+    python cluster.py [--workers 4] [--backend sqlite|memory]
+С --backend memory обработчики работают потоками в одном процессе (очередь в памяти, для отладки).
+
+Настройки: CLUSTER_WORKERS (по умолчанию - число ядер), CLUSTER_DRAIN_TIMEOUT, CLUSTER_POLL_TIMEOUT (длинный
+опрос getUpdates, с), а также настройки очереди WORK_QUEUE_* (модуль work_queue). Если WORKER_PROCESSES не задан,
+пул процессов каждого процесса-обработчика получает свою долю ядер, а если не задан DISPATCH_GLOBAL_RATE -
+свою долю общего ограничения частоты отправки DISPATCH_TOTAL_RATE (по умолчанию 30 запросов в секунду).
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from multiprocessing.connection import wait
+
+from work_queue import create_work_queue, worker_shards
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv('CLUSTER_WORKERS') or os.cpu_count() or 1)
+DRAIN_TIMEOUT = float(os.getenv('CLUSTER_DRAIN_TIMEOUT', 30))
+POLL_TIMEOUT = int(os.getenv('CLUSTER_POLL_TIMEOUT', 20))
+
+# Сколько заданий обработчик забирает из очереди за раз
+CLAIM_BATCH = 10
+
+
+def ingress(queue, stop, lock, poll_timeout=POLL_TIMEOUT):
+    """
+    Прием обновлений: длинный опрос getUpdates и запись обновлений в очередь.
+    Обновления передаются в очередь как есть (словари Bot API), без разбора в объекты telebot.
+    lock удерживается на время записи в очередь: после остановки (stop) новые обновления в очередь не попадают.
+    """
+    from telebot import apihelper
+
+    import bot
+
+    bot.configure_api(apihelper)
+    offset = queue.last_update_id() + 1
+    while not stop.is_set():
+        try:
+            updates = apihelper.get_updates(bot.TOKEN, offset, timeout=poll_timeout,
+                                            long_polling_timeout=poll_timeout)
+        except Exception:
+            logger.exception("Ошибка при получении обновлений")
+            stop.wait(1)
+            continue
+        with lock:
+            if stop.is_set() or not updates:
+                continue
+            queue.put(updates)
+        offset = updates[-1]['update_id'] + 1
+
+
+def consume(queue, shards, drain, drain_timeout=DRAIN_TIMEOUT):
+    """
+    Обработка обновлений сегментов shards по порядку.
+    После сигнала drain задания сегментов дорабатываются, пока очередь не опустеет или не истечет drain_timeout.
+    """
+    from telebot import types
+
+    import bot
+
+    deadline = None
+    while True:
+        if deadline is None and drain.is_set():
+            deadline = time.monotonic() + drain_timeout
+        jobs = queue.claim(shards, CLAIM_BATCH, timeout=0.5)
+        if not jobs and deadline is not None:
+            return
+        for job_id, update in jobs:
+            try:
+                bot.bot.process_new_updates([types.Update.de_json(update)])
+            except Exception:
+                logger.exception("Ошибка при обработке обновления %s", update.get('update_id'))
+            queue.ack([job_id])
+        if deadline is not None and time.monotonic() > deadline:
+            logger.warning("Задания остались в очереди после остановки: %s", queue.pending(shards))
+            return
+
+
+def stop_bot(bot, timeout=DRAIN_TIMEOUT):
+    """
+    Завершение обработчика: дожидается альбомов, которые еще собираются, и заданий планировщика,
+    затем записывает состояния и кэш результатов
+    """
+    deadline = time.monotonic() + timeout
+    # Альбом завершается по таймеру (finish_album) через ALBUM_DELAY после последней фотографии
+    while len(bot.album_buffer) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if not bot.scheduler.wait_idle(max(0.0, deadline - time.monotonic())):
+        logger.warning("Не все задания планировщика выполнены до остановки: %s", bot.scheduler.stats())
+    bot.scheduler.shutdown(wait=False)
+    bot.user_states.close()
+    bot.result_cache.close()
+
+
+def watch_parent(drain):
+    """
+    Если ingress завершился аварийно, обработчик дорабатывает свои задания и тоже завершается
+    """
+    wait([multiprocessing.parent_process().sentinel])
+    drain.set()
+
+
+def run_worker(index, workers, drain):
+    """
+    Процесс-обработчик с номером index из workers
+    """
+    # Сигналы остановки обрабатывает ingress: обработчик завершается, когда очередь доработана (drain)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f'worker-{index} %(levelname)s %(message)s')
+
+    threading.Thread(target=watch_parent, args=(drain,), name='cluster-parent', daemon=True).start()
+
+    import bot
+
+    # Обновления одного чата обрабатываются по порядку в этом потоке, а не в пуле потоков telebot
+    bot.create_app().threaded = False
+    queue = create_work_queue()
+    shards = worker_shards(index, workers, queue.shards)
+    released = queue.release(shards)
+    if released:
+        logger.info("Возвращены в очередь незавершенные задания: %s", released)
+    try:
+        consume(queue, shards, drain)
+    finally:
+        stop_bot(bot)
+        queue.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=WORKERS, help="количество обработчиков")
+    parser.add_argument('--backend', default=os.getenv('WORK_QUEUE_BACKEND', 'sqlite'), choices=('sqlite', 'memory'),
+                        help="очередь: sqlite - обработчики-процессы, memory - обработчики-потоки")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='ingress %(levelname)s %(message)s')
+
+    # Настройки из файла .env загружаются сразу, а значения по умолчанию для кластера задаются до создания бота
+    # (в том числе в процессах-обработчиках, они наследуют окружение)
+    import bot
+    bot.load_settings()
+    if args.backend == 'sqlite':
+        os.environ.setdefault('STATE_BACKEND', 'sqlite')
+        os.environ.setdefault('WORKER_PROCESSES', str(max(1, (os.cpu_count() or 1) // args.workers)))
+        # Общее ограничение частоты отправки (модуль dispatch) делится между процессами; ограничение чата точное,
+        # так как чат обслуживает один процесс
+        os.environ.setdefault('DISPATCH_GLOBAL_RATE', str(float(os.getenv('DISPATCH_TOTAL_RATE', 30)) / args.workers))
+    queue = create_work_queue(args.backend)
+    if args.workers > queue.shards:
+        parser.error(f"--workers must not exceed WORK_QUEUE_SHARDS ({queue.shards})")
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    if args.backend == 'memory':
+        bot.create_app().threaded = False
+        drain = threading.Event()
+        workers = [threading.Thread(target=consume, args=(queue, worker_shards(index, args.workers, queue.shards),
+                                                          drain), name=f'cluster-worker-{index}')
+                   for index in range(args.workers)]
+    else:
+        # Процессы запускаются заново (spawn), а не копией ingress: соединения SQLite и HTTP не наследуются
+        context = multiprocessing.get_context('spawn')
+        drain = context.Event()
+        workers = [context.Process(target=run_worker, args=(index, args.workers, drain), name=f'cluster-worker-{index}')
+                   for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    lock = threading.Lock()
+    receiver = threading.Thread(target=ingress, args=(queue, stop, lock), name='cluster-ingress', daemon=True)
+    receiver.start()
+    logger.info("Запущено обработчиков: %s (очередь %s)", args.workers, args.backend)
+    while not stop.wait(1):
+        pass
+
+    logger.info("Остановка: обработчики дорабатывают очередь")
+    with lock:
+        drain.set()
+    for worker in workers:
+        worker.join()
+    if args.backend == 'memory':
+        stop_bot(bot)
+    queue.close()
+    raise SystemExit(1 if any(getattr(worker, 'exitcode', 0) for worker in workers) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Цветовые палитры для поточечных операций (инверсия, тепловая карта и другие).
+
+Раньше convert_to_heatmap при каждом вызове строил таблицы градиента в ImageOps.colorize, а invert_colors
+перед инверсией всегда преобразовывал изображение в RGB. Таблицы палитр вычисляются один раз и кэшируются,
+а применяются к изображению одним проходом на уровне C:
+- channel: таблица для каждого канала (инверсия) применяется вызовом Image.point в исходном режиме
+изображения (L, RGB или RGBA - альфа-канал не меняется);
+- gradient: цвет зависит только от яркости. Изображение переводится в оттенки серого (для JPEG, декодированного
+сразу в режиме L, этот шаг ничего не стоит), к нему присоединяется палитра (putpalette), и при переводе в RGB
+каждый пиксель заменяется цветом из палитры. Image.point не может превратить один канал в три, поэтому
+вместо него используется палитра.
+
+Функции:
+- colors: таблица градиента яркость -> (r, g, b);
+- palette: та же таблица в виде палитры для putpalette;
+- channel_lut: таблица для Image.point (256 значений на канал);
+- colorize: применяет таблицу яркость -> (r, g, b) к изображению;
+- apply_colormap: применяет палитру по названию.
+"""
+from functools import lru_cache
+
+from PIL import Image
+
+# Палитры: название -> (вид, подпись кнопки, опорные цвета градиента от темного к светлому)
+COLORMAPS = {
+    "heatmap": ("gradient", "Heatmap", ((0, 0, 255), (255, 0, 0))),
+    "inverted": ("channel", "Inverted", None),
+    "viridis": ("gradient", "Viridis", ((68, 1, 84), (71, 44, 122), (59, 81, 139), (44, 113, 142), (33, 144, 141),
+                                        (39, 173, 129), (92, 200, 99), (170, 220, 50), (253, 231, 37))),
+    "sepia": ("gradient", "Sepia", ((20, 10, 0), (112, 66, 20), (196, 160, 110), (255, 240, 200))),
+    "thermal": ("gradient", "Thermal", ((0, 0, 0), (30, 0, 120), (140, 0, 160), (220, 40, 60), (255, 140, 0),
+                                        (255, 220, 60), (255, 255, 255))),
+}
+
+
+def is_gradient(name):
+    return COLORMAPS[name][0] == "gradient"
+
+
+@lru_cache(maxsize=None)
+def colors(name):
+    """
+    Таблица градиента: яркость -> (r, g, b).
+    Цвета между опорными точками интерполируются линейно с округлением вниз, как в ImageOps.colorize,
+    поэтому тепловая карта совпадает с прежней.
+    """
+    _, _, stops = COLORMAPS[name]
+    if stops is None:
+        raise ValueError(f"Palette {name} is not a gradient")
+    positions = [round(index * 255 / (len(stops) - 1)) for index in range(len(stops))]
+    table = []
+    for segment in range(len(stops) - 1):
+        start, end = positions[segment], positions[segment + 1]
+        low, high = stops[segment], stops[segment + 1]
+        for value in range(start, end):
+            table.append(tuple(a + (value - start) * (b - a) // (end - start) for a, b in zip(low, high)))
+    table.append(stops[-1])
+    return tuple(table)
+
+
+@lru_cache(maxsize=None)
+def palette(name):
+    return table_palette(colors(name))
+
+
+def table_palette(table):
+    """
+    Таблица яркость -> (r, g, b) в виде палитры для putpalette (r0, g0, b0, r1, ...)
+    """
+    return bytes(channel for rgb in table for channel in rgb)
+
+
+@lru_cache(maxsize=None)
+def channel_lut(name, bands=3):
+    """
+    Таблица для Image.point: 256 значений для каждого из bands каналов. Альфа-канал (четвертый) не меняется.
+    """
+    if name != "inverted":
+        raise ValueError(f"Palette {name} has no per-channel table")
+    inverted = tuple(255 - value for value in range(256))
+    lut = inverted * min(bands, 3)
+    if bands == 4:
+        lut += tuple(range(256))
+    return lut
+
+
+def colorize(image, table_or_palette):
+    """
+    Заменяет каждый пиксель цветом из таблицы по его яркости. Возвращает изображение RGB.
+    table_or_palette: палитра (bytes) или таблица яркость -> (r, g, b)
+    """
+    if not isinstance(table_or_palette, bytes):
+        table_or_palette = table_palette(table_or_palette)
+    # convert создает копию и для изображения в режиме L, поэтому putpalette не меняет исходное изображение
+    gray = image.convert('L')
+    gray.putpalette(table_or_palette)
+    return gray.convert('RGB')
+
+
+def apply_colormap(image, name):
+    """
+    Применяет палитру по названию (COLORMAPS)
+    """
+    if is_gradient(name):
+        return colorize(image, palette(name))
+    if image.mode not in ('L', 'RGB', 'RGBA'):
+        image = image.convert('RGB')
+    return image.point(channel_lut(name, len(image.getbands())))
@@ -0,0 +1,462 @@
+"""
+Отправка запросов к Bot API с ограничением частоты.
+
+Telegram ограничивает частоту отправки сообщений: примерно одно сообщение в секунду в один чат (20 в минуту
+в группу) и около 30 в секунду всего. Раньше send_photo, send_message и answer_callback_query вызывались
+напрямую, поэтому серия нажатий кнопок приводила к ответам 429 Too Many Requests, а повторные попытки - к новым
+ошибкам. Этот модуль - слой между ботом и HTTP-запросами telebot:
+- RateLimiter: корзины токенов (token bucket) для каждого чата и общая. Запрос ждет токен в корзине своего чата,
+затем в общей корзине; в общей корзине запросы ждут по приоритету: ответы на нажатия кнопок
+(answerCallbackQuery) - первыми, загрузка изображений (sendPhoto, sendDocument, sendAnimation,
+sendMediaGroup) - последней;
+- обработчики не копят долг корзины чата лишними ответами: ответ обработчика отбрасывается, только если такой же
+текст (sendMessage без клавиатуры) уже ждет отправки в этот чат, а sendChatAction - если долг корзины больше
+chat_burst токенов. Сообщения с клавиатурой (reply_markup) и сообщения об ошибках (keep_texts) отправляются всегда;
+- обработчики telebot (два общих потока или цикл обработчика кластера) не ждут токен своего чата: если его
+нет, install ставит запрос в очередь этого чата в планировщике (модуль scheduler), а ответ приходит позже.
+Запросы из заданий очереди чата ждут токен там же и не отбрасываются - это результаты обработки;
+- ответ 429 приостанавливает корзину чата (или общую, если в запросе нет чата) на retry_after секунд, после
+чего запрос повторяется (не больше max_retries раз);
+- install и install_async подключают ограничение ко всем запросам синхронного и асинхронного telebot
+(функции apihelper._make_request и asyncio_helper._process_request), поэтому обработчики бота не меняются;
+- InFlight: повторное нажатие той же кнопки для той же фотографии, пока задание еще выполняется, не запускает
+второе задание (результат первого придет один раз).
+
+Ядро RateLimiter не блокирует поток: reserve только забирает токен и возвращает момент, когда можно отправлять
+запрос, wait и acquire ждут через time.sleep, acquire_async - через asyncio.sleep.
+
+create_rate_limiter выбирает ограничения по переменным окружения (0 - без ограничения):
+- DISPATCH_GLOBAL_RATE: запросов в секунду всего;
+- DISPATCH_CHAT_RATE, DISPATCH_CHAT_BURST: сообщений в секунду в один чат и сколько можно отправить сразу;
+- DISPATCH_GROUP_RATE: сообщений в секунду в группу (идентификатор чата меньше нуля);
+- DISPATCH_MAX_RETRIES: повторов после ответа 429.
+"""
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from scheduler import current_chat
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов в общей корзине (меньше - раньше)
+HIGH, NORMAL, LOW = 0, 1, 2
+
+# Методы с загрузкой файлов: отправляются после ответов на нажатия и текстовых сообщений
+UPLOAD_METHODS = frozenset(("sendPhoto", "sendDocument", "sendAnimation", "sendMediaGroup", "sendVideo",
+                            "sendAudio", "sendVoice", "sendSticker"))
+
+# Запросы, которые обработчик может не отправить, если в чат уже отправлено слишком много сообщений
+DROPPABLE_METHODS = frozenset(("sendChatAction",))
+
+# Ограничиваются запросы, которые что-то отправляют пользователю; getUpdates, getFile и другие - нет
+LIMITED_PREFIXES = ("send", "answer", "edit", "copy", "forward")
+
+
+def request_priority(method_name):
+    if method_name.startswith("answer"):
+        return HIGH
+    return LOW if method_name in UPLOAD_METHODS else NORMAL
+
+
+def is_limited(method_name):
+    return method_name.startswith(LIMITED_PREFIXES)
+
+
+def request_chat(params):
+    """
+    Чат запроса. telebot передает chat_id то числом, то строкой (например, при загрузке файлов).
+    """
+    chat_id = (params or {}).get('chat_id')
+    if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+        return int(chat_id)
+    return chat_id
+
+
+def retry_after(error):
+    """
+    Время ожидания из ответа 429 (секунды) или None для других ошибок (ApiTelegramException)
+    """
+    if error.error_code != 429:
+        return None
+    return (error.result_json.get('parameters') or {}).get('retry_after', 1)
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше capacity
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def delay(self, now):
+        """
+        Сколько ждать до появления токена (0 - токен есть)
+        """
+        self._refill(now)
+        if now < self._paused_until:
+            return self._paused_until - now
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self):
+        self._tokens -= 1
+
+    def reserve(self, now, max_debt=None):
+        """
+        Забирает токен, даже если его еще нет (в долг). Возвращает, сколько ждать до отправки:
+        запросы, пришедшие позже, ждут дольше, поэтому порядок сохраняется.
+        max_debt: сколько токенов можно взять в долг; None - без ограничения. Если долг превысил бы max_debt,
+        токен не забирается и возвращается None.
+        """
+        self._refill(now)
+        if max_debt is not None and self._tokens - 1 < -max_debt:
+            return None
+        self._tokens -= 1
+        wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        return max(wait, self._paused_until - now)
+
+    def pause(self, now, seconds):
+        self._paused_until = max(self._paused_until, now + seconds)
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RateLimiter:
+    """
+    Ограничение частоты запросов к Bot API
+    global_rate: запросов в секунду всего (0 - без ограничения)
+    chat_rate, chat_burst: запросов в секунду в один чат и сколько можно отправить сразу (0 - без ограничения)
+    group_rate: запросов в секунду в группу
+    max_retries: повторов после ответа 429
+    max_chats: сколько корзин чатов хранить (неактивные вытесняются, их корзины все равно полные)
+    keep_texts: сообщения об ошибках, которые отправляются, даже если такое же сообщение уже ждет отправки
+    Запросы reserve с droppable берут в долг не больше chat_burst токенов корзины чата.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=5, group_rate=20 / 60, max_retries=3,
+                 max_chats=10000, keep_texts=()):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.keep_texts = frozenset(keep_texts)
+        self._lock = threading.Lock()
+        self._global = TokenBucket(global_rate, max(1, global_rate)) if global_rate else None
+        self._chats = OrderedDict()
+        self._queued = set()  # (чат, текст) ответов обработчиков, которые ждут отправки
+        self._waiters = []  # очередь ожидающих общей корзины: [приоритет, номер]
+        self._sequence = itertools.count()
+        self._counters = dict.fromkeys(('requests', 'delayed', 'deferred', 'dropped', 'rate_limited', 'retries'), 0)
+        self._wait_time = 0.0
+
+    def acquire(self, chat_id=None, priority=NORMAL, droppable=False, text=None):
+        """
+        Ждет разрешения на запрос в чат chat_id (None - запрос без чата).
+        Возвращает False, если запрос отброшен (droppable и text, см. reserve).
+        """
+        ready_at = self.reserve(chat_id, droppable, text)
+        if ready_at is None:
+            return False
+        self.wait(ready_at, priority, chat_id, text)
+        return True
+
+    async def acquire_async(self, chat_id=None, priority=NORMAL, droppable=False, text=None):
+        # asyncio нужен только асинхронному боту и не загружается вместе с синхронным
+        import asyncio
+
+        ready_at = self.reserve(chat_id, droppable, text)
+        if ready_at is None:
+            return False
+        try:
+            for delay in self._wait(ready_at, priority):
+                await asyncio.sleep(delay)
+        finally:
+            self._release(chat_id, text)
+        return True
+
+    def repeat_text(self, method_name, params):
+        """
+        Текст ответа обработчика, который не нужно отправлять повторно, пока такой же ответ ждет отправки в этот
+        чат: sendMessage без клавиатуры (reply_markup), кроме сообщений об ошибках (keep_texts).
+        None - запрос отправляется всегда.
+        """
+        params = params or {}
+        if method_name != "sendMessage" or params.get('reply_markup'):
+            return None
+        text = params.get('text')
+        return None if text in self.keep_texts else text
+
+    def reserve(self, chat_id=None, droppable=False, text=None):
+        """
+        Забирает токен в корзине чата и возвращает момент (time.monotonic), начиная с которого можно отправлять
+        запрос, или None, если запрос отброшен:
+        droppable - запрос можно не отправлять, если долг корзины больше chat_burst токенов;
+        text - текст ответа (repeat_text): запрос отбрасывается, если такой же ответ уже ждет отправки в этот чат.
+        Текст считается ждущим отправки до конца wait.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._counters['requests'] += 1
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            if bucket is None:
+                return now
+            key = (chat_id, text)
+            if text is not None and key in self._queued:
+                self._counters['dropped'] += 1
+                return None
+            delay = bucket.reserve(now, self.chat_burst if droppable else None)
+            if delay is None:
+                self._counters['dropped'] += 1
+                return None
+            if text is not None:
+                self._queued.add(key)
+        return now + delay
+
+    def wait(self, ready_at, priority=NORMAL, chat_id=None, text=None):
+        """
+        Ждет момента ready_at (reserve), затем токена общей корзины. chat_id и text - те же, что в reserve.
+        """
+        try:
+            for delay in self._wait(ready_at, priority):
+                time.sleep(delay)
+        finally:
+            self._release(chat_id, text)
+
+    def count_deferred(self):
+        with self._lock:
+            self._counters['deferred'] += 1
+
+    def pause(self, chat_id, seconds):
+        """
+        Приостанавливает отправку в чат (или всю отправку, если chat_id - None) после ответа 429
+        """
+        with self._lock:
+            self._counters['rate_limited'] += 1
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+            if bucket is not None:
+                bucket.pause(time.monotonic(), seconds)
+
+    def count_retry(self):
+        with self._lock:
+            self._counters['retries'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(waiting=len(self._waiters), chats=len(self._chats), queued_texts=len(self._queued),
+                         wait_ms=self._wait_time * 1000)
+        return stats
+
+    def _release(self, chat_id, text):
+        if text is not None:
+            with self._lock:
+                self._queued.discard((chat_id, text))
+
+    def _wait(self, ready_at, priority):
+        """
+        Генератор пауз (в секундах), которые нужно выждать до запроса
+        """
+        started = time.monotonic()
+        if ready_at > started:
+            yield ready_at - started
+        if self._global is not None:
+            yield from self._acquire_global(priority)
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            with self._lock:
+                self._counters['delayed'] += 1
+                self._wait_time += waited
+
+    def _acquire_global(self, priority):
+        with self._lock:
+            if not self._waiters and self._global.delay(time.monotonic()) <= 0:
+                self._global.take()
+                return
+            entry = [priority, next(self._sequence)]
+            heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                with self._lock:
+                    delay = self._global.delay(time.monotonic())
+                    if self._waiters[0] is entry:
+                        if delay <= 0:
+                            self._global.take()
+                            return
+                    else:
+                        # Первым токен получает запрос с наивысшим приоритетом, остальные проверяют позже
+                        delay += 1 / self._global.rate
+                yield delay
+        finally:
+            with self._lock:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            self._chats.move_to_end(chat_id)
+            return bucket
+        group = isinstance(chat_id, int) and chat_id < 0
+        rate = self.group_rate if group else self.chat_rate
+        if not rate:
+            return None
+        bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return bucket
+
+
+def rewind(files):
+    """
+    Перематывает загружаемые файлы в начало перед повторной отправкой
+    """
+    for value in (files or {}).values():
+        content = value[1] if isinstance(value, tuple) else value
+        if hasattr(content, 'seek'):
+            content.seek(0)
+
+
+def install(limiter, helper=None, scheduler=None):
+    """
+    Подключает ограничение частоты ко всем запросам синхронного telebot.
+    scheduler: планировщик (ProcessingScheduler); если задан, запрос обработчика, которому нужно ждать токен
+    своего чата, выполняется позже в очереди этого чата, а обработчик сразу получает None
+    """
+    if helper is None:
+        from telebot import apihelper as helper
+    make_request = helper._make_request
+
+    def send(token, method_name, method, params, files, chat_id, ready_at, text=None):
+        for attempt in itertools.count():
+            if attempt:
+                ready_at = limiter.reserve(chat_id)
+            limiter.wait(ready_at, request_priority(method_name), chat_id, text)
+            text = None
+            try:
+                # telebot изменяет параметры запроса, поэтому для повтора передается копия
+                return make_request(token, method_name, method, params=dict(params or {}), files=files)
+            except helper.ApiTelegramException as error:
+                delay = retry_after(error)
+                if delay is None or attempt >= limiter.max_retries:
+                    raise
+                logger.warning("%s: 429, повтор через %s с", method_name, delay)
+                limiter.pause(chat_id, delay)
+                limiter.count_retry()
+                rewind(files)
+
+    def limited_request(token, method_name, method='get', params=None, files=None):
+        if not is_limited(method_name):
+            return make_request(token, method_name, method, params=params, files=files)
+        chat_id = request_chat(params)
+        # Задания очереди чата отправляют результаты обработки: они ждут токен и не отбрасываются
+        queued = chat_id is not None and current_chat() == chat_id
+        text = None if queued else limiter.repeat_text(method_name, params)
+        ready_at = limiter.reserve(chat_id, not queued and method_name in DROPPABLE_METHODS, text)
+        if ready_at is None:
+            logger.info("%s: ответ в чат %s отброшен: такой же ответ уже ждет отправки", method_name, chat_id)
+            return None
+        if scheduler is not None and not queued and ready_at > time.monotonic():
+            # Поток обработчика не ждет токен чата: запрос ждет в очереди чата вместе с его заданиями
+            if scheduler.submit(chat_id, send, token, method_name, method, dict(params or {}), files, chat_id,
+                                ready_at, text):
+                limiter.count_deferred()
+                return None
+            # Очередь планировщика переполнена: ответ не теряется, а ждет токен в потоке обработчика
+            logger.warning("%s: очередь планировщика заполнена, ответ в чат %s ждет в потоке обработчика",
+                           method_name, chat_id)
+        return send(token, method_name, method, params, files, chat_id, ready_at, text)
+
+    helper._make_request = limited_request
+
+
+def install_async(limiter, helper=None):
+    """
+    Подключает ограничение частоты ко всем запросам асинхронного telebot.
+    Обработчики ждут токен в своих задачах asyncio и не занимают общих потоков; повторные ответы и sendChatAction
+    отбрасываются, как и в синхронном боте. Задания чата отмечены scheduler.chat_queue.
+    """
+    if helper is None:
+        from telebot import asyncio_helper as helper
+    process_request = helper._process_request
+
+    async def limited_request(token, url, method='get', params=None, files=None, **kwargs):
+        if not is_limited(url):
+            return await process_request(token, url, method, params=params, files=files, **kwargs)
+        chat_id = request_chat(params)
+        queued = chat_id is not None and current_chat() == chat_id
+        text = None if queued else limiter.repeat_text(url, params)
+        droppable = not queued and url in DROPPABLE_METHODS
+        for attempt in itertools.count():
+            if not await limiter.acquire_async(chat_id, request_priority(url), droppable and not attempt,
+                                               None if attempt else text):
+                logger.info("%s: ответ в чат %s отброшен: такой же ответ уже ждет отправки", url, chat_id)
+                return None
+            try:
+                return await process_request(token, url, method, params=dict(params or {}), files=files, **kwargs)
+            except helper.ApiTelegramException as error:
+                delay = retry_after(error)
+                if delay is None or attempt >= limiter.max_retries:
+                    raise
+                logger.warning("%s: 429, повтор через %s с", url, delay)
+                limiter.pause(chat_id, delay)
+                limiter.count_retry()
+                rewind(files)
+
+    helper._process_request = limited_request
+
+
+class InFlight:
+    """
+    Ключи заданий, которые сейчас выполняются (для отбрасывания повторных нажатий кнопок)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = set()
+        self._duplicates = 0
+
+    def start(self, key):
+        """
+        Отмечает задание как выполняющееся. Возвращает False, если такое задание уже выполняется.
+        """
+        with self._lock:
+            if key in self._keys:
+                self._duplicates += 1
+                return False
+            self._keys.add(key)
+            return True
+
+    def finish(self, key):
+        with self._lock:
+            self._keys.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._keys), 'duplicates': self._duplicates}
+
+
+def create_rate_limiter(keep_texts=()):
+    """
+    Создание ограничения частоты по настройкам из переменных окружения
+    keep_texts: сообщения об ошибках, которые никогда не отбрасываются
+    """
+    return RateLimiter(
+        global_rate=float(os.getenv('DISPATCH_GLOBAL_RATE', 30)),
+        chat_rate=float(os.getenv('DISPATCH_CHAT_RATE', 1)),
+        chat_burst=int(os.getenv('DISPATCH_CHAT_BURST', 5)),
+        group_rate=float(os.getenv('DISPATCH_GROUP_RATE', 20 / 60)),
+        max_retries=int(os.getenv('DISPATCH_MAX_RETRIES', 3)),
+        keep_texts=keep_texts,
+    )
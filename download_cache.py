@@ -0,0 +1,289 @@
+"""
+Кэш загруженных из Telegram фотографий.
+
+Все функции *_and_send работают с одной и той же фотографией пользователя, поэтому повторные нажатия кнопок
+не должны каждый раз обращаться к get_file/download_file. Кэш устроен в два уровня:
+- в памяти: LRU по ключу file_unique_id (или file_id), ограниченный по количеству записей и суммарному размеру
+в байтах, с вытеснением записей по TTL;
+- на диске (необязательно): вытесненные из памяти файлы сохраняются в каталог и могут быть прочитаны повторно,
+общий объем каталога также ограничен.
+
+Дополнительно хранятся уже декодированные объекты PIL.Image для нескольких последних фотографий, чтобы при
+повторном нажатии не тратить время ни на сеть, ни на декодирование JPEG. Их количество и суммарный объем
+в памяти ограничены: декодированное изображение в десятки раз больше файла.
+Счетчики попаданий, промахов и вытеснений доступны через метод stats().
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from image_loader import decode_image
+
+
+class DownloadCache:
+    """
+    Ограниченный кэш загруженных файлов и декодированных изображений
+    max_bytes: максимальный суммарный размер файлов в памяти
+    max_entries: максимальное количество файлов в памяти
+    ttl: время жизни записи в секундах
+    disk_dir: каталог для хранения вытесненных файлов (None - без дискового уровня)
+    disk_max_bytes: максимальный суммарный размер файлов на диске
+    max_images: количество декодированных изображений, которые хранятся в памяти
+    max_image_bytes: максимальный суммарный объем декодированных изображений в памяти
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=256, ttl=600,
+                 disk_dir=None, disk_max_bytes=512 * 1024 * 1024, max_images=8,
+                 max_image_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.max_images = max_images
+        self.max_image_bytes = max_image_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # ключ -> (данные, время сохранения)
+        self._images = OrderedDict()   # ключ -> (PIL.Image, время сохранения, объем в памяти)
+        self._disk = OrderedDict()     # имя файла -> (размер, время сохранения)
+        self._size = 0
+        self._image_size = 0
+        self._disk_size = 0
+        self._counters = dict.fromkeys(
+            ('hits', 'misses', 'evictions', 'expired', 'disk_hits', 'disk_writes', 'disk_evictions',
+             'image_hits', 'image_misses', 'image_evictions'), 0)
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def get(self, key):
+        """
+        Возвращает содержимое файла из кэша или None, если его там нет
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._counters['hits'] += 1
+                    return entry[0]
+                self._drop(key)
+                self._counters['expired'] += 1
+
+        data = self._read_disk(key)
+        if data is not None:
+            with self._lock:
+                self._counters['disk_hits'] += 1
+            self.put(key, data)
+            return data
+
+        with self._lock:
+            self._counters['misses'] += 1
+        return None
+
+    def put(self, key, data):
+        """
+        Сохраняет содержимое файла в кэш.
+        Файлы больше max_bytes в память не помещаются и сразу записываются на диск.
+        """
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if len(data) > self.max_bytes:
+                evicted.append((key, data))
+            else:
+                self._entries[key] = (data, time.monotonic())
+                self._size += len(data)
+                while self._size > self.max_bytes or len(self._entries) > self.max_entries:
+                    old_key, (old_data, _) = self._entries.popitem(last=False)
+                    self._size -= len(old_data)
+                    self._counters['evictions'] += 1
+                    evicted.append((old_key, old_data))
+
+        # Запись на диск выполняется вне блокировки, чтобы не задерживать другие потоки
+        for old_key, old_data in evicted:
+            self._write_disk(old_key, old_data)
+
+    def fetch(self, key, loader):
+        """
+        Возвращает файл из кэша, а при промахе загружает его с помощью loader() и сохраняет
+        """
+        data = self.get(key)
+        if data is None:
+            data = loader()
+            self.put(key, data)
+        return data
+
+    def get_image(self, key):
+        """
+        Возвращает декодированное изображение из кэша или None
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._images.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._images.move_to_end(key)
+                self._counters['image_hits'] += 1
+                return entry[0]
+            if entry is not None:
+                self._drop_image(key)
+                self._counters['expired'] += 1
+            self._counters['image_misses'] += 1
+        return None
+
+    def put_image(self, key, image):
+        """
+        Сохраняет декодированное изображение в кэш.
+        Изображение больше max_image_bytes не сохраняется.
+        """
+        size = image_size(image)
+        with self._lock:
+            if key in self._images:
+                self._drop_image(key)
+            # Слишком большое изображение не помещается, а остальные изображения не вытесняются
+            if size > self.max_image_bytes:
+                return
+            self._images[key] = (image, time.monotonic(), size)
+            self._image_size += size
+            while len(self._images) > self.max_images or self._image_size > self.max_image_bytes:
+                self._drop_image(next(iter(self._images)))
+                self._counters['image_evictions'] += 1
+
+    def fetch_image(self, key, loader, decoder=None):
+        """
+        Возвращает декодированное изображение.
+        При промахе получает байты файла через loader() и декодирует их функцией decoder(data)
+        (по умолчанию - полное декодирование с проверкой бюджета точек).
+        Изображение общее для всех обработчиков, поэтому изменять его на месте нельзя.
+        """
+        image = self.get_image(key)
+        if image is None:
+            data = loader()
+            if decoder is None:
+                image = decode_image(data)
+            else:
+                image = decoder(data)
+            self.put_image(key, image)
+        return image
+
+    def stats(self):
+        """
+        Текущие значения счетчиков и заполненность кэша
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(entries=len(self._entries), bytes=self._size, images=len(self._images),
+                         image_bytes=self._image_size,
+                         disk_entries=len(self._disk), disk_bytes=self._disk_size)
+        return stats
+
+    def clear(self):
+        """
+        Очистка кэша в памяти (файлы на диске сохраняются)
+        """
+        with self._lock:
+            self._entries.clear()
+            self._images.clear()
+            self._image_size = 0
+            self._size = 0
+
+    def _drop_image(self, key):
+        _, _, size = self._images.pop(key)
+        self._image_size -= size
+
+    def _drop(self, key):
+        data, _ = self._entries.pop(key)
+        self._size -= len(data)
+
+    def _disk_name(self, key):
+        return hashlib.sha1(str(key).encode('utf-8')).hexdigest() + '.bin'
+
+    def _scan_disk(self):
+        """
+        Регистрирует файлы, оставшиеся в каталоге после предыдущего запуска
+        """
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.bin'):
+                stat = os.stat(os.path.join(self.disk_dir, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+        wall_to_monotonic = time.monotonic() - time.time()
+        for mtime, name, size in sorted(files):
+            self._disk[name] = (size, mtime + wall_to_monotonic)
+            self._disk_size += size
+        self._trim_disk()
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        name = self._disk_name(key)
+        with self._lock:
+            entry = self._disk.get(name)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.ttl:
+                self._remove_disk(name)
+                self._counters['expired'] += 1
+                return None
+        try:
+            with open(os.path.join(self.disk_dir, name), 'rb') as file:
+                return file.read()
+        except OSError:
+            with self._lock:
+                if name in self._disk:
+                    self._remove_disk(name)
+            return None
+
+    def _write_disk(self, key, data):
+        if not self.disk_dir or len(data) > self.disk_max_bytes:
+            return
+        name = self._disk_name(key)
+        with self._lock:
+            # Файл уже лежит на диске (например, был прочитан оттуда) - повторно не записываем
+            if name in self._disk:
+                self._disk.move_to_end(name)
+                return
+        path = os.path.join(self.disk_dir, name)
+        # Пишем во временный файл и переименовываем, чтобы читатели не увидели частично записанный файл
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        with self._lock:
+            if name in self._disk:
+                self._disk_size -= self._disk.pop(name)[0]
+            self._disk[name] = (len(data), time.monotonic())
+            self._disk_size += len(data)
+            self._counters['disk_writes'] += 1
+            self._trim_disk()
+
+    def _trim_disk(self):
+        while self._disk_size > self.disk_max_bytes and self._disk:
+            name = next(iter(self._disk))
+            self._remove_disk(name)
+            self._counters['disk_evictions'] += 1
+
+    def _remove_disk(self, name):
+        size, _ = self._disk.pop(name)
+        self._disk_size -= size
+        try:
+            os.remove(os.path.join(self.disk_dir, name))
+        except OSError:
+            pass
+
+
+def image_size(image):
+    """
+    Объем декодированного изображения в памяти (оценка): Pillow хранит точку в 1 байте для режимов с одним
+    каналом и в 4 байтах для остальных
+    """
+    return image.width * image.height * (1 if image.mode in ("1", "L", "P") else 4)
@@ -0,0 +1,194 @@
+"""
+Кодирование результатов обработки.
+
+Раньше все результаты сохранялись в JPEG с настройками по умолчанию, а стикер - в неоптимизированный PNG
+с прозрачными полями до размера 512x512. На медленных каналах время ответа определяется в основном размером
+загружаемого файла. Формат и параметры кодирования выбираются по профилю:
+- photo: JPEG с подобранным качеством, субдискретизацией 4:2:0, прогрессивной разверткой и оптимизацией
+таблиц Хаффмана;
+- pixel_art: PNG с палитрой (пикселизированное изображение состоит из крупных одноцветных блоков и сжимается
+без потерь лучше, чем JPEG, без артефактов на границах блоков);
+- sticker: WebP, как ожидает Telegram для стикеров; прозрачные поля обрезаются (у стикера одна сторона
+должна быть 512 точек, вторая - не больше 512).
+
+Для форматов с потерями можно задать бюджет размера: качество подбирается двоичным поиском, чтобы файл
+не превышал max_bytes. Буферы кодирования переиспользуются, чтобы не выделять память заново для каждого файла
+(буфер больше MAX_BUFFER_BYTES, например после длинной анимации, в пул не возвращается).
+
+Настройки (переменные окружения): ENCODING_JPEG_QUALITY, ENCODING_MAX_BYTES (бюджет размера фотографии),
+ENCODING_WEBP_QUALITY, ANIMATION_FORMAT, ENCODING_REPORT (сравнивать размер с прежним способом сохранения и записывать
+сэкономленные байты в метрики; удваивает время кодирования).
+"""
+import io
+import os
+import threading
+
+from PIL import Image
+
+from image_loader import load_plugin
+
+# Формат результата покадровой обработки анимаций (модуль animation): GIF или WEBP
+ANIMATION_FORMAT = os.getenv('ANIMATION_FORMAT', 'GIF').upper()
+
+# Профили кодирования: формат, параметры сохранения и способ отправки (document - отправлять как файл)
+PROFILES = {
+    "photo": {
+        "format": "JPEG",
+        "quality": int(os.getenv('ENCODING_JPEG_QUALITY', 75)),
+        "min_quality": 40,
+        "max_bytes": int(os.getenv('ENCODING_MAX_BYTES', 0)) or None,
+        "options": {"subsampling": "4:2:0", "progressive": True, "optimize": True},
+        "document": False,
+        "extension": "jpg",
+    },
+    "pixel_art": {
+        "format": "PNG",
+        "palette": 256,
+        "options": {"optimize": True},
+        "document": False,
+        "extension": "png",
+    },
+    # Анимации кодируются модулем animation; профиль определяет формат и способ отправки
+    "animation": {
+        "format": ANIMATION_FORMAT,
+        "document": ANIMATION_FORMAT == "WEBP",
+        "animation": True,
+        "extension": ANIMATION_FORMAT.lower(),
+    },
+    "sticker": {
+        "format": "WEBP",
+        "quality": int(os.getenv('ENCODING_WEBP_QUALITY', 90)),
+        "min_quality": 50,
+        "max_bytes": 512 * 1024,  # ограничение Telegram для статических стикеров
+        "trim": True,
+        "options": {"method": 4},
+        "document": True,
+        "extension": "webp",
+    },
+}
+
+# Сравнение размера с прежним способом сохранения (default_size) для отчета о сэкономленных байтах
+REPORT_SAVINGS = bool(os.getenv('ENCODING_REPORT'))
+
+# Профиль по умолчанию для операций
+OPERATION_PROFILES = {
+    "pixelate": "pixel_art",
+    "sticker": "sticker",
+}
+
+# Переиспользуемые буферы кодирования (в каждом процессе пула - свои)
+_buffers = []
+_buffers_lock = threading.Lock()
+MAX_BUFFERS = 4
+MAX_BUFFER_BYTES = 8 * 1024 * 1024
+
+
+def profile_for(operation):
+    """
+    Профиль кодирования для операции
+    """
+    return OPERATION_PROFILES.get(operation, "photo")
+
+
+def is_document(profile):
+    """
+    Отправлять ли результат как документ (стикер), а не как фотографию
+    """
+    return PROFILES[profile]["document"]
+
+
+def is_animation(profile):
+    """
+    Отправлять ли результат как анимацию (send_animation)
+    """
+    return PROFILES[profile].get("animation", False) and not PROFILES[profile]["document"]
+
+
+def file_name(profile, name="image"):
+    return f"{name}.{PROFILES[profile]['extension']}"
+
+
+def encode(image, profile="photo"):
+    """
+    Кодирует изображение по профилю и возвращает байты
+    """
+    settings = PROFILES[profile]
+    image = prepare(image, settings)
+    if "quality" not in settings:
+        return save(image, settings["format"], settings["options"])
+
+    quality = settings["quality"]
+    data = save(image, settings["format"], dict(settings["options"], quality=quality))
+    max_bytes = settings.get("max_bytes")
+    if max_bytes is None or len(data) <= max_bytes:
+        return data
+
+    # Двоичный поиск наибольшего качества, при котором файл укладывается в бюджет
+    low, high = settings["min_quality"], quality - 1
+    best = None
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = save(image, settings["format"], dict(settings["options"], quality=middle))
+        if len(candidate) <= max_bytes:
+            best = candidate
+            low = middle + 1
+        else:
+            high = middle - 1
+    if best is None:
+        # Даже минимальное качество не укладывается в бюджет - отправляем наименьший вариант
+        best = save(image, settings["format"], dict(settings["options"], quality=settings["min_quality"]))
+    return best
+
+
+def prepare(image, settings):
+    """
+    Приведение изображения к виду, который поддерживает формат профиля
+    """
+    if settings.get("trim") and image.mode == "RGBA":
+        # Прозрачные поля не нужны: обрезаем изображение по непрозрачной области
+        box = image.getchannel("A").getbbox()
+        if box is not None:
+            image = image.crop(box)
+    if settings["format"] == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    if settings.get("palette") and image.mode != "P":
+        # FASTOCTREE в несколько раз быстрее MEDIANCUT, а на крупных одноцветных блоках дает почти тот же размер
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        image = image.quantize(colors=settings["palette"], method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    return image
+
+
+def save(image, image_format, options):
+    """
+    Сохраняет изображение в переиспользуемый буфер и возвращает байты
+    """
+    with _buffers_lock:
+        buffer = _buffers.pop() if _buffers else io.BytesIO()
+    try:
+        buffer.seek(0)
+        load_plugin(image_format)
+        image.save(buffer, format=image_format, **options)
+        size = buffer.tell()
+        # Буфер не усекается: выделенная память используется при следующем кодировании
+        with buffer.getbuffer() as view, view[:size] as data:
+            return bytes(data)
+    finally:
+        # Размер буфера - наибольший записанный в него файл: большой буфер не удерживается в пуле
+        if buffer.seek(0, io.SEEK_END) <= MAX_BUFFER_BYTES:
+            with _buffers_lock:
+                if len(_buffers) < MAX_BUFFERS:
+                    _buffers.append(buffer)
+
+
+def default_size(image, profile="photo"):
+    """
+    Размер файла при прежнем способе сохранения (JPEG или PNG с настройками по умолчанию) - для отчета
+    о сэкономленных байтах
+    """
+    image_format = "PNG" if profile == "sticker" else "JPEG"
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+    return output.tell()
@@ -0,0 +1,157 @@
+"""
+Загрузка изображений с учетом необходимого разрешения.
+
+Telegram присылает фотографию в нескольких размерах (PhotoSize). Раньше всегда использовался самый большой
+вариант, а ASCII-арт, пикселизация и тепловая карта затем уменьшали его до 40 символов или в 20 раз.
+Для каждой операции задается бюджет разрешения (по длинной стороне), и загрузчик:
+- выбирает наименьший вариант фотографии, которого достаточно для операции (select_photo_size);
+- уменьшает JPEG уже при декодировании с помощью Image.draft (масштабирование в области DCT), а затем
+при необходимости - с помощью Image.reduce (decode_image).
+
+Функции:
+- photo_sizes: список вариантов фотографии из сообщения Telegram;
+- select_photo_size: выбор варианта фотографии по бюджету разрешения;
+- select_for_operation: выбор варианта фотографии пользователя для операции;
+- select_sizes_for_operation: то же для одной фотографии альбома;
+- decode_image: декодирование с уменьшением до бюджета операции и проверкой бюджета точек (модуль limits);
+- open_image, load_plugin: открытие файла и загрузка модуля Pillow только для нужного формата.
+"""
+import importlib
+import io
+
+from PIL import Image
+
+from limits import ImageTooLarge, check_size
+
+# Необходимое разрешение по длинной стороне для каждой операции (None - исходное разрешение)
+RESOLUTION_BUDGETS = {
+    "ascii": 320,      # 40 символов в строке, запас для сглаживания при уменьшении
+    "pixelate": 800,   # пиксели размером 20 точек все равно скрывают детали
+    "heatmap": 800,
+    "sticker": 512,    # максимальный размер стикера
+}
+
+# Модули Pillow для форматов, которых нет среди основных. При первом открытии или сохранении Pillow загружает
+# модули пяти основных форматов (BMP, GIF, JPEG, PPM, PNG), а встретив любой другой формат - модули всех
+# форматов (около 50 модулей, десятки миллисекунд в каждом процессе пула). Модуль WebP (стикеры) загружается
+# отдельно при первом использовании.
+PLUGINS = {
+    "WEBP": "PIL.WebPImagePlugin",
+}
+
+# Режим, в котором операции нужно изображение: JPEG сразу декодируется в нем
+DECODE_MODES = {
+    "ascii": "L",
+    "heatmap": "L",    # цвет тепловой карты зависит только от яркости (модуль colormaps)
+}
+
+
+def photo_sizes(photos):
+    """
+    Варианты фотографии из message.photo в виде списка [file_id, file_unique_id, ширина, высота]
+    """
+    return [[photo.file_id, photo.file_unique_id, photo.width, photo.height] for photo in photos]
+
+
+def select_photo_size(sizes, budget):
+    """
+    Выбирает наименьший вариант фотографии, длинная сторона которого не меньше budget.
+    Если такого нет или бюджет не задан, возвращает самый большой вариант.
+    Возвращает (file_id, file_unique_id).
+    """
+    ordered = sorted(sizes, key=lambda size: max(size[2], size[3]))
+    if budget is not None:
+        for file_id, file_unique_id, width, height in ordered:
+            if max(width, height) >= budget:
+                return file_id, file_unique_id
+    file_id, file_unique_id = ordered[-1][:2]
+    return file_id, file_unique_id
+
+
+def select_for_operation(state, operation):
+    """
+    Выбор варианта фотографии из состояния пользователя для операции.
+    Возвращает (file_id, file_unique_id, бюджет разрешения).
+    """
+    budget = RESOLUTION_BUDGETS.get(operation)
+    if state.sizes:
+        file_id, file_unique_id = select_photo_size(state.sizes, budget)
+    else:
+        file_id, file_unique_id = state.photo, state.file_unique_id
+    return file_id, file_unique_id or file_id, budget
+
+
+def select_sizes_for_operation(sizes, operation):
+    """
+    Выбор варианта одной фотографии альбома для операции.
+    Возвращает (file_id, file_unique_id, бюджет разрешения).
+    """
+    budget = RESOLUTION_BUDGETS.get(operation)
+    file_id, file_unique_id = select_photo_size(sizes, budget)
+    return file_id, file_unique_id, budget
+
+
+def load_plugin(image_format):
+    """
+    Загружает модуль Pillow для формата image_format, если он не входит в основные
+    """
+    module = PLUGINS.get(image_format.upper())
+    if module is not None:
+        importlib.import_module(module)
+
+
+def open_image(data):
+    """
+    Открывает изображение из байтов файла (без декодирования). Модуль формата WebP загружается по сигнатуре
+    файла, остальные форматы Pillow определяет сам. Собственная защита Pillow от слишком больших изображений
+    (DecompressionBombError) вызывает ImageTooLarge, как и проверка check_size.
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        load_plugin("WEBP")
+    # BytesIO не копирует байты файла, пока в буфер ничего не записывается
+    try:
+        return Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as error:
+        raise ImageTooLarge(str(error)) from error
+
+
+def decode_image(data, budget=None, mode=None):
+    """
+    Декодирует изображение, уменьшая его так, чтобы длинная сторона была не меньше budget
+    и не больше чем в два раза его превышала.
+    data: содержимое файла
+    budget: бюджет разрешения операции (None - без уменьшения)
+    mode: режим, в котором операции нужно изображение (например, 'L' для ASCII-арта), - JPEG может
+    сразу декодироваться в нем
+    Изображение больше бюджета точек (IMAGE_MAX_PIXELS) уменьшается при декодировании или отклоняется
+    до декодирования: вызывается ImageTooLarge.
+    """
+    image = open_image(data)
+    limit = check_size(image)
+    width, height = image.size
+    request = None
+    if budget is not None:
+        scale = budget / max(width, height)
+        if scale < 1:
+            request = (max(1, int(width * scale)), max(1, int(height * scale)))
+    if limit is not None:
+        # Масштаб DCT дает размер не меньше запрошенного, но меньше удвоенного: половина предельного размера
+        # гарантирует, что декодированное изображение уложится в бюджет точек
+        half = (max(1, limit[0] // 2), max(1, limit[1] // 2))
+        request = half if request is None else (min(request[0], half[0]), min(request[1], half[1]))
+    if request is not None:
+        # Для JPEG выбирается наименьший масштаб DCT (1/2, 1/4, 1/8), не меньше запрошенного размера.
+        # Повторный вызов draft не действует, поэтому бюджет операции и бюджет точек объединяются в один запрос
+        image.draft(mode or image.mode, request)
+    image.load()
+    if image.mode not in ("L", "RGB", "RGBA"):
+        # Файлы, отправленные документом (PNG, GIF, WebP), могут быть в режиме с палитрой или прозрачностью:
+        # преобразования и кодирование работают с L, RGB и RGBA
+        has_alpha = image.mode in ("LA", "PA", "La") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    if budget is not None:
+        factor = max(image.size) // budget
+        if factor >= 2:
+            image = image.reduce(factor)
+    return image
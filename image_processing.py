@@ -0,0 +1,206 @@
+"""
+Функции обработки изображений.
+
+Функции вынесены в отдельный модуль, чтобы их можно было импортировать без запуска бота: они выполняются
+в пуле процессов (модуль scheduler), где передаются по ссылке на модуль.
+
+- resize_image: изменяет размер изображения с сохранением пропорций;
+- grayify: преобразует цветное изображение в оттенки серого;
+- image_to_ascii: преобразует изображение в ASCII-арт (ширина, количество сообщений и упорядочивание символов
+по яркости - настройки ASCII_WIDTH, ASCII_MAX_MESSAGES и ASCII_ORDER_BY_BRIGHTNESS);
+- pixels_to_ascii: конвертирует пиксели изображения в градациях серого в строку ASCII-символов;
+- pixelate_image: пикселизация изображения;
+- invert_colors: инверсия цветов изображения;
+- mirror_image: отражение изображения по горизонтали или вертикали;
+- convert_to_heatmap: преобразование изображения в тепловую карту (палитры - модуль colormaps);
+- resize_for_sticker: подготовка изображения для стикера Telegram (холст берется из пула холстов, модуль limits);
+- encode_image: сохранение изображения в байты в заданном формате (через переиспользуемый буфер);
+- apply_and_encode: применение функции обработки и сохранение результата по профилю кодирования (модуль encoding,
+одно задание для пула процессов);
+- apply_and_encode_timed: то же с замером времени обработки и кодирования (для метрик).
+"""
+import os
+import time
+
+from PIL import Image
+
+import ascii_art
+import encoding
+import limits
+from ascii_art import MESSAGE_LIMIT, render_ascii_rows
+from colormaps import apply_colormap
+
+# Набор символов для создания ASCII-арта
+ASCII_CHARS = '@%#*+=-:. '
+
+# Ширина ASCII-арта в символах, на сколько сообщений Telegram он может быть разбит (лишние строки
+# отбрасываются) и упорядочивать ли символы пользователя по яркости (тогда их можно ввести в любом порядке)
+ASCII_WIDTH = int(os.getenv('ASCII_WIDTH', 40))
+ASCII_MAX_MESSAGES = int(os.getenv('ASCII_MAX_MESSAGES', 3))
+ASCII_ORDER_BY_BRIGHTNESS = os.getenv('ASCII_ORDER_BY_BRIGHTNESS', '0') == '1'
+
+# Разметка блока кода вокруг ASCII-арта в сообщении ("```\n" и "\n```")
+ASCII_MESSAGE_OVERHEAD = 8
+
+def resize_image(image, new_width=100):
+    """
+    Функция изменения размера изображения
+    """
+    width, height = image.size
+    ratio = height / width
+    new_height = int(new_width * ratio)
+    return image.resize((new_width, new_height))
+
+def grayify(image):
+    """
+    Преобразование изображения в градации серого
+    """
+    return image.convert("L")
+
+def image_to_ascii(image_stream, new_width=ASCII_WIDTH, ascii_chars=ASCII_CHARS, max_messages=1,
+                   order_by_brightness=False):
+    """
+    Преобразование изображения в ASCII-арт
+    image_stream: поток изображения или объект PIL.Image
+    new_width: новая ширина для изменения размера
+    ascii_chars: набор символов для ASCII-арта
+    max_messages: на сколько сообщений Telegram рассчитан результат (ascii_art.chunk_ascii_rows)
+    order_by_brightness: упорядочить символы от самого темного к самому светлому (ascii_art.order_by_brightness)
+    """
+    # Принимаем как поток, так и уже открытое изображение
+    if not isinstance(image_stream, Image.Image):
+        image_stream = Image.open(image_stream)
+    if order_by_brightness:
+        ascii_chars = ascii_art.order_by_brightness(ascii_chars)
+
+    # Ограничение на количество символов: в каждое сообщение помещаются целые строки вместе с разметкой
+    rows_per_message = max((MESSAGE_LIMIT - ASCII_MESSAGE_OVERHEAD) // (new_width + 1), 1)
+    max_rows = rows_per_message * max_messages
+
+    # Переводим в оттенки серого, меняем размер и конвертируем пиксели в ASCII-символы (модуль ascii_art)
+    rows = render_ascii_rows(image_stream, new_width, ascii_chars, max_rows=max_rows)
+    if not rows:
+        return ""
+    return "\n".join(rows) + "\n"
+
+def pixels_to_ascii(image, ascii_chars):
+    """
+    Преобразование пикселей в ASCII-символы
+    """
+    return ascii_art.pixels_to_ascii(image, ascii_chars)
+
+def pixelate_image(image, pixel_size):
+    """
+    Функция огрубления изображения
+    """
+    image = image.resize(
+        (image.size[0] // pixel_size, image.size[1] // pixel_size),
+        Image.NEAREST
+    )
+    image = image.resize(
+        (image.size[0] * pixel_size, image.size[1] * pixel_size),
+        Image.NEAREST
+    )
+    return image
+
+def invert_colors(image):
+    """
+    Функция инверсии цветов изображения
+    Инверсия выполняется одним вызовом Image.point в исходном режиме изображения (модуль colormaps)
+    """
+    return apply_colormap(image, "inverted")
+
+def mirror_image(image, direction="horizontal"):
+    """
+    Функция отражения изображения по горизонтали или вертикали
+    image: Объект PIL.Image
+    direction: Направление отражения ("horizontal" или "vertical")
+    """
+    if direction == "horizontal":
+        return image.transpose(Image.FLIP_LEFT_RIGHT)
+    elif direction == "vertical":
+        return image.transpose(Image.FLIP_TOP_BOTTOM)
+    else:
+        raise ValueError("Invalid direction. Use 'horizontal' or 'vertical'.")
+
+def convert_to_heatmap(image):
+    """
+    Преобразование изображения в тепловую карту
+    Применяем градиент от синего (холодные) к красному (теплые области) по яркости пикселя;
+    таблица градиента вычисляется один раз (модуль colormaps)
+    """
+    return apply_colormap(image, "heatmap")
+
+def resize_for_sticker(image, max_size=512):
+    """
+    Изменяет размер изображения для загрузки в Telegram в виде стикера.
+    - Максимальное измерение (ширина или высота) не превышает max_size.
+    - Гарантирует формат PNG и добавляет прозрачный фон, если его нет.
+    image: объект PIL.Image;
+    max_size: максимальный размер (ширина или высота)
+        """
+    # Получаем текущие размеры изображения
+    width, height = image.size
+
+    # Вычисляем коэффициент изменения размера
+    scaling_factor = max_size / max(width, height)
+
+    # Вычисляем новые размеры, сохраняя пропорции
+    new_width = int(width * scaling_factor)
+    new_height = int(height * scaling_factor)
+
+    # Изменяем размер изображения
+    resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+    # Проверяем, есть ли прозрачный фон, и добавляем его, если нужно
+    if resized_image.mode != "RGBA":
+        resized_image = resized_image.convert("RGBA")
+
+    # Берем прозрачный холст из пула: он возвращается в пул после кодирования результата (apply_and_encode)
+    final_image = limits.canvases.acquire("RGBA", (max_size, max_size), (0, 0, 0, 0))
+
+    # Размещаем изображение по центру
+    offset_x = (max_size - new_width) // 2
+    offset_y = (max_size - new_height) // 2
+    final_image.paste(resized_image, (offset_x, offset_y), resized_image)
+
+    return final_image
+
+def encode_image(image, image_format="JPEG"):
+    """
+    Сохраняет изображение в байты в указанном формате
+    """
+    return encoding.save(image, image_format, {})
+
+def apply_and_encode(func, image, args=(), profile="photo"):
+    """
+    Применяет функцию обработки к изображению и сохраняет результат.
+    Обработка и кодирование выполняются в одном задании, чтобы в основной процесс возвращались
+    только готовые байты, а не декодированное изображение.
+    profile: профиль кодирования (модуль encoding)
+    В процессе пула с ограничением памяти ее нехватка вызывает MemoryError (limits.job_memory).
+    """
+    with limits.job_memory():
+        result = func(image, *args)
+        try:
+            return encoding.encode(result, profile)
+        finally:
+            limits.canvases.release(result)
+
+def apply_and_encode_timed(func, image, args=(), profile="photo"):
+    """
+    То же, что apply_and_encode, но дополнительно возвращает время обработки и кодирования в миллисекундах
+    (для метрик: задание выполняется в пуле процессов, и измерить этапы можно только в нем).
+    Возвращает (байты, {'transform': мс, 'encode': мс}, размер при прежнем способе сохранения или None).
+    """
+    started = time.perf_counter()
+    with limits.job_memory():
+        result = func(image, *args)
+        transformed = time.perf_counter()
+        try:
+            data = encoding.encode(result, profile)
+            encoded = time.perf_counter()
+            baseline = encoding.default_size(result, profile) if encoding.REPORT_SAVINGS else None
+        finally:
+            limits.canvases.release(result)
+    return data, {'transform': (transformed - started) * 1000, 'encode': (encoded - transformed) * 1000}, baseline
@@ -0,0 +1,207 @@
+"""
+Ограничения памяти при обработке изображений.
+
+Файл размером в несколько сотен килобайт может содержать изображение в сотни миллионов точек (например, PNG
+одного цвета - "декомпрессионная бомба"): после декодирования оно занимает гигабайты и завершает процесс
+по нехватке памяти. Поэтому:
+- check_size проверяет размер по заголовку файла, до декодирования. Изображение больше IMAGE_MAX_PIXELS точек
+либо уменьшается уже при декодировании (JPEG, масштабирование в области DCT не больше чем в 8 раз по стороне),
+либо отклоняется: вызывается ImageTooLarge. Поведение задает IMAGE_OVERSIZE: downscale (по умолчанию) или
+reject (отклонять всегда);
+- init_worker ограничивает память каждого процесса пула (RLIMIT_AS): процесс выполняет одно задание за раз,
+поэтому это ограничение памяти задания. Задание, которому не хватило JOB_MEMORY_LIMIT_MB мегабайт сверх
+памяти процесса при запуске, завершается с MemoryError (job_memory: кодеки Pillow сообщают о нехватке памяти
+ошибкой OSError, is_allocation_failure отличает ее от прочих), а процесс пула и бот продолжают работу. Без пула
+процессов (WORKER_PROCESSES=0) действует только ограничение точек;
+- tune_allocator фиксирует порог mmap распределителя памяти glibc. По умолчанию порог растет после освобождения
+каждого большого блока (до 32 МБ), и буферы изображений и загруженных файлов начинают выделяться в куче, которая
+фрагментируется: RSS процесса медленно растет от задания к заданию. С фиксированным порогом большие буферы
+выделяются через mmap и при освобождении сразу возвращаются системе;
+- CanvasPool: холсты (например, прозрачный фон стикера 512x512) переиспользуются между заданиями, а не
+выделяются заново (буферы кодирования переиспользует модуль encoding).
+
+Настройки: IMAGE_MAX_PIXELS (по умолчанию 25 млн точек, 0 - без ограничения), IMAGE_OVERSIZE,
+JOB_MEMORY_LIMIT_MB (по умолчанию 1024, 0 - без ограничения), MALLOC_MMAP_THRESHOLD_KB (по умолчанию 1024,
+0 - порог glibc по умолчанию).
+"""
+import contextlib
+import errno
+import os
+import threading
+import weakref
+
+from PIL import Image
+
+MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', 25_000_000))
+OVERSIZE = os.getenv('IMAGE_OVERSIZE', 'downscale')
+JOB_MEMORY_LIMIT = int(os.getenv('JOB_MEMORY_LIMIT_MB', 1024)) * 1024 * 1024
+MMAP_THRESHOLD = int(os.getenv('MALLOC_MMAP_THRESHOLD_KB', 1024)) * 1024
+
+# Параметр mallopt для порога mmap (malloc.h)
+M_MMAP_THRESHOLD = -3
+
+# Ограничение адресного пространства текущего процесса (limit_memory), байт; None - без ограничения
+ceiling = None
+
+# Наибольшее уменьшение JPEG при декодировании (Image.draft): в 8 раз по каждой стороне
+MAX_DRAFT_SCALE = 8
+
+
+class ImageTooLarge(ValueError):
+    """
+    Изображение не укладывается в бюджет точек
+    """
+
+
+def check_size(image, max_pixels=MAX_PIXELS, oversize=OVERSIZE):
+    """
+    Проверка размера открытого, но еще не декодированного изображения (Image.open читает только заголовок).
+    Возвращает None, если изображение укладывается в max_pixels, или наибольший размер (ширина, высота),
+    до которого его нужно уменьшить при декодировании. Вызывает ImageTooLarge, если изображение нельзя
+    уменьшить при декодировании (не JPEG, слишком большое даже для уменьшения в 8 раз или oversize='reject').
+    """
+    width, height = image.size
+    pixels = width * height
+    if not max_pixels or pixels <= max_pixels:
+        return None
+    if oversize != 'downscale' or image.format != 'JPEG' or pixels > max_pixels * MAX_DRAFT_SCALE ** 2:
+        raise ImageTooLarge(f"Too many pixels: {width}x{height} > {max_pixels}")
+    scale = (max_pixels / pixels) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def process_memory():
+    """
+    Размер адресного пространства текущего процесса в байтах (VmSize) или None, если он неизвестен
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmSize:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def limit_memory(limit=JOB_MEMORY_LIMIT):
+    """
+    Ограничивает адресное пространство текущего процесса: limit байт сверх уже занятого.
+    Возвращает установленное ограничение или None, если ограничение не поддерживается (не Linux) или выключено.
+    """
+    global ceiling
+    current = process_memory()
+    if not limit or current is None:
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    soft = current + limit if hard == resource.RLIM_INFINITY else min(current + limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+    ceiling = soft
+    return ceiling
+
+
+# Ошибки кодеков Pillow при записи (ImageFile._get_oserror), которыми проявляется нехватка памяти:
+# libjpeg сообщает о ней как о любой своей ошибке ("broken data stream"), остальные кодеки - статусом -9
+ALLOCATION_ERRORS = (
+    'out of memory error when writing image file',
+    'broken data stream when writing image file',
+)
+
+
+def is_allocation_failure(error):
+    """
+    Вызвана ли ошибка OSError нехваткой памяти: ENOMEM или ошибка кодека при записи результата в память.
+    Ошибки чтения (поврежденный или обрезанный файл) и прочие ошибки ввода-вывода к нехватке памяти не относятся.
+    """
+    return error.errno == errno.ENOMEM or str(error) in ALLOCATION_ERRORS
+
+
+@contextlib.contextmanager
+def job_memory():
+    """
+    Выполнение преобразования и кодирования в процессе с ограничением памяти. Кодеки Pillow (libjpeg, zlib,
+    libwebp) сообщают о нехватке памяти ошибкой OSError, она заменяется MemoryError (is_allocation_failure).
+    Остальные ошибки, а также все ошибки без ограничения (ceiling is None) не изменяются.
+    """
+    try:
+        yield
+    except OSError as error:
+        if ceiling is None or not is_allocation_failure(error):
+            raise
+        raise MemoryError(f"Job memory limit exceeded: {error}") from error
+
+
+def tune_allocator(threshold=MMAP_THRESHOLD):
+    """
+    Фиксирует порог mmap распределителя памяти glibc (mallopt). Возвращает False, если порог не изменен
+    (настройка выключена или это не glibc).
+    """
+    if not threshold:
+        return False
+    try:
+        import ctypes
+        return bool(ctypes.CDLL(None).mallopt(M_MMAP_THRESHOLD, threshold))
+    except (OSError, AttributeError):
+        return False
+
+
+def init_worker():
+    """
+    Инициализация процесса пула обработки (initializer для ProcessPoolExecutor): порог mmap и ограничение
+    памяти задания
+    """
+    tune_allocator()
+    limit_memory()
+
+
+class CanvasPool:
+    """
+    Переиспользуемые холсты (PIL.Image) по режиму и размеру.
+    Холст выдается (acquire) залитым цветом color и возвращается в пул (release) после кодирования результата.
+    Холст, который не вернули (например, промежуточный результат цепочки), удаляется сборщиком мусора.
+    max_free: сколько свободных холстов каждого режима и размера хранить
+    """
+
+    def __init__(self, max_free=2):
+        self.max_free = max_free
+        self._lock = threading.Lock()
+        self._free = {}  # (режим, размер) -> [холсты]
+        self._lent = weakref.WeakValueDictionary()  # id -> выданный холст
+        self._counters = dict.fromkeys(('created', 'reused'), 0)
+
+    def acquire(self, mode, size, color=0):
+        with self._lock:
+            free = self._free.get((mode, size))
+            canvas = free.pop() if free else None
+            self._counters['reused' if canvas is not None else 'created'] += 1
+        if canvas is None:
+            canvas = Image.new(mode, size, color)
+        else:
+            canvas.paste(color, (0, 0) + size)
+        with self._lock:
+            self._lent[id(canvas)] = canvas
+        return canvas
+
+    def release(self, image):
+        """
+        Возвращает холст в пул. Изображения, выданные не пулом, пропускаются.
+        """
+        with self._lock:
+            if self._lent.get(id(image)) is not image:
+                return
+            del self._lent[id(image)]
+            free = self._free.setdefault((image.mode, image.size), [])
+            if len(free) < self.max_free:
+                free.append(image)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, free=sum(len(free) for free in self._free.values()))
+
+
+# Холсты процесса (в каждом процессе пула - свои)
+canvases = CanvasPool()
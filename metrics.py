@@ -0,0 +1,358 @@
+"""
+Метрики и трассировка обработки запросов.
+
+Раньше было невозможно понять, из-за чего медленно приходит ответ: из-за загрузки файла из Telegram,
+декодирования Pillow, преобразования, кодирования JPEG/PNG или отправки. Модуль измеряет каждый этап:
+- stage: контекстный менеджер этапа (download, decode, transform, encode, upload, dispatch); время этапа
+записывается в гистограмму для операции, ошибки считаются по этапу, операции и типу исключения;
+- trace/traced: трассировка задания целиком; по окончании задания в журнал (логгер "metrics") пишется
+одна строка JSON со временем всех этапов;
+- observe: произвольное значение в гистограмму (например, размер загруженного файла в байтах);
+- render: метрики в текстовом формате Prometheus, включая показатели планировщика и кэшей (add_collector);
+значения меток экранируются (escape_label);
+- serve: локальный HTTP-сервер с адресами /metrics, /debug/profile и /debug/tracemalloc.
+
+Профилирование включается во время работы: cProfile - для заданной доли заданий (/debug/profile?rate=0.1),
+tracemalloc - по запросу (/debug/tracemalloc?enable=1). Если метрики выключены, stage и traced не делают
+ничего, кроме одной проверки.
+"""
+import bisect
+import contextvars
+import io
+import json
+import logging
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger("metrics")
+
+# Границы корзин гистограмм: время в миллисекундах и размер в байтах
+TIME_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+BYTES_BUCKETS = tuple(1024 * 4 ** power for power in range(9))  # 1 КБ ... 64 МБ
+
+# Трассировка текущего задания (contextvars работает и для потоков, и для задач asyncio)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+NO_STAGE = nullcontext()
+
+
+def escape_label(value):
+    """
+    Значение метки в формате Prometheus: экранируются обратная косая черта, кавычка и перевод строки
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными границами корзин (как histogram в Prometheus)
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Trace:
+    """
+    Трассировка одного задания: время этапов и результат
+    """
+    __slots__ = ('operation', 'chat_id', 'started', 'stages', 'error')
+
+    def __init__(self, operation, chat_id=None):
+        self.operation = operation
+        self.chat_id = chat_id
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.error = None
+
+
+class Metrics:
+    """
+    Реестр метрик
+    enabled: включить измерения (если выключено, stage и traced почти ничего не стоят)
+    log: писать в журнал строку JSON по каждому заданию
+    profile_rate: доля заданий, выполняемых под cProfile (0 - профилирование выключено)
+    """
+
+    def __init__(self, enabled=False, log=False, profile_rate=0.0):
+        self.enabled = enabled
+        self.log = log
+        self.profile_rate = profile_rate
+        self._lock = threading.Lock()
+        self._histograms = {}  # (метрика, операция) -> Histogram
+        self._errors = {}      # (этап, операция, тип ошибки) -> количество
+        self._collectors = {}  # префикс -> функция, возвращающая словарь показателей
+        self._profile = None
+        self._profiled_jobs = 0
+        self._profiling = threading.Lock()
+        self._server = None
+
+    def observe(self, name, operation, value, buckets=TIME_BUCKETS):
+        """
+        Записывает значение в гистограмму name для операции (None - операция текущей трассировки)
+        """
+        if not self.enabled:
+            return
+        if operation is None:
+            trace = current_trace.get()
+            operation = trace.operation if trace is not None else "unknown"
+        with self._lock:
+            histogram = self._histograms.get((name, operation))
+            if histogram is None:
+                histogram = self._histograms[(name, operation)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def count_error(self, stage, operation, error):
+        if not self.enabled:
+            return
+        key = (stage, operation, type(error).__name__)
+        with self._lock:
+            self._errors[key] = self._errors.get(key, 0) + 1
+
+    def stage(self, name, operation=None):
+        """
+        Контекстный менеджер этапа обработки. Операция по умолчанию берется из текущей трассировки.
+        """
+        if not self.enabled:
+            return NO_STAGE
+        return self._stage(name, operation)
+
+    @contextmanager
+    def _stage(self, name, operation):
+        trace = current_trace.get()
+        if operation is None:
+            operation = trace.operation if trace is not None else "unknown"
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as error:
+            self.count_error(name, operation, error)
+            raise
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            self.observe(f"{name}_ms", operation, elapsed)
+            if trace is not None:
+                trace.stages[name] = trace.stages.get(name, 0.0) + elapsed
+
+    def record_stages(self, operation, stages):
+        """
+        Записывает время этапов, измеренных вне текущего процесса (например, в пуле процессов)
+        stages: словарь этап -> время в миллисекундах
+        """
+        if not self.enabled:
+            return
+        trace = current_trace.get()
+        for name, elapsed in stages.items():
+            self.observe(f"{name}_ms", operation, elapsed)
+            if trace is not None:
+                trace.stages[name] = trace.stages.get(name, 0.0) + elapsed
+
+    @contextmanager
+    def trace(self, operation, chat_id=None):
+        """
+        Трассировка задания целиком: общее время, время этапов, ошибка.
+        При необходимости задание выполняется под cProfile.
+        """
+        trace = Trace(operation, chat_id)
+        token = current_trace.set(trace)
+        profiler = None
+        # Одновременно профилируется только одно задание: в Python 3.12+ cProfile нельзя включить
+        # в нескольких потоках сразу
+        if self.profile_rate and random.random() < self.profile_rate and self._profiling.acquire(blocking=False):
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            yield trace
+        except Exception as error:
+            trace.error = type(error).__name__
+            self.count_error("job", operation, error)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiling.release()
+                self._add_profile(profiler)
+            current_trace.reset(token)
+            elapsed = (time.perf_counter() - trace.started) * 1000
+            self.observe("job_ms", operation, elapsed)
+            if self.log:
+                logger.info(json.dumps({"event": "job", "operation": operation, "chat_id": chat_id,
+                                        "ms": round(elapsed, 3),
+                                        "stages": {name: round(value, 3) for name, value in trace.stages.items()},
+                                        "error": trace.error}))
+
+    def traced(self, operation, func):
+        """
+        Оборачивает функцию задания трассировкой (первый аргумент функции - сообщение Telegram)
+        """
+        if not self.enabled:
+            return func
+
+        def run(message, *args, **kwargs):
+            with self.trace(operation, message.chat.id):
+                return func(message, *args, **kwargs)
+
+        return run
+
+    def add_collector(self, prefix, collect):
+        """
+        Добавляет источник показателей (например, scheduler.stats): числовые значения словаря
+        экспортируются как gauge с именем <prefix>_<ключ>
+        """
+        self._collectors[prefix] = collect
+
+    def set_profile_rate(self, rate):
+        """
+        Включает профилирование доли заданий (0 - выключить). Накопленный профиль сбрасывается.
+        """
+        with self._lock:
+            self.profile_rate = max(0.0, min(1.0, rate))
+            self._profile = None
+            self._profiled_jobs = 0
+
+    def profile_report(self, limit=30):
+        """
+        Функции с наибольшим суммарным временем по всем профилированным заданиям
+        """
+        with self._lock:
+            if self._profile is None:
+                return f"No profiled jobs (rate={self.profile_rate})\n"
+            output = io.StringIO()
+            output.write(f"Profiled jobs: {self._profiled_jobs}\n")
+            self._profile.stream = output
+            self._profile.sort_stats("cumulative").print_stats(limit)
+        return output.getvalue()
+
+    @staticmethod
+    def set_tracemalloc(enable, frames=10):
+        if enable and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        elif not enable and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @staticmethod
+    def tracemalloc_report(limit=30):
+        """
+        Места программы с наибольшим объемом выделенной памяти
+        """
+        if not tracemalloc.is_tracing():
+            return "tracemalloc is off (/debug/tracemalloc?enable=1)\n"
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"current={current} peak={peak}"]
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:limit]:
+            lines.append(str(stat))
+        return "\n".join(lines) + "\n"
+
+    def render(self):
+        """
+        Метрики в текстовом формате Prometheus
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            errors = sorted(self._errors.items())
+        seen = set()
+        for (name, operation), histogram in histograms:
+            metric = f"bot_{name}"
+            operation = escape_label(operation)
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{operation="{operation}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{operation="{operation}"}} {histogram.sum}')
+            lines.append(f'{metric}_count{{operation="{operation}"}} {histogram.count}')
+        lines.append("# TYPE bot_errors_total counter")
+        for (stage, operation, error), count in errors:
+            stage, operation, error = escape_label(stage), escape_label(operation), escape_label(error)
+            lines.append(f'bot_errors_total{{stage="{stage}",operation="{operation}",type="{error}"}} {count}')
+        for prefix, collect in self._collectors.items():
+            try:
+                values = collect()
+            except Exception:
+                logger.exception("Ошибка при сборе показателей %s", prefix)
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE bot_{prefix}_{key} gauge")
+                    lines.append(f"bot_{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host="127.0.0.1", port=9100):
+        """
+        Запускает HTTP-сервер метрик в фоновом потоке:
+        /metrics - метрики Prometheus; /debug/profile?rate=0.1 - профилирование доли заданий и отчет;
+        /debug/tracemalloc?enable=1 - включение tracemalloc и отчет о выделенной памяти
+        """
+        from http.server import ThreadingHTTPServer
+
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        return self._server
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _add_profile(self, profiler):
+        with self._lock:
+            if self._profile is None:
+                import pstats
+
+                self._profile = pstats.Stats(profiler)
+            else:
+                self._profile.add(profiler)
+            self._profiled_jobs += 1
+
+    def _make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                if url.path == "/metrics":
+                    body = metrics.render()
+                elif url.path == "/debug/profile":
+                    if "rate" in params:
+                        metrics.set_profile_rate(float(params["rate"]))
+                    body = metrics.profile_report(int(params.get("limit", 30)))
+                elif url.path == "/debug/tracemalloc":
+                    if "enable" in params:
+                        metrics.set_tracemalloc(params["enable"] == "1")
+                    body = metrics.tracemalloc_report(int(params.get("limit", 30)))
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
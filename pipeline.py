@@ -0,0 +1,153 @@
+"""
+Цепочки преобразований изображения.
+
+Раньше для последовательности "отразить, затем инвертировать, затем пикселизировать" пользователю приходилось
+трижды пересылать изображение через Telegram, и каждый раз оно заново декодировалось и сжималось в JPEG с
+потерей качества. Цепочка описывается списком шагов и выполняется за один проход: изображение декодируется
+один раз, все шаги применяются подряд, результат кодируется один раз.
+
+Поточечные операции (инверсия, тепловая карта и другие палитры модуля colormaps) объединяются в одну таблицу
+преобразования (LUT) и применяются за один проход. Отражение и пикселизация (NEAREST) только переставляют пиксели и
+перестановочны с поточечными операциями, поэтому поточечные операции объединяются и через них.
+Подготовка стикера (масштабирование LANCZOS) не перестановочна и разделяет цепочку на части.
+
+Функции:
+- build_plan: строит план выполнения из списка шагов с объединением поточечных операций;
+- run_plan: применяет план к изображению;
+- render_steps: выполняет цепочку шагов (используется как задание для пула процессов);
+- output_profile: профиль кодирования результата цепочки (модуль encoding).
+"""
+import colormaps
+from image_processing import mirror_image, pixelate_image, resize_for_sticker
+
+# Шаги цепочки: название -> (вид операции, функция, аргументы, подпись кнопки)
+# Виды: 'geometry' - перестановочна с поточечными операциями, 'point' - поточечная, 'barrier' - прочие
+STEPS = {
+    "mirror_horizontal": ("geometry", mirror_image, ("horizontal",), "Mirror H"),
+    "mirror_vertical": ("geometry", mirror_image, ("vertical",), "Mirror V"),
+    "pixelate": ("geometry", pixelate_image, (20,), "Pixelate"),
+    "invert": ("point", None, (), "Invert"),
+    "heatmap": ("point", None, (), "Heatmap"),
+    "viridis": ("point", None, (), "Viridis"),
+    "sepia": ("point", None, (), "Sepia"),
+    "thermal": ("point", None, (), "Thermal"),
+    "sticker": ("barrier", resize_for_sticker, (), "Sticker"),
+}
+
+# Максимальное количество шагов в цепочке
+MAX_STEPS = 8
+
+
+def luminance(rgb):
+    """
+    Яркость цвета по той же формуле, что и Image.convert('L')
+    """
+    r, g, b = rgb
+    return (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16
+
+
+class PointMap:
+    """
+    Композиция поточечных операций.
+    Пока не встретилась палитра-градиент (тепловая карта и т.п.), композиция - это инверсия (или ее отсутствие)
+    каналов. После градиента результат зависит только от яркости пикселя, и композиция хранится как
+    таблица яркость -> (r, g, b). Инверсия перед первым градиентом остается отдельным проходом: яркость
+    инвертированного пикселя зависит от всех трех каналов, а не только от яркости исходного.
+    """
+
+    def __init__(self):
+        self.inverted = False
+        self.table = None
+
+    def add(self, step):
+        if step == "invert":
+            if self.table is None:
+                self.inverted = not self.inverted
+            else:
+                self.table = tuple((255 - r, 255 - g, 255 - b) for r, g, b in self.table)
+        elif step in colormaps.COLORMAPS and colormaps.is_gradient(step):
+            gradient = colormaps.colors(step)
+            if self.table is None:
+                self.table = tuple(gradient)
+            else:
+                self.table = tuple(gradient[luminance(rgb)] for rgb in self.table)
+        else:
+            raise ValueError(f"Unknown point operation: {step}")
+
+    def apply(self, image):
+        """
+        Применяет композицию: инверсию - вызовом Image.point, таблицу - как палитру
+        """
+        if self.inverted:
+            image = colormaps.apply_colormap(image, "inverted")
+        if self.table is None:
+            return image
+        return colormaps.colorize(image, self.table)
+
+
+def build_plan(steps):
+    """
+    Строит план выполнения: список этапов ('geometry'/'barrier', функция, аргументы) и ('point', PointMap).
+    Поточечные операции между барьерами объединяются в один этап, который выполняется после
+    геометрических операций своего участка.
+    """
+    if len(steps) > MAX_STEPS:
+        raise ValueError(f"Too many steps: {len(steps)} > {MAX_STEPS}")
+    plan = []
+    geometry = []
+    point_map = None
+
+    def flush():
+        plan.extend(geometry)
+        geometry.clear()
+        if point_map is not None:
+            plan.append(("point", point_map, ()))
+
+    for step in steps:
+        if step not in STEPS:
+            raise ValueError(f"Unknown step: {step}")
+        kind, func, args, _ = STEPS[step]
+        if kind == "point":
+            if point_map is None:
+                point_map = PointMap()
+            point_map.add(step)
+        elif kind == "geometry":
+            geometry.append((kind, func, args))
+        else:
+            flush()
+            point_map = None
+            plan.append((kind, func, args))
+    flush()
+    return plan
+
+
+def run_plan(image, plan):
+    """
+    Применяет план к изображению
+    """
+    for kind, operation, args in plan:
+        if kind == "point":
+            image = operation.apply(image)
+        else:
+            image = operation(image, *args)
+    return image
+
+
+def render_steps(image, steps):
+    """
+    Выполняет цепочку шагов над изображением
+    """
+    return run_plan(image, build_plan(steps))
+
+
+def output_profile(steps):
+    """
+    Профиль кодирования результата: стикер (WebP с прозрачностью), если цепочка заканчивается стикером;
+    PNG с палитрой, если после последнего стикера изображение пикселизируется; иначе JPEG
+    """
+    if steps and steps[-1] == "sticker":
+        return "sticker"
+    last_sticker = max((index for index, step in enumerate(steps) if step == "sticker"), default=-1)
+    if "pixelate" in steps[last_sticker + 1:]:
+        return "pixel_art"
+    return "photo"
@@ -0,0 +1,122 @@
+"""
+Кэш результатов обработки.
+
+Повторное нажатие "Heatmap" или "Prepare Sticker", а также одна и та же популярная фотография, пересланная
+разными пользователями, раньше заново обрабатывались и заново загружались в Telegram. Кэш хранит результат
+по ключу (file_unique_id фотографии, операция, параметры):
+- для изображений - file_id, который Telegram вернул после send_photo/send_document: повторная отправка
+по file_id не требует ни обработки, ни загрузки файла;
+- для ASCII-арта - готовый текст.
+
+Записи вытесняются по принципу LRU с ограничением количества и суммарного размера. Если задан путь к базе
+SQLite, кэш сохраняется между перезапусками бота.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Кэш результатов обработки
+    max_entries: максимальное количество записей (в памяти и в базе)
+    max_bytes: максимальный суммарный размер значений в памяти
+    path: путь к базе SQLite для сохранения кэша (None - только в памяти)
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._puts = 0
+        self._counters = dict.fromkeys(('hits', 'misses', 'evictions'), 0)
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                             "key TEXT PRIMARY KEY, value TEXT NOT NULL, used_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(file_unique_id, operation, params=()):
+        """
+        Ключ результата: фотография, операция и параметры обработки
+        """
+        return json.dumps([file_unique_id, operation, list(params)], ensure_ascii=False)
+
+    def get(self, key):
+        """
+        Возвращает сохраненный результат (file_id или текст) или None
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+                return value
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self._counters['hits'] += 1
+                    self._db.execute("UPDATE results SET used_at = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    self._remember(key, row[0])
+                    return row[0]
+            self._counters['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Сохраняет результат
+        """
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO results (key, value, used_at) VALUES (?, ?, ?)",
+                                 (key, value, time.time()))
+                self._puts += 1
+                # Размер базы проверяется не при каждой записи, а раз в 100 записей
+                if self._puts % 100 == 0:
+                    self._db.execute("DELETE FROM results WHERE key IN (SELECT key FROM results "
+                                     "ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+                self._db.commit()
+
+    def delete(self, key):
+        """
+        Удаляет результат (например, если Telegram больше не принимает сохраненный file_id)
+        """
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            if self._db is not None:
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(entries=len(self._entries), bytes=self._size)
+        return stats
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._size += len(value)
+        while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+            _, old_value = self._entries.popitem(last=False)
+            self._size -= len(old_value)
+            self._counters['evictions'] += 1
@@ -0,0 +1,290 @@
+"""
+Планировщик обработки изображений.
+
+Обработчики telebot выполняются в потоке опроса, поэтому длительная обработка одного изображения задерживала
+ответы всем остальным пользователям. Планировщик выносит работу из этого потока:
+- задания (загрузка, обработка, отправка) выполняются в пуле потоков, так как в основном ждут сеть;
+- ресурсоемкие преобразования Pillow выполняются в пуле процессов через run_cpu;
+- задания одного чата выполняются строго по очереди, задания разных чатов - параллельно;
+- очередь ограничена: при переполнении submit возвращает False, и бот отвечает, что сейчас занят.
+
+Для альбомов задание может распараллелить свою работу: map_io выполняет загрузки в отдельном пуле потоков,
+map_cpu - преобразования в пуле процессов. imap_cpu обрабатывает длинную последовательность (например, кадры
+анимации) с ограниченным числом одновременно выполняемых частей.
+
+Если процесс пула завершился аварийно (например, при нехватке памяти, модуль limits), пул больше не принимает
+задания: преобразование завершается ошибкой, а следующее создает новый пул.
+
+current_chat() возвращает чат задания, которое выполняется в текущем потоке: так модуль dispatch отличает
+отправку из очереди чата от отправки из потока обработчика telebot.
+
+Метод stats() возвращает глубину очереди и задержки выполнения заданий, wait_idle() ждет выполнения всех
+принятых заданий (например, перед остановкой процесса).
+"""
+import contextlib
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from itertools import repeat
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Чат задания, которое выполняется в текущем потоке (или задаче asyncio, см. chat_queue)
+_current_chat = contextvars.ContextVar('current_chat', default=None)
+
+
+class ProcessingScheduler:
+    """
+    Планировщик заданий с очередью для каждого чата
+    max_pending: максимальное количество заданий в очереди (ожидающих и выполняющихся)
+    io_workers: количество потоков для заданий (сетевые операции)
+    cpu_workers: количество процессов для преобразований; 0 - выполнять преобразования в потоке задания
+    initializer: функция, которая выполняется при запуске каждого процесса пула (например, ограничение памяти)
+    """
+
+    def __init__(self, max_pending=100, io_workers=8, cpu_workers=None, initializer=None):
+        self.max_pending = max_pending
+        self.cpu_workers = (os.cpu_count() or 1) if cpu_workers is None else cpu_workers
+        self.initializer = initializer
+
+        self._io_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='scheduler-io')
+        # Отдельный пул для map_io: задание, ожидающее загрузок в своем же пуле, могло бы его заблокировать
+        self._fetch_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='scheduler-fetch')
+        self._cpu_pool = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)  # уведомляется, когда все принятые задания выполнены
+        self._chats = {}  # chat_id -> очередь заданий этого чата
+        self._pending = 0
+        self._running = 0
+        self._counters = dict.fromkeys(('submitted', 'completed', 'failed', 'rejected', 'pool_restarts'), 0)
+        self._wait_times = deque(maxlen=1000)
+        self._run_times = deque(maxlen=1000)
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """
+        Ставит задание в очередь чата.
+        Возвращает False, если очередь переполнена и задание не принято.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._counters['rejected'] += 1
+                return False
+            self._pending += 1
+            self._counters['submitted'] += 1
+            queue = self._chats.get(chat_id)
+            start = queue is None
+            if start:
+                queue = self._chats[chat_id] = deque()
+            queue.append((func, args, kwargs, time.monotonic()))
+
+        # Для чата запускается только один исполнитель, остальные задания ждут в его очереди
+        if start:
+            self._io_pool.submit(self._run_next, chat_id)
+        return True
+
+    def run_cpu(self, func, *args, **kwargs):
+        """
+        Выполняет преобразование в пуле процессов и возвращает результат.
+        Аргументы и результат должны поддерживать pickle (объекты PIL.Image поддерживают).
+        """
+        if not self.cpu_workers:
+            return func(*args, **kwargs)
+        pool = self._get_cpu_pool()
+        with self._replace_if_broken(pool):
+            return pool.submit(func, *args, **kwargs).result()
+
+    def submit_cpu(self, func, *args, **kwargs):
+        """
+        Ставит преобразование в пул процессов и сразу возвращает concurrent.futures.Future (асинхронный бот ждет
+        его через asyncio.wrap_future, не занимая поток). Аварийно завершившийся пул заменяется, как в run_cpu.
+        Только для cpu_workers > 0.
+        """
+        pool = self._get_cpu_pool()
+        with self._replace_if_broken(pool):
+            future = pool.submit(func, *args, **kwargs)
+        future.add_done_callback(lambda done: self._forget_if_broken(pool, done))
+        return future
+
+    def map_io(self, func, items):
+        """
+        Выполняет func для каждого элемента параллельно в пуле потоков (например, загрузку фотографий альбома).
+        Возвращает список результатов в порядке элементов.
+        """
+        # Контекст (трассировка задания, модуль metrics) копируется, чтобы он был доступен в потоках пула
+        calls = [(contextvars.copy_context(), item) for item in items]
+        return list(self._fetch_pool.map(lambda call: call[0].run(func, call[1]), calls))
+
+    def map_cpu(self, func, *iterables):
+        """
+        Выполняет преобразования параллельно в пуле процессов. Возвращает список результатов по порядку.
+        """
+        if not self.cpu_workers:
+            return list(map(func, *iterables))
+        pool = self._get_cpu_pool()
+        with self._replace_if_broken(pool):
+            return list(pool.map(func, *iterables))
+
+    def imap_cpu(self, func, items, *args):
+        """
+        Выполняет func(item, *args) для элементов последовательности в пуле процессов и возвращает результаты
+        по порядку по мере готовности. Элементы берутся из items лениво: одновременно в работе не больше
+        двух элементов на процесс.
+        """
+        if not self.cpu_workers:
+            yield from map(func, items, *(repeat(arg) for arg in args))
+            return
+        pool = self._get_cpu_pool()
+        with self._replace_if_broken(pool):
+            yield from imap_executor(pool, func, items, *args, window=self.cpu_workers * 2)
+
+    def stats(self):
+        """
+        Текущее состояние очереди и задержки (в миллисекундах) по последним заданиям
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(queue_depth=self._pending - self._running, running=self._running,
+                         active_chats=len(self._chats))
+            wait_times = sorted(self._wait_times)
+            run_times = sorted(self._run_times)
+        for name, values in (('wait', wait_times), ('run', run_times)):
+            if values:
+                stats[f'{name}_avg_ms'] = sum(values) / len(values) * 1000
+                stats[f'{name}_p95_ms'] = values[min(len(values) - 1, int(len(values) * 0.95))] * 1000
+                stats[f'{name}_max_ms'] = values[-1] * 1000
+        return stats
+
+    def wait_idle(self, timeout=None):
+        """
+        Ждет выполнения всех принятых заданий, включая задания, ожидающие в очередях чатов.
+        Возвращает False, если за timeout секунд они не выполнены.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def shutdown(self, wait=True):
+        """
+        Остановка пулов. При wait=True дожидается выполнения уже принятых заданий.
+        """
+        self._io_pool.shutdown(wait=wait)
+        self._fetch_pool.shutdown(wait=wait)
+        if self._cpu_pool is not None:
+            self._cpu_pool.shutdown(wait=wait)
+
+    def _get_cpu_pool(self):
+        # Пул процессов (и модуль multiprocessing) создается при первом преобразовании, чтобы не замедлять
+        # запуск бота
+        if self._cpu_pool is None:
+            with self._lock:
+                if self._cpu_pool is None:
+                    self._cpu_pool = process_pool(self.cpu_workers, self.initializer)
+        return self._cpu_pool
+
+    @contextlib.contextmanager
+    def _replace_if_broken(self, pool):
+        # Процесс пула завершился аварийно: пул заменяется новым при следующем преобразовании
+        try:
+            yield
+        except BrokenExecutor:
+            self._forget_pool(pool)
+            pool.shutdown(wait=False)
+            raise
+
+    def _forget_if_broken(self, pool, future):
+        # Вызывается потоком управления пула: сам пул уже остановлен, поэтому shutdown не нужен
+        if not future.cancelled() and isinstance(future.exception(), BrokenExecutor):
+            self._forget_pool(pool)
+
+    def _forget_pool(self, pool):
+        with self._lock:
+            if self._cpu_pool is pool:
+                self._cpu_pool = None
+                self._counters['pool_restarts'] += 1
+                logger.warning("Процесс пула обработки завершился аварийно, пул будет создан заново")
+
+    def _run_next(self, chat_id):
+        with self._lock:
+            func, args, kwargs, queued_at = self._chats[chat_id].popleft()
+            self._running += 1
+        started_at = time.monotonic()
+        try:
+            with chat_queue(chat_id):
+                func(*args, **kwargs)
+        except Exception:
+            logger.exception("Ошибка при обработке задания для чата %s", chat_id)
+            failed = True
+        else:
+            failed = False
+        finished_at = time.monotonic()
+
+        with self._lock:
+            self._running -= 1
+            self._pending -= 1
+            self._counters['failed' if failed else 'completed'] += 1
+            self._wait_times.append(started_at - queued_at)
+            self._run_times.append(finished_at - started_at)
+            has_more = bool(self._chats[chat_id])
+            if not has_more:
+                del self._chats[chat_id]
+            if not self._pending:
+                self._idle.notify_all()
+
+        # Следующее задание чата снова ставится в общий пул, чтобы один чат не занимал поток надолго
+        if has_more:
+            self._io_pool.submit(self._run_next, chat_id)
+
+
+def current_chat():
+    """
+    Чат, в очереди которого выполняется текущий код (None - вне заданий планировщика)
+    """
+    return _current_chat.get()
+
+
+@contextlib.contextmanager
+def chat_queue(chat_id):
+    """
+    Отмечает код внутри блока как задание из очереди чата chat_id (current_chat). Асинхронный бот
+    отмечает так задания, которые выполняет по очереди для каждого чата.
+    """
+    token = _current_chat.set(chat_id)
+    try:
+        yield
+    finally:
+        _current_chat.reset(token)
+
+
+def process_pool(max_workers, initializer=None):
+    """
+    Пул процессов для преобразований. Процессы запускаются через forkserver (spawn, если forkserver
+    недоступен), а не fork: процесс бота многопоточный (потоки опроса, заданий, цикл событий aiohttp),
+    и копия его памяти в дочернем процессе может содержать захваченные блокировки и открытые соединения.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=initializer,
+                               mp_context=multiprocessing.get_context(method))
+
+
+def imap_executor(executor, func, items, *args, window=4):
+    """
+    Генератор результатов func(item, *args), выполняемых в executor, не больше window заданий одновременно.
+    Если генератор закрыт раньше времени, еще не начатые задания отменяются.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item, *args))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,366 @@
+"""
+Хранилище состояний пользователей.
+
+Раньше состояние хранилось в словаре, который рос без ограничений и терялся при перезапуске бота.
+Хранилище ограничивает объем памяти и удаляет неактивные сессии:
+- MemoryStateStore: LRU в памяти с ограничением количества записей и временем жизни (TTL);
+- SQLiteStateStore: сохраняет состояния в SQLite (режим WAL) с пакетной записью изменений, перед базой
+используется MemoryStateStore как кэш активных чатов. После перезапуска пользователям не нужно заново
+загружать фотографию.
+
+Проверка "ожидается ли набор символов" выполняется за O(1), так как фильтр обработчика set_ascii_chars
+вызывается для каждого текстового сообщения: в памяти - по отдельному множеству чатов, в SQLite - для чатов вне
+кэша памяти запросом по индексу с ограниченным LRU-кэшем ответов (память не растет с количеством чатов в базе).
+
+create_state_store выбирает хранилище по переменным окружения:
+- STATE_BACKEND: memory (по умолчанию) или sqlite;
+- STATE_DB_PATH: путь к файлу базы SQLite;
+- STATE_TTL: время жизни неактивной сессии в секундах;
+- STATE_MAX_ENTRIES: максимальное количество сессий в памяти.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserState:
+    """
+    Состояние чата: фотография и выбранные пользователем параметры обработки
+    """
+    __slots__ = ('photo', 'file_unique_id', 'sizes', 'album', 'media', 'ascii_chars', 'chain', 'updated_at')
+
+    def __init__(self, photo=None, file_unique_id=None, sizes=None, album=None, media=None, ascii_chars=None,
+                 chain=None, updated_at=None):
+        self.photo = photo
+        self.file_unique_id = file_unique_id
+        self.sizes = sizes  # все варианты фотографии: [file_id, file_unique_id, ширина, высота]
+        self.album = album  # варианты всех фотографий альбома (модуль album), None - одна фотография
+        self.media = media  # None - фотография, "image" - изображение-файл или стикер, "animation" - GIF
+        self.ascii_chars = ascii_chars
+        self.chain = chain  # шаги цепочки преобразований (модуль pipeline)
+        self.updated_at = time.time() if updated_at is None else updated_at
+
+    @property
+    def awaiting_charset(self):
+        """
+        Фотография получена, но набор символов для ASCII-арта еще не введен
+        """
+        return self.photo is not None and self.ascii_chars is None
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'updated_at'}
+
+    @classmethod
+    def from_dict(cls, data, updated_at=None):
+        state = cls(updated_at=updated_at)
+        for name, value in data.items():
+            if name in cls.__slots__:
+                setattr(state, name, value)
+        return state
+
+
+class MemoryStateStore:
+    """
+    Хранилище состояний в памяти
+    max_entries: максимальное количество чатов (давно неактивные вытесняются)
+    ttl: время жизни неактивной сессии в секундах
+    """
+
+    def __init__(self, max_entries=100000, ttl=24 * 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._states = OrderedDict()
+        self._awaiting = set()
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, chat_id):
+        """
+        Возвращает состояние чата или None, если его нет или сессия истекла
+        """
+        with self._lock:
+            state = self._states.get(chat_id)
+            if state is None:
+                return None
+            if time.time() - state.updated_at > self.ttl:
+                self._remove(chat_id)
+                return None
+            self._states.move_to_end(chat_id)
+            return state
+
+    def set_photo(self, chat_id, photo, file_unique_id=None, sizes=None, album=None, media=None):
+        """
+        Начинает новую сессию с полученной фотографией (для альбома - с первой фотографией альбома)
+        media: вид файла для изображений, присланных не как фотография ("image" или "animation")
+        """
+        state = UserState(photo=photo, file_unique_id=file_unique_id, sizes=sizes, album=album, media=media)
+        self.put(chat_id, state)
+        return state
+
+    def update(self, chat_id, **fields):
+        """
+        Изменяет поля состояния чата. Возвращает состояние или None, если сессия истекла.
+        """
+        with self._lock:
+            state = MemoryStateStore.get(self, chat_id)
+            if state is None:
+                return None
+            for name, value in fields.items():
+                setattr(state, name, value)
+            state.updated_at = time.time()
+            self._index(chat_id, state)
+            return state
+
+    def put(self, chat_id, state):
+        """
+        Сохраняет состояние чата, вытесняя самые давно неактивные чаты при превышении лимита
+        """
+        with self._lock:
+            self._states[chat_id] = state
+            self._states.move_to_end(chat_id)
+            self._index(chat_id, state)
+            while len(self._states) > self.max_entries:
+                old_chat_id = next(iter(self._states))
+                self._remove(old_chat_id)
+
+    def delete(self, chat_id):
+        with self._lock:
+            if chat_id in self._states:
+                self._remove(chat_id)
+
+    def is_awaiting_charset(self, chat_id):
+        """
+        Проверка за O(1): ожидается ли от чата набор символов для ASCII-арта
+        """
+        return chat_id in self._awaiting and self.get(chat_id) is not None
+
+    def purge_expired(self):
+        """
+        Удаляет истекшие сессии. Возвращает количество удаленных записей.
+        """
+        deadline = time.time() - self.ttl
+        with self._lock:
+            expired = [chat_id for chat_id, state in self._states.items() if state.updated_at < deadline]
+            for chat_id in expired:
+                self._remove(chat_id)
+        return len(expired)
+
+    def close(self):
+        pass
+
+    def _index(self, chat_id, state):
+        if state.awaiting_charset:
+            self._awaiting.add(chat_id)
+        else:
+            self._awaiting.discard(chat_id)
+
+    def _remove(self, chat_id):
+        del self._states[chat_id]
+        self._awaiting.discard(chat_id)
+
+
+class SQLiteStateStore(MemoryStateStore):
+    """
+    Хранилище состояний в SQLite с кэшем активных чатов в памяти.
+    Изменения накапливаются и записываются пакетом: при накоплении batch_size изменений или
+    раз в flush_interval секунд (в фоновом потоке), а также при закрытии хранилища.
+    path: путь к файлу базы данных
+    batch_size: количество изменений, после которого они записываются сразу
+    flush_interval: период фоновой записи изменений в секундах
+    max_lookups: сколько ответов is_awaiting_charset для чатов вне кэша памяти хранить (LRU)
+    """
+
+    def __init__(self, path, max_entries=100000, ttl=24 * 60 * 60, batch_size=100, flush_interval=1.0,
+                 max_lookups=10000):
+        super().__init__(max_entries=max_entries, ttl=ttl)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_lookups = max_lookups
+        # chat_id -> время изменения записи, ожидающей набор символов, или 0 (не ожидает); только чаты вне кэша
+        self._lookups = OrderedDict()
+
+        self._db_lock = threading.Lock()
+        self._dirty = {}      # chat_id -> состояние для записи (None - удалить)
+        self._flushing = {}   # изменения, которые записываются в базу в данный момент
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS user_states ("
+                         "chat_id INTEGER PRIMARY KEY, updated_at REAL NOT NULL, "
+                         "awaiting INTEGER NOT NULL, data TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS user_states_updated_at ON user_states (updated_at)")
+        # Частичный индекс: только чаты, ожидающие набор символов (is_awaiting_charset)
+        self._db.execute("CREATE INDEX IF NOT EXISTS user_states_awaiting ON user_states (chat_id, updated_at) "
+                         "WHERE awaiting = 1")
+        self._db.commit()
+        self.purge_expired()
+
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name='state-store-flush', daemon=True)
+        self._flusher.start()
+
+    def get(self, chat_id):
+        state = super().get(chat_id)
+        if state is not None:
+            return state
+        with self._lock:
+            pending = self._pending(chat_id)
+            if pending is not None:
+                # Изменение еще не записано в базу: берем его, а не устаревшую запись из базы
+                state = pending[0]
+                if state is None or time.time() - state.updated_at > self.ttl:
+                    return None
+                MemoryStateStore.put(self, chat_id, state)
+                return state
+        # Чата нет в кэше: читаем из базы и помещаем в кэш
+        with self._db_lock:
+            row = self._db.execute("SELECT updated_at, data FROM user_states WHERE chat_id = ?",
+                                   (chat_id,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        state = UserState.from_dict(json.loads(row[1]), updated_at=row[0])
+        with self._lock:
+            # Пока шло чтение, состояние могло быть изменено другим потоком
+            if chat_id in self._states or self._pending(chat_id) is not None:
+                return self.get(chat_id)
+            MemoryStateStore.put(self, chat_id, state)
+        return state
+
+    def update(self, chat_id, **fields):
+        # Состояние читается из базы (get) до блокировки, под блокировкой оно берется из кэша памяти. Если за это
+        # время чат вытеснен из кэша, чтение повторяется
+        while self.get(chat_id) is not None:
+            with self._lock:
+                if chat_id in self._states:
+                    state = super().update(chat_id, **fields)
+                    if state is not None:
+                        self._mark_dirty(chat_id, state)
+                    return state
+        return None
+
+    def put(self, chat_id, state):
+        with self._lock:
+            super().put(chat_id, state)
+            self._mark_dirty(chat_id, state)
+
+    def delete(self, chat_id):
+        with self._lock:
+            super().delete(chat_id)
+            self._mark_dirty(chat_id, None)
+
+    def is_awaiting_charset(self, chat_id):
+        # Чат в кэше памяти или с незаписанными изменениями: ответ по его состоянию
+        with self._lock:
+            if chat_id in self._states or self._pending(chat_id) is not None:
+                state = self.get(chat_id)
+                return state is not None and state.awaiting_charset
+            updated_at = self._lookups.get(chat_id)
+            if updated_at is not None:
+                self._lookups.move_to_end(chat_id)
+        if updated_at is None:
+            # Чтение из базы по индексу - вне блокировки состояний
+            with self._db_lock:
+                row = self._db.execute("SELECT updated_at FROM user_states WHERE chat_id = ? AND awaiting = 1",
+                                       (chat_id,)).fetchone()
+            updated_at = row[0] if row else 0
+            with self._lock:
+                # Пока шло чтение, состояние могло быть изменено другим потоком: тогда ответ не запоминается
+                if chat_id in self._states or self._pending(chat_id) is not None:
+                    return self.is_awaiting_charset(chat_id)
+                self._lookups[chat_id] = updated_at
+                while len(self._lookups) > self.max_lookups:
+                    self._lookups.popitem(last=False)
+        if not updated_at or time.time() - updated_at > self.ttl:
+            return False
+        # Чат ожидает набор символов: состояние понадобится обработчику, загружаем его в кэш памяти
+        return self.get(chat_id) is not None
+
+    def purge_expired(self):
+        self.flush()
+        super().purge_expired()
+        with self._db_lock:
+            with self._db:
+                cursor = self._db.execute("DELETE FROM user_states WHERE updated_at < ?",
+                                          (time.time() - self.ttl,))
+        return cursor.rowcount
+
+    def flush(self):
+        """
+        Записывает накопленные изменения в базу одной транзакцией
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            self._flushing = dirty
+        rows = []
+        deleted = []
+        for chat_id, state in dirty.items():
+            if state is None:
+                deleted.append((chat_id,))
+            else:
+                rows.append((chat_id, state.updated_at, int(state.awaiting_charset),
+                             json.dumps(state.to_dict(), ensure_ascii=False)))
+        with self._db_lock:
+            with self._db:
+                self._db.executemany("DELETE FROM user_states WHERE chat_id = ?", deleted)
+                self._db.executemany("INSERT OR REPLACE INTO user_states (chat_id, updated_at, awaiting, data) "
+                                     "VALUES (?, ?, ?, ?)", rows)
+        with self._lock:
+            self._flushing = {}
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._flusher.join()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def _pending(self, chat_id):
+        """
+        Незаписанное изменение чата в виде кортежа (состояние,) или None, если изменений нет
+        """
+        for changes in (self._dirty, self._flushing):
+            if chat_id in changes:
+                return (changes[chat_id],)
+        return None
+
+    def _mark_dirty(self, chat_id, state):
+        self._dirty[chat_id] = state
+        self._lookups.pop(chat_id, None)
+        if len(self._dirty) >= self.batch_size:
+            self._wakeup.set()
+
+    def _flush_loop(self):
+        last_purge = time.monotonic()
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            # Истекшие сессии удаляются из базы не чаще раза в минуту
+            if time.monotonic() - last_purge > 60:
+                self.purge_expired()
+                last_purge = time.monotonic()
+
+
+def create_state_store():
+    """
+    Создание хранилища состояний по настройкам из переменных окружения
+    """
+    max_entries = int(os.getenv('STATE_MAX_ENTRIES', 100000))
+    ttl = int(os.getenv('STATE_TTL', 24 * 60 * 60))
+    if os.getenv('STATE_BACKEND', 'memory') == 'sqlite':
+        return SQLiteStateStore(os.getenv('STATE_DB_PATH', 'user_states.sqlite3'), max_entries=max_entries, ttl=ttl,
+                                max_lookups=int(os.getenv('STATE_MAX_LOOKUPS', 10000)))
+    return MemoryStateStore(max_entries=max_entries, ttl=ttl)
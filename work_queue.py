@@ -0,0 +1,275 @@
+"""
+Очередь обновлений Telegram для запуска бота в несколько процессов (модуль cluster).
+
+Один процесс (ingress) получает обновления и кладет их в очередь, несколько процессов-обработчиков забирают
+их из очереди. Обновления распределяются по сегментам (shard) по идентификатору чата: обработчик владеет своими
+сегментами и забирает задания по порядку, поэтому сообщения и нажатия кнопок одного чата обрабатываются
+в том порядке, в котором пришли, а разные чаты - параллельно в разных процессах.
+
+Реализации очереди (брокера) с одинаковым интерфейсом:
+- MemoryWorkQueue: очередь в памяти для обработчиков-потоков одного процесса (разработка и отладка);
+- SQLiteWorkQueue: очередь в файле SQLite (режим WAL), общая для процессов на одной машине. Задания
+хранятся до подтверждения (ack): если обработчик завершился аварийно, взятые им задания при следующем запуске
+возвращаются в очередь (release).
+
+Очередь запоминает номер последнего принятого обновления: повторно полученные обновления (например, после
+перезапуска ingress) не добавляются второй раз.
+
+create_work_queue выбирает очередь по переменным окружения:
+- WORK_QUEUE_BACKEND: sqlite (по умолчанию) или memory;
+- WORK_QUEUE_PATH: путь к файлу базы SQLite;
+- WORK_QUEUE_SHARDS: количество сегментов (должно быть не меньше количества обработчиков и не меняться,
+пока в очереди есть задания);
+- WORK_QUEUE_POLL_INTERVAL: как часто обработчик проверяет пустую очередь SQLite, в секундах.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Виды обновлений, в которых есть сообщение с чатом
+MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+
+def update_chat_id(update):
+    """
+    Идентификатор чата обновления (словарь в формате Bot API). Для обновлений без чата - идентификатор
+    пользователя, а если нет и его - 0.
+    """
+    for field in MESSAGE_FIELDS:
+        if field in update:
+            return update[field]['chat']['id']
+    callback = update.get('callback_query')
+    if callback is not None:
+        message = callback.get('message')
+        return message['chat']['id'] if message else callback['from']['id']
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from']['id']
+    return 0
+
+
+def shard_for(chat_id, shards):
+    return chat_id % shards
+
+
+def worker_shards(index, workers, shards):
+    """
+    Сегменты, которыми владеет обработчик с номером index
+    """
+    return tuple(shard for shard in range(shards) if shard % workers == index)
+
+
+class MemoryWorkQueue:
+    """
+    Очередь обновлений в памяти процесса
+    shards: количество сегментов
+    """
+
+    def __init__(self, shards=64):
+        self.shards = shards
+        self._condition = threading.Condition()
+        self._jobs = [deque() for _ in range(shards)]  # сегмент -> [(номер задания, обновление)]
+        self._claimed = {}  # номер задания -> (сегмент, обновление)
+        self._last_update_id = 0
+        self._next_id = 1
+
+    def put(self, updates):
+        """
+        Добавляет обновления в очередь. Уже принятые обновления пропускаются.
+        Возвращает количество добавленных обновлений.
+        """
+        added = 0
+        with self._condition:
+            for update in updates:
+                if update['update_id'] <= self._last_update_id:
+                    continue
+                self._last_update_id = update['update_id']
+                self._jobs[shard_for(update_chat_id(update), self.shards)].append((self._next_id, update))
+                self._next_id += 1
+                added += 1
+            if added:
+                self._condition.notify_all()
+        return added
+
+    def last_update_id(self):
+        with self._condition:
+            return self._last_update_id
+
+    def claim(self, shards, limit=10, timeout=1.0):
+        """
+        Забирает до limit заданий из сегментов shards по порядку поступления. Если заданий нет, ждет до timeout
+        секунд. Возвращает список (номер задания, обновление).
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                jobs = self._take(shards, limit)
+                remaining = deadline - time.monotonic()
+                if jobs or remaining <= 0:
+                    return jobs
+                self._condition.wait(remaining)
+
+    def ack(self, job_ids):
+        """
+        Подтверждает обработку заданий (они удаляются из очереди)
+        """
+        with self._condition:
+            for job_id in job_ids:
+                self._claimed.pop(job_id, None)
+
+    def release(self, shards):
+        """
+        Возвращает в очередь взятые, но не подтвержденные задания сегментов shards
+        """
+        with self._condition:
+            released = sorted((job_id, job) for job_id, job in self._claimed.items() if job[0] in shards)
+            for job_id, (shard, update) in reversed(released):
+                del self._claimed[job_id]
+                self._jobs[shard].appendleft((job_id, update))
+            if released:
+                self._condition.notify_all()
+        return len(released)
+
+    def pending(self, shards=None):
+        """
+        Количество заданий в очереди (всего или в сегментах shards), включая взятые и не подтвержденные
+        """
+        shards = range(self.shards) if shards is None else shards
+        with self._condition:
+            return (sum(len(self._jobs[shard]) for shard in shards)
+                    + sum(1 for shard, _ in self._claimed.values() if shard in shards))
+
+    def stats(self):
+        with self._condition:
+            return {'queued': sum(len(jobs) for jobs in self._jobs), 'claimed': len(self._claimed),
+                    'last_update_id': self._last_update_id}
+
+    def close(self):
+        pass
+
+    def _take(self, shards, limit):
+        # Задания нескольких сегментов берутся по порядку поступления
+        jobs = []
+        while len(jobs) < limit:
+            heads = [(self._jobs[shard][0][0], shard) for shard in shards if self._jobs[shard]]
+            if not heads:
+                break
+            _, shard = min(heads)
+            job_id, update = self._jobs[shard].popleft()
+            self._claimed[job_id] = (shard, update)
+            jobs.append((job_id, update))
+        return jobs
+
+
+class SQLiteWorkQueue:
+    """
+    Очередь обновлений в SQLite, общая для процессов одной машины.
+    Каждый процесс открывает очередь заново (соединение SQLite нельзя передавать между процессами).
+    path: путь к файлу базы данных
+    shards: количество сегментов
+    poll_interval: пауза между проверками пустой очереди в claim, в секундах
+    """
+
+    def __init__(self, path, shards=64, poll_interval=0.05):
+        self.path = path
+        self.shards = shards
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        # Несколько процессов пишут в базу одновременно: ждем освобождения блокировки до 30 секунд
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self._db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                             "id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL, "
+                             "claimed INTEGER NOT NULL DEFAULT 0, payload TEXT NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_shard ON jobs (shard, claimed, id)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS ingress (id INTEGER PRIMARY KEY CHECK (id = 1), "
+                             "last_update_id INTEGER NOT NULL)")
+            self._db.execute("INSERT OR IGNORE INTO ingress (id, last_update_id) VALUES (1, 0)")
+
+    def put(self, updates):
+        with self._transaction():
+            last_update_id = self._db.execute("SELECT last_update_id FROM ingress").fetchone()[0]
+            rows = [(shard_for(update_chat_id(update), self.shards), json.dumps(update, ensure_ascii=False))
+                    for update in updates if update['update_id'] > last_update_id]
+            if rows:
+                self._db.executemany("INSERT INTO jobs (shard, payload) VALUES (?, ?)", rows)
+                self._db.execute("UPDATE ingress SET last_update_id = ?",
+                                 (max(update['update_id'] for update in updates),))
+        return len(rows)
+
+    def last_update_id(self):
+        with self._lock:
+            return self._db.execute("SELECT last_update_id FROM ingress").fetchone()[0]
+
+    def claim(self, shards, limit=10, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        placeholders = ','.join('?' * len(shards))
+        while True:
+            with self._transaction():
+                rows = self._db.execute(f"SELECT id, payload FROM jobs WHERE shard IN ({placeholders}) "
+                                        f"AND claimed = 0 ORDER BY id LIMIT ?", (*shards, limit)).fetchall()
+                self._db.executemany("UPDATE jobs SET claimed = 1 WHERE id = ?", [(job_id,) for job_id, _ in rows])
+            if rows or time.monotonic() >= deadline:
+                return [(job_id, json.loads(payload)) for job_id, payload in rows]
+            time.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+    def ack(self, job_ids):
+        with self._transaction():
+            self._db.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+    def release(self, shards):
+        placeholders = ','.join('?' * len(shards))
+        with self._transaction():
+            cursor = self._db.execute(f"UPDATE jobs SET claimed = 0 WHERE shard IN ({placeholders}) AND claimed = 1",
+                                      tuple(shards))
+        return cursor.rowcount
+
+    def pending(self, shards=None):
+        with self._lock:
+            if shards is None:
+                return self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            placeholders = ','.join('?' * len(shards))
+            return self._db.execute(f"SELECT COUNT(*) FROM jobs WHERE shard IN ({placeholders})",
+                                    tuple(shards)).fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            queued, claimed = self._db.execute("SELECT COUNT(*) - COALESCE(SUM(claimed), 0), "
+                                               "COALESCE(SUM(claimed), 0) FROM jobs").fetchone()
+            last_update_id = self._db.execute("SELECT last_update_id FROM ingress").fetchone()[0]
+        return {'queued': queued, 'claimed': claimed, 'last_update_id': last_update_id}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Транзакция BEGIN IMMEDIATE: блокировка записи берется сразу, поэтому процессы не мешают друг другу
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+
+def create_work_queue(backend=None):
+    """
+    Создание очереди обновлений по настройкам из переменных окружения
+    """
+    shards = int(os.getenv('WORK_QUEUE_SHARDS', 64))
+    if (backend or os.getenv('WORK_QUEUE_BACKEND', 'sqlite')) == 'memory':
+        return MemoryWorkQueue(shards=shards)
+    return SQLiteWorkQueue(os.getenv('WORK_QUEUE_PATH', 'work_queue.sqlite3'), shards=shards,
+                           poll_interval=float(os.getenv('WORK_QUEUE_POLL_INTERVAL', 0.05)))